@@ -0,0 +1,232 @@
+"""Embedding providers, a persistent embedding store and micro-batching of concurrent embedding requests.
+
+This module is kept identical in `data-processing/notebooks` and `webapp/src` (checked by the tests), so that the index
+build and the search queries embed texts the same way.
+"""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections.abc import Callable, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Texts -> float32 matrix of one (normalized) embedding per text
+Embedder = Callable[[Sequence[str]], np.ndarray]
+
+ONNX_INT8_FILE = "onnx/model_qint8.onnx"
+
+
+def embedding_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+class EndpointEmbedder:
+    """Embeds with an OpenAI-compatible serving endpoint, `max_batch_size` texts per request."""
+
+    def __init__(self, open_ai_client: Any, model: str, max_batch_size: int = 128):
+        self.open_ai_client = open_ai_client
+        self.model = model
+        self.max_batch_size = max_batch_size
+
+    def __call__(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = []
+        for start in range(0, len(texts), self.max_batch_size):
+            response = self.open_ai_client.embeddings.create(
+                model=self.model, input=list(texts[start : start + self.max_batch_size])
+            )
+            vectors += [i.embedding for i in sorted(response.data, key=lambda i: i.index)]
+        return _normalize(np.array(vectors, dtype=np.float32))
+
+
+class LocalEmbedder:
+    """Embeds on the CPU with sentence-transformers (optional dependency), by default with an ONNX model quantized to
+    int8 once and saved to `cache_dir`.
+
+    The model must be the one the index was built with, e.g. `Alibaba-NLP/gte-large-en-v1.5` for an index built with
+    the `databricks-gte-large-en` endpoint.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        quantized: bool = True,
+        cache_dir: str | Path = "/tmp/eng-rec-models",
+        batch_size: int = 32,
+    ):
+        from sentence_transformers import SentenceTransformer
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        if not quantized:
+            self.model = SentenceTransformer(model_name, backend="onnx", trust_remote_code=True)
+            return
+
+        quantized_path = Path(cache_dir) / model_name.replace("/", "--")
+        if not (quantized_path / ONNX_INT8_FILE).exists():
+            from sentence_transformers import export_dynamic_quantized_onnx_model
+
+            logger.info(f"Quantizing {model_name} to int8 into {quantized_path}")
+            model = SentenceTransformer(model_name, backend="onnx", trust_remote_code=True)
+            model.save(str(quantized_path))
+            export_dynamic_quantized_onnx_model(model, "avx2", str(quantized_path), file_suffix="qint8")
+        self.model = SentenceTransformer(
+            str(quantized_path), backend="onnx", trust_remote_code=True, model_kwargs={"file_name": ONNX_INT8_FILE}
+        )
+
+    def __call__(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = self.model.encode(list(texts), batch_size=self.batch_size, normalize_embeddings=True)
+        return np.asarray(vectors, dtype=np.float32)
+
+
+class SQLiteEmbeddingStore:
+    """Embeddings stored in a single SQLite file, keyed by the hash of the model and the text.
+
+    Connections are per thread, like the completion cache's.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self._local = threading.local()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection().execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, keys: Sequence[str]) -> dict[str, np.ndarray]:
+        found = {}
+        # SQLite limits the number of query parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            rows = self._connection().execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            found.update({k: np.frombuffer(v, dtype=np.float32) for k, v in rows})
+        return found
+
+    def put_many(self, vectors: dict[str, np.ndarray]) -> None:
+        conn = self._connection()
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+            [(k, np.asarray(v, dtype=np.float32).tobytes()) for k, v in vectors.items()],
+        )
+        conn.execute("COMMIT")
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def stored_embedder(embed: Embedder, store: SQLiteEmbeddingStore, model: str) -> Embedder:
+    """Wraps an embedder so that texts already embedded with `model` are read from the store instead."""
+
+    def _embed(texts: Sequence[str]) -> np.ndarray:
+        keys = [embedding_key(model, t) for t in texts]
+        stored = store.get_many(keys)
+        missing = list({k: t for k, t in zip(keys, texts) if k not in stored}.items())
+        if missing:
+            embedded = embed([t for _, t in missing])
+            new = {k: v for (k, _), v in zip(missing, embedded)}
+            store.put_many(new)
+            stored.update(new)
+        return np.vstack([stored[k] for k in keys]) if keys else np.zeros((0, 0), dtype=np.float32)
+
+    return _embed
+
+
+@dataclass
+class _Request:
+    texts: Sequence[str]
+    future: Future = field(default_factory=Future)
+
+
+class MicroBatchingEmbedder:
+    """Coalesces the calls of concurrent threads into batched calls of `embed`.
+
+    A call waits at most `max_wait_seconds` for others to join its batch, of up to `max_batch_size` texts (a larger
+    call is embedded on its own). Identical texts of a batch are embedded once.
+    """
+
+    def __init__(self, embed: Embedder, max_batch_size: int = 64, max_wait_seconds: float = 0.005):
+        self.embed = embed
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.n_batches = 0
+        self._queue: list[_Request] = []
+        self._condition = threading.Condition()
+        self._worker: threading.Thread | None = None
+
+    def __call__(self, texts: Sequence[str]) -> np.ndarray:
+        request = _Request(texts)
+        with self._condition:
+            self._queue.append(request)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+            self._condition.notify()
+        return request.future.result()
+
+    def _next_batch(self) -> list[_Request]:
+        with self._condition:
+            self._condition.wait_for(lambda: bool(self._queue))
+            deadline = time.monotonic() + self.max_wait_seconds
+            while sum(len(r.texts) for r in self._queue) < self.max_batch_size:
+                if (remaining := deadline - time.monotonic()) <= 0 or not self._condition.wait(remaining):
+                    break
+            batch: list[_Request] = []
+            n_texts = 0
+            while self._queue and (not batch or n_texts + len(self._queue[0].texts) <= self.max_batch_size):
+                n_texts += len(self._queue[0].texts)
+                batch.append(self._queue.pop(0))
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            self.n_batches += 1
+            unique_texts = list(dict.fromkeys(t for r in batch for t in r.texts))
+            try:
+                vectors = self.embed(unique_texts)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            rows = {t: i for i, t in enumerate(unique_texts)}
+            for request in batch:
+                request.future.set_result(vectors[[rows[t] for t in request.texts]])
+
+
+def embed_corpus(embed: Embedder, texts: Sequence[str], batch_size: int = 256, max_workers: int = 4) -> np.ndarray:
+    """Embeds a whole corpus by batches, `max_workers` batches at a time, logging the progress."""
+    batches = [texts[start : start + batch_size] for start in range(0, len(texts), batch_size)]
+    start_time, vectors = time.perf_counter(), []
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="embed-corpus") as executor:
+        for n_batch, batch_vectors in enumerate(executor.map(embed, batches), start=1):
+            vectors.append(batch_vectors)
+            if n_batch % 10 == 0 or n_batch == len(batches):
+                elapsed = time.perf_counter() - start_time
+                logger.info(f"Embedded {min(n_batch * batch_size, len(texts))}/{len(texts)} texts in {elapsed:.1f}s")
+    return np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
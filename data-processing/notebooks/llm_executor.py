@@ -0,0 +1,178 @@
+import logging
+import random
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from json import JSONDecodeError
+from typing import Any, TypeVar
+
+import openai
+from pydantic import ValidationError
+from tenacity import Retrying, retry_if_exception_type, stop_after_attempt
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 429, 500, 502, 503, 504})
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token, rounded up like the webapp's), good enough for rate limiting."""
+    return (len(text) + 3) // 4
+
+
+class RateLimiter:
+    """Requests-per-second and tokens-per-second limiter shared by all worker threads.
+
+    Each call reserves its budget up front and then sleeps until the reservation is covered, so a single large
+    request can never deadlock the limiter.
+    """
+
+    def __init__(self, requests_per_second: float | None = None, tokens_per_second: float | None = None):
+        self.requests_per_second = requests_per_second
+        self.tokens_per_second = tokens_per_second
+        self._request_budget = requests_per_second or 0.0
+        self._token_budget = tokens_per_second or 0.0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed, self._last_refill = now - self._last_refill, now
+        if self.requests_per_second:
+            self._request_budget = min(
+                self.requests_per_second, self._request_budget + elapsed * self.requests_per_second
+            )
+        if self.tokens_per_second:
+            self._token_budget = min(self.tokens_per_second, self._token_budget + elapsed * self.tokens_per_second)
+
+    def acquire(self, tokens: int = 0) -> float:
+        """Blocks until the request fits in the budget and returns the time spent waiting."""
+        with self._lock:
+            self._refill()
+            wait_s = 0.0
+            if self.requests_per_second:
+                self._request_budget -= 1
+                wait_s = max(wait_s, -self._request_budget / self.requests_per_second)
+            if self.tokens_per_second:
+                self._token_budget -= tokens
+                wait_s = max(wait_s, -self._token_budget / self.tokens_per_second)
+
+        if wait_s > 0:
+            time.sleep(wait_s)
+        return wait_s
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_attempts: int = 6
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+
+    def backoff(self, attempt: int, exc: BaseException) -> float:
+        retry_after = _retry_after_seconds(exc)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        # "Full jitter" exponential backoff, so that throttled workers do not retry in lockstep
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+def _root_exception(exc: BaseException) -> BaseException:
+    # instructor wraps every failure of the underlying client in an InstructorRetryException
+    while not isinstance(exc, openai.APIError):
+        inner = exc.args[0] if exc.args and isinstance(exc.args[0], BaseException) else exc.__cause__
+        if inner is None or inner is exc:
+            break
+        exc = inner
+    return exc
+
+
+def _retry_after_seconds(exc: BaseException) -> float | None:
+    root = _root_exception(exc)
+    if not isinstance(root, openai.APIStatusError):
+        return None
+    try:
+        return float(root.response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+def validation_retries(max_attempts: int = 3) -> Retrying:
+    """Retries for instructor that only re-ask on invalid outputs.
+
+    By default instructor immediately retries on any exception, API errors included, which would bypass the
+    executor's backoff and rate limiting.
+    """
+    return Retrying(
+        stop=stop_after_attempt(max_attempts), retry=retry_if_exception_type((ValidationError, JSONDecodeError))
+    )
+
+
+def is_retryable(exc: BaseException) -> bool:
+    root = _root_exception(exc)
+    if isinstance(root, openai.APIConnectionError):
+        return True
+    return isinstance(root, openai.APIStatusError) and root.status_code in RETRYABLE_STATUS_CODES
+
+
+class LLMExecutor:
+    """Runs LLM calls with bounded concurrency, rate limiting and retries on throttling / server errors."""
+
+    def __init__(
+        self,
+        max_in_flight: int = 8,
+        rate_limiter: RateLimiter | None = None,
+        retry_policy: RetryPolicy | None = None,
+    ):
+        self.max_in_flight = max_in_flight
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.retry_policy = retry_policy or RetryPolicy()
+
+    def call(self, fn: Callable[..., R], *args: Any, tokens: int = 0, **kwargs: Any) -> R:
+        """Calls `fn` in the current thread, waiting for the rate limiter and retrying transient failures."""
+        attempt = 1
+        while True:
+            self.rate_limiter.acquire(tokens)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.retry_policy.max_attempts or not is_retryable(e):
+                    raise
+                delay = self.retry_policy.backoff(attempt, e)
+                logger.warning(f"Attempt {attempt} failed with {_root_exception(e)!r}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+
+    def map_pipeline(self, pipeline: Callable[[T], R], items: Iterable[T]) -> Iterator[tuple[int, R | Exception]]:
+        """Runs `pipeline` over `items` on `max_in_flight` workers, yielding `(index, result)` as items complete.
+
+        Every stage of an item runs back to back on the same worker, so e.g. censoring starts as soon as that
+        issue's distillation returns. Items are consumed lazily, and a failed item yields its exception instead
+        of aborting the whole run.
+        """
+        items_iter = enumerate(items)
+        pending: dict[Future, int] = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="llm-executor") as pool:
+
+            def _fill() -> None:
+                # Keep at most two items per worker queued, so huge inputs are never fully materialized
+                while len(pending) < 2 * self.max_in_flight:
+                    try:
+                        idx, item = next(items_iter)
+                    except StopIteration:
+                        return
+                    pending[pool.submit(pipeline, item)] = idx
+
+            _fill()
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    idx = pending.pop(future)
+                    exc = future.exception()
+                    yield idx, exc if isinstance(exc, Exception) else future.result()
+                _fill()
@@ -0,0 +1,163 @@
+"""Routes the structured LLM calls to a small model first, escalating to the large one, and accounts for their tokens.
+
+Prompts up to `max_small_tokens` go to the small model, with `small_max_attempts` attempts (instructor's re-asks on
+invalid outputs included). Once they are used up, or when the small model's answer is not confident enough, the call
+is escalated to the large model, which gets the full `validation_retries`. Larger prompts go to the large model
+directly. Every call's model, tokens (re-asks included), latency and attempts are recorded as an `LLMUsage`.
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Callable, Mapping, Sequence
+from dataclasses import asdict, dataclass
+from typing import Any, Literal, TypeVar
+
+import instructor
+from instructor.exceptions import InstructorRetryException
+from llm_executor import RateLimiter, estimate_tokens, validation_retries
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+ResponseModel = TypeVar("ResponseModel", bound=BaseModel)
+
+Outcome = Literal["ok", "invalid", "low_confidence"]
+
+
+@dataclass(frozen=True)
+class LLMUsage:
+    stage: str
+    model: str
+    prompt_tokens: int
+    completion_tokens: int
+    latency_s: float
+    attempts: int
+    # "invalid" and "low_confidence" calls of the small model were escalated
+    outcome: Outcome
+    timestamp: float
+
+
+class UsageRecorder:
+    """Usage of the calls made by all the worker threads, until the job drains it into its usage table."""
+
+    def __init__(self) -> None:
+        self._usages: list[LLMUsage] = []
+        self._totals: dict[str, dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self._lock = threading.Lock()
+
+    def record(self, usage: LLMUsage) -> None:
+        with self._lock:
+            self._usages.append(usage)
+            totals = self._totals[usage.model]
+            totals["calls"] += 1
+            totals["rejected"] += usage.outcome != "ok"
+            totals["prompt_tokens"] += usage.prompt_tokens
+            totals["completion_tokens"] += usage.completion_tokens
+            totals["latency_s"] += usage.latency_s
+
+    def drain(self) -> list[dict[str, Any]]:
+        with self._lock:
+            usages, self._usages = self._usages, []
+        return [asdict(usage) for usage in usages]
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """Calls, rejected answers, tokens and mean latency per model, since the recorder was created."""
+        with self._lock:
+            return {
+                model: {**totals, "latency_s": totals["latency_s"] / totals["calls"]}
+                for model, totals in self._totals.items()
+            }
+
+
+def _prompt_tokens(messages: Sequence[Mapping[str, Any]]) -> int:
+    return sum(estimate_tokens(message["content"]) for message in messages)
+
+
+class ModelRouter:
+    """Sends the calls of prompts up to `max_small_tokens` to `small_model` first, see the module's docstring.
+
+    Without a `small_model`, every call goes to `large_model`, as if there was no router. Escalated calls wait for the
+    `rate_limiter`, if any, like the first one did in the executor.
+    """
+
+    def __init__(
+        self,
+        large_model: str,
+        small_model: str | None = None,
+        max_small_tokens: int = 1000,
+        small_max_attempts: int = 2,
+        usage: UsageRecorder | None = None,
+        rate_limiter: RateLimiter | None = None,
+    ):
+        self.large_model = large_model
+        self.small_model = small_model
+        self.max_small_tokens = max_small_tokens
+        self.small_max_attempts = small_max_attempts
+        self.usage = usage
+        self.rate_limiter = rate_limiter
+
+    def models(self, messages: Sequence[Mapping[str, Any]]) -> list[str]:
+        """The models a prompt is sent to, in order, until one gives a valid and confident answer."""
+        if self.small_model is not None and _prompt_tokens(messages) <= self.max_small_tokens:
+            return [self.small_model, self.large_model]
+        return [self.large_model]
+
+    def create(
+        self,
+        instructor_client: instructor.client.Instructor,
+        response_model: type[ResponseModel],
+        messages: list[dict],
+        stage: str,
+        confident: Callable[[ResponseModel], bool] | None = None,
+    ) -> tuple[ResponseModel, str]:
+        """The response of the first model that gives a valid (and, but for the last one, confident) answer, and
+        that model."""
+        models = self.models(messages)
+        for n_model, model in enumerate(models):
+            escalable = n_model < len(models) - 1
+            if n_model and self.rate_limiter is not None:
+                self.rate_limiter.acquire(_prompt_tokens(messages))
+            retrying = validation_retries(self.small_max_attempts) if escalable else validation_retries()
+            start = time.perf_counter()
+            try:
+                response, completion = instructor_client.chat.completions.create_with_completion(
+                    model=model,
+                    response_model=response_model,
+                    max_retries=retrying,  # type: ignore[arg-type]  # accepts tenacity.Retrying
+                    # instructor appends re-ask messages in place
+                    messages=list(messages),  # type: ignore[arg-type]
+                    # Deterministic, as the completions are cached (see `completion_cache_key`)
+                    temperature=0.0,
+                )
+            except InstructorRetryException as e:
+                self._record(stage, model, e.total_usage, start, e.n_attempts, "invalid")
+                if not escalable:
+                    raise
+                logger.debug(f"{model} gave no valid {stage} answer in {e.n_attempts} attempts, escalating")
+                continue
+            attempts = retrying.statistics.get("attempt_number", 1)
+            if escalable and confident is not None and not confident(response):
+                self._record(stage, model, completion.usage, start, attempts, "low_confidence")
+                logger.debug(f"{model}'s {stage} answer is not confident enough, escalating")
+                continue
+            self._record(stage, model, completion.usage, start, attempts, "ok")
+            return response, model
+        raise AssertionError("The last model is never escalated")
+
+    def _record(self, stage: str, model: str, usage: Any, start: float, attempts: int, outcome: Outcome) -> None:
+        if self.usage is None:
+            return
+        self.usage.record(
+            LLMUsage(
+                stage=stage,
+                model=model,
+                prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+                completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+                latency_s=time.perf_counter() - start,
+                attempts=attempts,
+                outcome=outcome,
+                timestamp=time.time(),
+            )
+        )
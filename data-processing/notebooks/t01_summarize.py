@@ -1,22 +1,94 @@
+import difflib
+import hashlib
+import json
 import logging
+import re
 import textwrap
+import time
 from base64 import b64decode
-from collections.abc import Mapping
+from collections.abc import Callable, Collection, Iterable, Iterator, Mapping, Sequence
+from pathlib import Path
+from typing import Any, Literal, TypeVar
 
 import instructor
+import pandas as pd
+from completion_cache import CompletionCache, SQLiteCompletionCache, completion_cache_key
 from databricks.connect import DatabricksSession
 from databricks.sdk import WorkspaceClient
+from llm_executor import LLMExecutor, RateLimiter, estimate_tokens
+from model_router import ModelRouter, UsageRecorder
 from openai import OpenAI
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
 from tqdm.auto import tqdm
 
 DATABRICKS_TOKEN_SECRET = dict(scope="eng-rec-scope", key="databricks-token")
 INSTRUCT_MODEL = "databricks-meta-llama-3-1-70b-instruct"
+# Issues whose prompt has up to SMALL_MODEL_MAX_TOKENS tokens are sent to the small model first, and escalated to
+# INSTRUCT_MODEL when it gives no valid answer in SMALL_MODEL_MAX_ATTEMPTS attempts (instructor's re-asks included) or a
+# low confidence one (see `_is_confident`). None sends every issue to INSTRUCT_MODEL
+SMALL_INSTRUCT_MODEL: str | None = "databricks-meta-llama-3-1-8b-instruct"
+SMALL_MODEL_MAX_TOKENS = 1000
+SMALL_MODEL_MAX_ATTEMPTS = 2
+# A small model's summary longer than this times what it summarizes is likely made up
+MAX_SUMMARY_LENGTH_RATIO = 1.2
 SOURCE_TABLE = "workspace.default.raw_tracked_issues"
 DESTINATION_TABLE = "workspace.default.summarized_tracked_issues"
+# Model, tokens, latency, attempts and outcome of every call, appended after every chunk
+USAGE_TABLE = "workspace.default.llm_usage"
+USAGE_COLUMNS = {
+    "stage": "Stage",
+    "model": "Model",
+    "prompt_tokens": "PromptTokens",
+    "completion_tokens": "CompletionTokens",
+    "latency_s": "LatencySeconds",
+    "attempts": "Attempts",
+    "outcome": "Outcome",
+    "timestamp": "Timestamp",
+}
+# The webapp adds the recommendations submitted by the engineers to the destination, with negative Ids
+TRACKED_ISSUES = "Id >= 0"
+
+# Only (re)summarize issues whose content or prompts changed since the last run, and MERGE them into the destination
+INCREMENTAL = True
+VERSION_COLUMNS = ("ContentHash", "Distilled", "Model", "DistillerVersion", "CensorVersion")
+
+# Concurrency and rate limits for the serving endpoint, tune them to the endpoint's provisioned throughput
+MAX_IN_FLIGHT = 8
+REQUESTS_PER_SECOND = 2.0
+TOKENS_PER_SECOND = 10_000
+MAX_FAILED_FRACTION = 0.05
+
+# Issues are streamed from the source table and summarized by chunks, each committed to the destination on its own,
+# so the driver only holds one chunk and a rerun after a crash resumes after the last committed chunk
+CHUNK_SIZE = 500
+
+# "two-pass": a distiller call then a censor call per issue. "fused": a single call that distills and censors at once,
+# on an issue whose turbine IDs, site, OEMs and ratings were already censored by regexes (see `_pre_censor_issue`)
+SUMMARIZATION_MODE: Literal["two-pass", "fused"] = "two-pass"
+# Bump when the pre-censoring patterns change, so that the fused summaries are redone
+PRE_CENSOR_VERSION = "1"
+# Summarizes a random sample of issues in both modes and reports how the fused summaries differ from the two-pass ones
+QUALITY_SAMPLE_SIZE = 0
+QUALITY_REPORT_PATH = "/Volumes/workspace/default/eng_rec/summarization_quality.json"
+# Summarizes a random sample of issues with the router and with INSTRUCT_MODEL only, and reports how they differ
+ROUTING_QUALITY_SAMPLE_SIZE = 0
+ROUTING_QUALITY_REPORT_PATH = "/Volumes/workspace/default/eng_rec/routing_quality.json"
+
+# Completions are deterministic, so reruns (e.g. after a crash) reuse them instead of calling the endpoint again. SQLite
+# needs a local disk, so the cache is merged with its snapshot on the volume (shared with the webapp's
+# COMPLETION_CACHE_SNAPSHOT_PATH) when the job starts, every COMPLETION_CACHE_SYNC_CHUNKS chunks and when it ends
+COMPLETION_CACHE_PATH = "/tmp/eng-rec-helper/completion_cache.sqlite"
+COMPLETION_CACHE_SNAPSHOT_PATH = "/Volumes/workspace/default/eng_rec/completion_cache.sqlite"
+COMPLETION_CACHE_SYNC_CHUNKS = 10
+COMPLETION_CACHE_BYPASS = False
 
 logger = logging.getLogger(__name__)
 
+ResponseModel = TypeVar("ResponseModel", bound="RoutedResponse")
+T = TypeVar("T")
+
 prompt_spec = {
     "distiller": {
         "main_prompt": (
@@ -60,37 +132,116 @@ prompt_spec = {
         "recommendation_prompt": ("The recommendation that the performance engineer has made to resolve the issue."),
         "resolution_prompt": ("The action that was taken to resolve the issue."),
     },
+    "fused": {
+        "main_prompt": (
+            "Distill the following issue into its symptoms, recommendations, and resolution, censoring it. "
+            "Remember to: "
+            "- Think step by step "
+            "- Do not include anything that is not there "
+            "- Remove any dates from the output "
+            "- Objects should be called by what they are. "
+            "- Censor any identifying details about personnel, turbines, equipment identifiers"
+            " (e.g. T4), as well as site names. "
+            "- Personnel name should be turned to their job title (E.G.: Asset Manager)"
+            " or 'Individual' if not there.  "
+            "- Think carefully about site names, they are usually capitalised. Replace site name with 'SITE'. "
+            "- Turbine identifiers should be replaced with 'TURBINE/S'. "
+            "- Replace turbine manufacturers (e.g. GE, Nordex, Siemens) with 'OEM'. "
+            "- Some identifiers were already replaced with 'SITE', 'TURBINE', 'OEM' or 'RATING', keep them as they are "
+            "but leave out the 'RATING' ones.\n"
+        ),
+        "symptoms_prompt": (
+            "The problem that a performance engineer has identified, focusing on the actual engineering and physics "
+            "on what happened. Keep it to two sentences."
+        ),
+        "recommendation_prompt": (
+            "The recommendation that the performance engineer has made to resolve the issue. Keep it to two sentences."
+        ),
+        "resolution_prompt": (
+            "The action that was taken to resolve the issue. Sometimes it is not there, if so - Leave empty. "
+            "Keep it to one sentence."
+        ),
+    },
 }
 
 
 def _raw_issue_to_single_markdown(issue: Mapping) -> str:
     return textwrap.dedent(f"""\
-    # {issue['Issue Title']}
+    # {issue["Issue Title"]}
 
     ## Description
-    {issue['Description']}
+    {issue["Description"]}
 
     ## Closing Comment
-    {issue['Closing Comment']}
+    {issue["Closing Comment"]}
     """)
 
 
-class DistilledIssue(BaseModel):
+class RoutedResponse(BaseModel):
+    # The model that answered, which is not part of the response
+    _answered_by: str = PrivateAttr(default=INSTRUCT_MODEL)
+
+
+def _cached_response(
+    cache: CompletionCache | None, router: ModelRouter, response_model: type[ResponseModel], messages: list[dict]
+) -> ResponseModel | None:
+    """The cached response of any of the models the prompt would be sent to, e.g. of the large model once escalated."""
+    if cache is None:
+        return None
+    schema = response_model.model_json_schema()
+    for model in router.models(messages):
+        if (cached := cache.get(completion_cache_key(model, messages, schema))) is not None:
+            response = response_model.model_validate_json(cached)
+            response._answered_by = model
+            return response
+    return None
+
+
+def _create_cached(
+    instructor_client: instructor.client.Instructor,
+    cache: CompletionCache | None,
+    router: ModelRouter,
+    response_model: type[ResponseModel],
+    messages: list[dict],
+    stage: str,
+    confident: Callable[[ResponseModel], bool] | None = None,
+) -> ResponseModel:
+    response, model = router.create(instructor_client, response_model, messages, stage, confident=confident)
+    response._answered_by = model
+    if cache is not None:
+        cache.set(completion_cache_key(model, messages, response_model.model_json_schema()), response.model_dump_json())
+    return response
+
+
+class DistilledIssue(RoutedResponse):
     symptoms: str = Field(..., description=prompt_spec["distiller"]["symptoms_prompt"])
     recommendation: str = Field(..., description=prompt_spec["distiller"]["recommendation_prompt"])
     resolution: str = Field(..., description=prompt_spec["distiller"]["resolution_prompt"])
 
 
 class Distiller:
-    def __init__(self, main_prompt: str):
+    def __init__(self, main_prompt: str, cache: CompletionCache | None = None, router: ModelRouter | None = None):
         self.main_prompt = main_prompt
+        self.cache = cache
+        self.router = router or ModelRouter(INSTRUCT_MODEL)
+
+    def _messages(self, issue: Mapping) -> list[dict]:
+        issue_markdown = _raw_issue_to_single_markdown(issue)
+        return [{"role": "user", "content": f"{self.main_prompt}:\n{issue_markdown}"}]
+
+    def from_cache(self, issue: Mapping) -> DistilledIssue | None:
+        return _cached_response(self.cache, self.router, DistilledIssue, self._messages(issue))
 
     def run_instructor(self, issue: Mapping, instructor_client: instructor.client.Instructor) -> DistilledIssue:
         issue_markdown = _raw_issue_to_single_markdown(issue)
-        return instructor_client.chat.completions.create(
-            model=INSTRUCT_MODEL,
-            response_model=DistilledIssue,
-            messages=[{"role": "user", "content": f"{self.main_prompt}:\n{issue_markdown}"}],
+        return _create_cached(
+            instructor_client,
+            self.cache,
+            self.router,
+            DistilledIssue,
+            self._messages(issue),
+            stage="distiller",
+            confident=lambda distilled_issue: _is_confident(distilled_issue, issue_markdown),
         )
 
 
@@ -108,23 +259,458 @@ def _distilled_issue_to_single_markdown(distilled_issue: DistilledIssue) -> str:
     """)
 
 
-class CensorIssue(BaseModel):
+class CensorIssue(RoutedResponse):
     symptoms: str = Field(..., description=prompt_spec["censor"]["symptoms_prompt"])
     recommendation: str = Field(..., description=prompt_spec["censor"]["recommendation_prompt"])
     resolution: str = Field(..., description=prompt_spec["censor"]["resolution_prompt"])
 
 
+def _censored_issue_to_summary(censored_issue: CensorIssue) -> str:
+    return "\n\n".join([f"### {k.title()}:\n{v}" for k, v in censored_issue.model_dump().items()])
+
+
 class Censor:
-    def __init__(self, main_prompt: str):
+    def __init__(self, main_prompt: str, cache: CompletionCache | None = None, router: ModelRouter | None = None):
         self.main_prompt = main_prompt
+        self.cache = cache
+        self.router = router or ModelRouter(INSTRUCT_MODEL)
 
-    def run_instructor(self, issue: DistilledIssue, instructor_client: instructor.client.Instructor) -> CensorIssue:
+    def _messages(self, issue: DistilledIssue) -> list[dict]:
         issue_markdown = _distilled_issue_to_single_markdown(distilled_issue=issue)
-        return instructor_client.chat.completions.create(
-            model=INSTRUCT_MODEL,
-            response_model=CensorIssue,
-            messages=[{"role": "user", "content": f"{self.main_prompt}:\n{issue_markdown}"}],
+        return [{"role": "user", "content": f"{self.main_prompt}:\n{issue_markdown}"}]
+
+    def from_cache(self, issue: DistilledIssue) -> CensorIssue | None:
+        return _cached_response(self.cache, self.router, CensorIssue, self._messages(issue))
+
+    def run_instructor(
+        self, issue: DistilledIssue, instructor_client: instructor.client.Instructor, raw_issue: Mapping
+    ) -> CensorIssue:
+        """Censors a distilled issue, checking the answer against the identifiers of its `raw_issue`."""
+        issue_markdown = _distilled_issue_to_single_markdown(distilled_issue=issue)
+        replacements = _identifier_replacements(raw_issue)
+        return _create_cached(
+            instructor_client,
+            self.cache,
+            self.router,
+            CensorIssue,
+            self._messages(issue),
+            stage="censor",
+            confident=lambda censored_issue: _is_confident(censored_issue, issue_markdown, replacements),
+        )
+
+
+OEM_NAMES = (
+    "Siemens Gamesa",
+    "Siemens",
+    "Gamesa",
+    "General Electric",
+    "GE",
+    "Nordex",
+    "Vestas",
+    "Enercon",
+    "Senvion",
+    "Repower",
+    "Suzlon",
+    "Goldwind",
+    "Acciona",
+    "Mitsubishi",
+    "Envision",
+)
+_TURBINE_ID_PATTERN = re.compile(r"\b(?:WTG[\s-]?|T)\d{1,3}\b")
+_OEM_PATTERN = re.compile(r"\b(?:" + "|".join(map(re.escape, OEM_NAMES)) + r")\b")
+# Power outputs and lengths (rotor diameter, hub height), not speeds like "12 m/s"
+_RATING_PATTERN = re.compile(r"\b\d+(?:\.\d+)?\s?(?:MW|m|meters|metres)(?![\w/])")
+
+
+def _identifier_replacements(issue: Mapping) -> list[tuple[re.Pattern, str]]:
+    """The identifiers to censor in an issue: its own site and turbine names, then turbine IDs, OEMs and ratings."""
+    own_names = ((issue.get("Site"), "SITE"), (issue.get("Turbine"), "TURBINE"))
+    replacements = [
+        (re.compile(rf"(?<!\w){re.escape(name.strip())}(?!\w)", re.IGNORECASE), placeholder)
+        for name, placeholder in own_names
+        if isinstance(name, str) and name.strip()
+    ]
+    return [*replacements, (_TURBINE_ID_PATTERN, "TURBINE"), (_OEM_PATTERN, "OEM"), (_RATING_PATTERN, "RATING")]
+
+
+def _pre_censor(text: str, replacements: Sequence[tuple[re.Pattern, str]]) -> str:
+    for pattern, placeholder in replacements:
+        text = pattern.sub(placeholder, text)
+    return text
+
+
+def _pre_censor_issue(issue: Mapping) -> dict:
+    replacements = _identifier_replacements(issue)
+    fields = ("Issue Title", "Description", "Closing Comment")
+    return {**issue, **{k: _pre_censor(issue[k], replacements) for k in fields if isinstance(issue[k], str)}}
+
+
+def _count_identifiers(text: str, replacements: Sequence[tuple[re.Pattern, str]]) -> int:
+    return sum(len(pattern.findall(text)) for pattern, _ in replacements)
+
+
+def _is_confident(response: BaseModel, source: str, replacements: Sequence[tuple[re.Pattern, str]] = ()) -> bool:
+    """Whether a small model's answer can be kept rather than escalated: it found the symptoms, it is not much longer
+    than what it summarizes, and it left none of the identifiers it had to censor (`replacements`), if any."""
+    fields = response.model_dump()
+    text = "\n".join(fields.values())
+    return (
+        bool(fields["symptoms"].strip())
+        and len(text) <= MAX_SUMMARY_LENGTH_RATIO * len(source)
+        and _count_identifiers(text, replacements) == 0
+    )
+
+
+class SummarizedIssue(RoutedResponse):
+    symptoms: str = Field(..., description=prompt_spec["fused"]["symptoms_prompt"])
+    recommendation: str = Field(..., description=prompt_spec["fused"]["recommendation_prompt"])
+    resolution: str = Field(..., description=prompt_spec["fused"]["resolution_prompt"])
+
+
+class FusedSummarizer:
+    """Distills and censors an issue in a single call, instead of a `Distiller` then a `Censor` call."""
+
+    def __init__(self, main_prompt: str, cache: CompletionCache | None = None, router: ModelRouter | None = None):
+        self.main_prompt = main_prompt
+        self.cache = cache
+        self.router = router or ModelRouter(INSTRUCT_MODEL)
+
+    def _messages(self, issue: Mapping) -> list[dict]:
+        issue_markdown = _raw_issue_to_single_markdown(_pre_censor_issue(issue))
+        return [{"role": "user", "content": f"{self.main_prompt}:\n{issue_markdown}"}]
+
+    def from_cache(self, issue: Mapping) -> SummarizedIssue | None:
+        return _cached_response(self.cache, self.router, SummarizedIssue, self._messages(issue))
+
+    def run_instructor(self, issue: Mapping, instructor_client: instructor.client.Instructor) -> SummarizedIssue:
+        issue_markdown = _raw_issue_to_single_markdown(_pre_censor_issue(issue))
+        replacements = _identifier_replacements(issue)
+        return _create_cached(
+            instructor_client,
+            self.cache,
+            self.router,
+            SummarizedIssue,
+            self._messages(issue),
+            stage="fused",
+            confident=lambda summarized_issue: _is_confident(summarized_issue, issue_markdown, replacements),
+        )
+
+
+Action = Literal["summarize", "censor", "skip"]
+
+
+def _content_hash(issue: Mapping) -> str:
+    fields = (issue[k] if isinstance(issue[k], str) else "" for k in ("Issue Title", "Description", "Closing Comment"))
+    return hashlib.sha256("\x1f".join(fields).encode()).hexdigest()
+
+
+def _prompt_version(stage: str, model: str) -> str:
+    spec_dict = {"model": model, "prompts": prompt_spec[stage]}
+    if stage == "fused":
+        spec_dict["pre_censor_version"] = PRE_CENSOR_VERSION
+    spec = json.dumps(spec_dict, sort_keys=True)
+    return hashlib.sha256(spec.encode()).hexdigest()[:16]
+
+
+def _version_stages() -> tuple[str, str]:
+    """The stages whose prompt versions are stored as the distiller's and the censor's. Both are the fused stage in
+    fused mode, so that switching modes resummarizes everything and nothing is re-censored."""
+    return ("fused", "fused") if SUMMARIZATION_MODE == "fused" else ("distiller", "censor")
+
+
+def _written_versions(
+    action: Action, previous: Mapping | None, distilled_issue: DistilledIssue, censored_issue: CensorIssue
+) -> tuple[str, str]:
+    """The prompt versions of the models that wrote an issue's distilled issue and summary (the stored distilled
+    issue's, when only the censor ran again)."""
+    distiller_stage, censor_stage = _version_stages()
+    if action == "censor" and previous is not None:
+        distiller_version = previous["DistillerVersion"]
+    else:
+        distiller_version = _prompt_version(distiller_stage, distilled_issue._answered_by)
+    return distiller_version, _prompt_version(censor_stage, censored_issue._answered_by)
+
+
+def _plan_action(
+    content_hash: str, previous: Mapping | None, distiller_versions: Collection[str], censor_versions: Collection[str]
+) -> Action:
+    """Decides how much of the pipeline has to run again for an issue, given its previous summary (if any).
+
+    The versions are those of the models the stages may be routed to, so that changing either model redoes what it
+    wrote. A distiller change (or new content) invalidates everything, whereas a censor change can reuse the stored
+    distilled issue, as the censor only ever sees the distiller's output.
+    """
+    if (
+        previous is None
+        or previous["ContentHash"] != content_hash
+        or previous["DistillerVersion"] not in distiller_versions
+        or not previous["Distilled"]
+    ):
+        return "summarize"
+    if previous["CensorVersion"] not in censor_versions:
+        return "censor"
+    return "skip"
+
+
+def _summarize_issue(
+    issue: Mapping,
+    distiller: Distiller,
+    censor: Censor,
+    instructor_client: instructor.client.Instructor,
+    executor: LLMExecutor,
+    distilled_issue: DistilledIssue | None = None,
+) -> tuple[DistilledIssue, CensorIssue]:
+    # Cache hits skip the executor, so they do not count towards the endpoint's rate limits
+    if distilled_issue is None:
+        distilled_issue = distiller.from_cache(issue)
+    if distilled_issue is None:
+        distilled_issue = executor.call(
+            distiller.run_instructor,
+            issue=issue,
+            instructor_client=instructor_client,
+            tokens=estimate_tokens(distiller.main_prompt + _raw_issue_to_single_markdown(issue)),
+        )
+    censored_issue = censor.from_cache(distilled_issue)
+    if censored_issue is None:
+        censored_issue = executor.call(
+            censor.run_instructor,
+            issue=distilled_issue,
+            instructor_client=instructor_client,
+            raw_issue=issue,
+            tokens=estimate_tokens(censor.main_prompt + _distilled_issue_to_single_markdown(distilled_issue)),
         )
+    return distilled_issue, censored_issue
+
+
+def _summarize_issue_fused(
+    issue: Mapping,
+    summarizer: FusedSummarizer,
+    instructor_client: instructor.client.Instructor,
+    executor: LLMExecutor,
+) -> tuple[DistilledIssue, CensorIssue]:
+    """Same output as `_summarize_issue`, except that the stored distilled issue is already censored."""
+    summarized_issue = summarizer.from_cache(issue)
+    if summarized_issue is None:
+        summarized_issue = executor.call(
+            summarizer.run_instructor,
+            issue=issue,
+            instructor_client=instructor_client,
+            tokens=estimate_tokens(summarizer.main_prompt + _raw_issue_to_single_markdown(issue)),
+        )
+    fields = summarized_issue.model_dump()
+    distilled_issue, censored_issue = DistilledIssue(**fields), CensorIssue(**fields)
+    distilled_issue._answered_by = censored_issue._answered_by = summarized_issue._answered_by
+    return distilled_issue, censored_issue
+
+
+def _stages(cache: CompletionCache | None, router: ModelRouter) -> tuple[Distiller, Censor, FusedSummarizer]:
+    return (
+        Distiller(main_prompt=prompt_spec["distiller"]["main_prompt"], cache=cache, router=router),
+        Censor(main_prompt=prompt_spec["censor"]["main_prompt"], cache=cache, router=router),
+        FusedSummarizer(main_prompt=prompt_spec["fused"]["main_prompt"], cache=cache, router=router),
+    )
+
+
+def _summarize(
+    issue: Mapping,
+    stages: tuple[Distiller, Censor, FusedSummarizer],
+    instructor_client: instructor.client.Instructor,
+    executor: LLMExecutor,
+    distilled_issue: DistilledIssue | None = None,
+) -> tuple[DistilledIssue, CensorIssue]:
+    """Summarizes an issue in the `SUMMARIZATION_MODE`."""
+    distiller, censor, summarizer = stages
+    if SUMMARIZATION_MODE == "fused":
+        return _summarize_issue_fused(issue, summarizer, instructor_client, executor)
+    return _summarize_issue(issue, distiller, censor, instructor_client, executor, distilled_issue=distilled_issue)
+
+
+def _quality_diff(
+    issue: Mapping, two_pass: CensorIssue, fused: CensorIssue, modes: tuple[str, str] = ("two_pass", "fused")
+) -> dict[str, float]:
+    """How a fused summary differs from the two-pass one (or any summary from a baseline one, named by `modes`):
+    word-level similarity and length ratio of every field, and the number of identifiers left in each (as found by
+    the pre-censoring patterns)."""
+    diff = {}
+    for name in CensorIssue.model_fields:
+        two_pass_text, fused_text = getattr(two_pass, name), getattr(fused, name)
+        diff[f"{name}_similarity"] = difflib.SequenceMatcher(None, two_pass_text.split(), fused_text.split()).ratio()
+        diff[f"{name}_length_ratio"] = len(fused_text) / max(len(two_pass_text), 1)
+    replacements = _identifier_replacements(issue)
+    diff[f"{modes[0]}_identifiers"] = _count_identifiers(_censored_issue_to_summary(two_pass), replacements)
+    diff[f"{modes[1]}_identifiers"] = _count_identifiers(_censored_issue_to_summary(fused), replacements)
+    return diff
+
+
+def _quality_report(
+    diffs: Sequence[Mapping[str, float]], modes: tuple[str, str] = ("two_pass", "fused")
+) -> dict[str, float]:
+    """Means of the per-issue metrics, plus the fraction of summaries with identifiers left, per mode."""
+    if not diffs:
+        return {"n_issues": 0}
+    report: dict[str, float] = {"n_issues": len(diffs)}
+    report |= {k: sum(d[k] for d in diffs) / len(diffs) for k in diffs[0]}
+    for mode in modes:
+        report[f"{mode}_leaky_fraction"] = sum(d[f"{mode}_identifiers"] > 0 for d in diffs) / len(diffs)
+    return report
+
+
+def _compare_modes(
+    issue: Mapping,
+    distiller: Distiller,
+    censor: Censor,
+    summarizer: FusedSummarizer,
+    instructor_client: instructor.client.Instructor,
+    executor: LLMExecutor,
+) -> dict[str, float]:
+    start = time.perf_counter()
+    _, two_pass = _summarize_issue(issue, distiller, censor, instructor_client, executor)
+    two_pass_seconds, start = time.perf_counter() - start, time.perf_counter()
+    _, fused = _summarize_issue_fused(issue, summarizer, instructor_client, executor)
+    fused_seconds = time.perf_counter() - start
+    return {
+        **_quality_diff(issue, two_pass, fused),
+        "two_pass_seconds": two_pass_seconds,
+        "fused_seconds": fused_seconds,
+    }
+
+
+def _compare_routing(
+    issue: Mapping,
+    baseline_stages: tuple[Distiller, Censor, FusedSummarizer],
+    routed_stages: tuple[Distiller, Censor, FusedSummarizer],
+    instructor_client: instructor.client.Instructor,
+    executor: LLMExecutor,
+) -> dict[str, float]:
+    """How an issue's routed summary differs from the `INSTRUCT_MODEL` one, and whether the small model wrote it."""
+    start = time.perf_counter()
+    _, baseline = _summarize(issue, baseline_stages, instructor_client, executor)
+    baseline_seconds, start = time.perf_counter() - start, time.perf_counter()
+    _, routed = _summarize(issue, routed_stages, instructor_client, executor)
+    routed_seconds = time.perf_counter() - start
+    return {
+        **_quality_diff(issue, baseline, routed, modes=("baseline", "routed")),
+        "baseline_seconds": baseline_seconds,
+        "routed_seconds": routed_seconds,
+        "small_model": float(routed._answered_by != INSTRUCT_MODEL),
+    }
+
+
+def _read_previous_summaries(spark: SparkSession) -> dict[Any, dict]:
+    if not spark.catalog.tableExists(DESTINATION_TABLE):
+        return {}
+    # The recommendations submitted in the webapp have no raw issue, so they are neither summarized nor deleted
+    previous_df = spark.read.table(DESTINATION_TABLE).where(TRACKED_ISSUES)
+    if not set(VERSION_COLUMNS).issubset(previous_df.columns):
+        logger.warning(f"{DESTINATION_TABLE} predates incremental summarization, summarizing all issues")
+        return {}
+    # Only whether there is a distilled issue, it is read by chunk when needed (see `_read_distilled`)
+    distilled = (F.col("Distilled").isNotNull() & (F.col("Distilled") != "")).alias("Distilled")
+    version_columns = [c if c != "Distilled" else distilled for c in VERSION_COLUMNS]
+    previous_pdf = previous_df.select("Id", *version_columns).toPandas()
+    return {_row["Id"]: _row for _row in previous_pdf.to_dict("records")}
+
+
+def _read_distilled(spark: SparkSession, ids: list) -> dict[Any, DistilledIssue]:
+    if not ids:
+        return {}
+    rows = spark.read.table(DESTINATION_TABLE).where(F.col("Id").isin(ids)).select("Id", "Distilled").collect()
+    return {_row["Id"]: DistilledIssue.model_validate_json(_row["Distilled"]) for _row in rows}
+
+
+def _plan_work(
+    raw_issues: Iterable[dict],
+    previous_summaries: Mapping[Any, Mapping],
+    distiller_versions: Collection[str],
+    censor_versions: Collection[str],
+    seen_ids: set,
+) -> Iterator[tuple[dict, str, Action]]:
+    """Yields the issues to (re)summarize, with their content hash and action, adding every issue's ID to `seen_ids`."""
+    for raw_issue in raw_issues:
+        seen_ids.add(raw_issue["Id"])
+        content_hash = _content_hash(raw_issue)
+        previous = previous_summaries.get(raw_issue["Id"])
+        action = _plan_action(content_hash, previous, distiller_versions, censor_versions)
+        if action != "skip":
+            yield raw_issue, content_hash, action
+
+
+def _chunked(items: Iterable[T], size: int) -> Iterator[list[T]]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _write_summaries(spark: SparkSession, summaries: list[dict], deleted_ids: list, full_refresh: bool) -> None:
+    if full_refresh:
+        logger.info(f"Overwriting {DESTINATION_TABLE} with {len(summaries)} summarized issues")
+        writer = spark.createDataFrame(pd.DataFrame(summaries)).write.mode("overwrite")
+        if spark.catalog.tableExists(DESTINATION_TABLE):
+            # Keeps the recommendations submitted in the webapp
+            writer = writer.option("replaceWhere", TRACKED_ISSUES).option("mergeSchema", "true")
+        writer.saveAsTable(DESTINATION_TABLE)
+        return
+
+    logger.info(f"Merging {len(summaries)} summarized and {len(deleted_ids)} deleted issues into {DESTINATION_TABLE}")
+    if summaries:
+        spark.createDataFrame(pd.DataFrame(summaries)).createOrReplaceTempView("summary_updates")
+        spark.sql(f"""
+            MERGE INTO {DESTINATION_TABLE} AS t USING summary_updates AS s ON t.Id = s.Id
+            WHEN MATCHED THEN UPDATE SET *
+            WHEN NOT MATCHED THEN INSERT *
+        """)
+    if deleted_ids:
+        spark.createDataFrame(pd.DataFrame({"Id": deleted_ids})).createOrReplaceTempView("summary_deletes")
+        spark.sql(f"""
+            MERGE INTO {DESTINATION_TABLE} AS t USING summary_deletes AS s ON t.Id = s.Id
+            WHEN MATCHED THEN DELETE
+        """)
+
+
+def _backfill_titles(spark: SparkSession) -> None:
+    """Fills the Title of the issues summarized before the column was added, which are skipped as unchanged."""
+    spark.sql(f"""
+        MERGE INTO {DESTINATION_TABLE} AS t USING (SELECT Id, `Issue Title` AS Title FROM {SOURCE_TABLE}) AS s
+        ON t.Id = s.Id
+        WHEN MATCHED AND t.Title IS NULL THEN UPDATE SET t.Title = s.Title
+    """)
+
+
+def _summary_row(
+    raw_issue: Mapping,
+    content_hash: str,
+    distilled_issue: DistilledIssue,
+    censored_issue: CensorIssue,
+    distiller_version: str,
+    censor_version: str,
+) -> dict:
+    return {
+        **{k: raw_issue[k] for k in ("Id", "Market", "Site", "Turbine")},
+        # Lets the webapp list similar issues without fetching the full original markdown
+        "Title": raw_issue["Issue Title"],
+        "Original": _raw_issue_to_single_markdown(raw_issue),
+        "Summary": _censored_issue_to_summary(censored_issue),
+        "ContentHash": content_hash,
+        "Distilled": distilled_issue.model_dump_json(),
+        # The model that wrote the summary, as the distiller's may have been routed to another one
+        "Model": censored_issue._answered_by,
+        "DistillerVersion": distiller_version,
+        "CensorVersion": censor_version,
+    }
+
+
+def _write_usage(spark: SparkSession, usages: list[dict], run_id: str) -> None:
+    if not usages:
+        return
+    usage_pdf = pd.DataFrame(usages).rename(columns=USAGE_COLUMNS)
+    usage_pdf["Timestamp"] = pd.to_datetime(usage_pdf["Timestamp"], unit="s")
+    usage_pdf = usage_pdf.assign(Job="summarize", RunId=run_id)
+    spark.createDataFrame(usage_pdf).write.mode("append").saveAsTable(USAGE_TABLE)
 
 
 def _get_dbx_secret(workspace_client: WorkspaceClient, scope: str, key: str) -> str:
@@ -139,35 +725,123 @@ if __name__ == "__main__":
     w = WorkspaceClient()
     spark = DatabricksSession.builder.profile(w.config.profile).getOrCreate()
     spark.conf.set("spark.sql.ansi.enabled", "false")
+    # New columns (e.g. Title) are added to the summaries table by the MERGE
+    spark.conf.set("spark.databricks.delta.schema.autoMerge.enabled", "true")
 
     DATABRICKS_TOKEN = _get_dbx_secret(workspace_client=w, **DATABRICKS_TOKEN_SECRET)
-    client = OpenAI(api_key=DATABRICKS_TOKEN, base_url=f"{w.config.host}/serving-endpoints")
+    # Retries are handled by the executor, which also honours the rate limits
+    client = OpenAI(api_key=DATABRICKS_TOKEN, base_url=f"{w.config.host}/serving-endpoints", max_retries=0)
     instructor_client = instructor.from_openai(client, mode=instructor.Mode.MD_JSON)
 
-    logger.info(f"Reading raw issues from {SOURCE_TABLE}")
-    raw_df = spark.read.table(SOURCE_TABLE)
-
-    logger.info(f"Distilling and censoring {raw_df.count()} issues")
-    distiller = Distiller(main_prompt=prompt_spec["distiller"]["main_prompt"])
-
-    distilled_issues = []
-    raw_df_pandas = raw_df.pandas_api()
-    for _, row in tqdm(raw_df_pandas.iterrows(), total=raw_df_pandas.shape[0]):
-        distilled_issues.append(distiller.run_instructor(issue=row, instructor_client=instructor_client))
-
-    logger.info(f"Censoring {len(distilled_issues)} distilled issues")
-    censor = Censor(main_prompt=prompt_spec["censor"]["main_prompt"])
-
-    censored_issues = []
-    for issue in tqdm(distilled_issues):
-        censored_issues.append(censor.run_instructor(issue=issue, instructor_client=instructor_client))
-
-    logger.info(f"Writing {len(censored_issues)} summarized issues to {DESTINATION_TABLE}")
-    _original = [_raw_issue_to_single_markdown(i) for _, i in raw_df_pandas.iterrows()]
-    _summaries = [
-        "\n\n".join([f"### {k.title()}:\n{v}" for k, v in _issue.model_dump().items()]) for _issue in censored_issues
-    ]
-    summarized_df = spark.createDataFrame(
-        raw_df.select(["Id", "Market", "Site", "Turbine"]).toPandas().assign(Original=_original, Summary=_summaries)
+    previous_summaries = _read_previous_summaries(spark) if INCREMENTAL else {}
+    full_refresh = not previous_summaries
+    missing_titles = not full_refresh and "Title" not in spark.read.table(DESTINATION_TABLE).columns
+
+    completion_cache = SQLiteCompletionCache(COMPLETION_CACHE_PATH, bypass=COMPLETION_CACHE_BYPASS)
+    n_restored = completion_cache.sync(COMPLETION_CACHE_SNAPSHOT_PATH)
+    logger.info(f"Restored {n_restored} completions from {COMPLETION_CACHE_SNAPSHOT_PATH}")
+    rate_limiter = RateLimiter(requests_per_second=REQUESTS_PER_SECOND, tokens_per_second=TOKENS_PER_SECOND)
+    executor = LLMExecutor(max_in_flight=MAX_IN_FLIGHT, rate_limiter=rate_limiter)
+    usage, run_id = UsageRecorder(), time.strftime("%Y%m%dT%H%M%S")
+    router = ModelRouter(
+        INSTRUCT_MODEL,
+        small_model=SMALL_INSTRUCT_MODEL,
+        max_small_tokens=SMALL_MODEL_MAX_TOKENS,
+        small_max_attempts=SMALL_MODEL_MAX_ATTEMPTS,
+        usage=usage,
+        rate_limiter=rate_limiter,
+    )
+    stages = _stages(completion_cache, router)
+    distiller, censor, summarizer = stages
+    routed_models = [m for m in (router.large_model, router.small_model) if m is not None]
+    distiller_versions, censor_versions = ({_prompt_version(s, m) for m in routed_models} for s in _version_stages())
+
+    if QUALITY_SAMPLE_SIZE:
+        logger.info(f"Summarizing {QUALITY_SAMPLE_SIZE} sampled issues in both modes")
+        sample = spark.read.table(SOURCE_TABLE).orderBy(F.rand(seed=0)).limit(QUALITY_SAMPLE_SIZE).collect()
+        diffs = [
+            result
+            for _, result in executor.map_pipeline(
+                lambda issue: _compare_modes(issue, distiller, censor, summarizer, instructor_client, executor),
+                [_row.asDict() for _row in sample],
+            )
+            if not isinstance(result, Exception)
+        ]
+        quality_report = _quality_report(diffs)
+        logger.info(f"Fused vs two-pass summaries: {json.dumps(quality_report, indent=2)}")
+        Path(QUALITY_REPORT_PATH).write_text(json.dumps(quality_report, indent=2))
+
+    if ROUTING_QUALITY_SAMPLE_SIZE and SMALL_INSTRUCT_MODEL is not None:
+        logger.info(f"Summarizing {ROUTING_QUALITY_SAMPLE_SIZE} sampled issues with and without routing")
+        sample = spark.read.table(SOURCE_TABLE).orderBy(F.rand(seed=0)).limit(ROUTING_QUALITY_SAMPLE_SIZE).collect()
+        baseline_stages = _stages(completion_cache, ModelRouter(INSTRUCT_MODEL, usage=usage))
+        # Without the cache, which would answer with the baseline summaries
+        routed_stages = _stages(None, router)
+        diffs = [
+            result
+            for _, result in executor.map_pipeline(
+                lambda issue: _compare_routing(issue, baseline_stages, routed_stages, instructor_client, executor),
+                [_row.asDict() for _row in sample],
+            )
+            if not isinstance(result, Exception)
+        ]
+        routing_report = _quality_report(diffs, modes=("baseline", "routed"))
+        logger.info(f"Routed vs {INSTRUCT_MODEL} summaries: {json.dumps(routing_report, indent=2)}")
+        Path(ROUTING_QUALITY_REPORT_PATH).write_text(json.dumps(routing_report, indent=2))
+        _write_usage(spark, usage.drain(), run_id)
+
+    logger.info(
+        f"Streaming raw issues from {SOURCE_TABLE}, summarizing the new or changed ones by chunks of {CHUNK_SIZE} "
+        f"with up to {MAX_IN_FLIGHT} requests in flight"
+    )
+    seen_ids: set = set()
+    raw_issues = (_row.asDict() for _row in spark.read.table(SOURCE_TABLE).toLocalIterator())
+    work_items = _plan_work(raw_issues, previous_summaries, distiller_versions, censor_versions, seen_ids)
+    n_summarized, n_failed, overwrite = 0, 0, full_refresh
+    progress = tqdm(unit="issue")
+    for n_chunk, chunk in enumerate(_chunked(work_items, CHUNK_SIZE), start=1):
+        distilled = _read_distilled(spark, [raw_issue["Id"] for raw_issue, _, action in chunk if action == "censor"])
+        results = dict(
+            executor.map_pipeline(
+                lambda item: _summarize(
+                    item[0], stages, instructor_client, executor, distilled_issue=distilled.get(item[0]["Id"])
+                ),
+                chunk,
+            )
+        )
+        progress.update(len(chunk))
+
+        summaries, failed = [], 0
+        for idx, (raw_issue, content_hash, action) in enumerate(chunk):
+            if isinstance(result := results[idx], Exception):
+                logger.error(f"Failed to summarize issue {raw_issue['Id']}: {result!r}")
+                failed += 1
+                continue
+            versions = _written_versions(action, previous_summaries.get(raw_issue["Id"]), *result)
+            summaries.append(_summary_row(raw_issue, content_hash, *result, *versions))
+        # Failed issues are not written, so that the next run retries them
+        if summaries:
+            _write_summaries(spark, summaries, [], full_refresh=overwrite)
+            overwrite = False
+        _write_usage(spark, usage.drain(), run_id)
+        n_summarized, n_failed = n_summarized + len(summaries), n_failed + failed
+        too_many_failed = failed > MAX_FAILED_FRACTION * len(chunk)
+        if n_chunk % COMPLETION_CACHE_SYNC_CHUNKS == 0 or too_many_failed:
+            completion_cache.sync(COMPLETION_CACHE_SNAPSHOT_PATH)
+        if too_many_failed:
+            raise RuntimeError(f"{failed} out of {len(chunk)} issues of a chunk failed to summarize, stopping")
+    progress.close()
+    completion_cache.sync(COMPLETION_CACHE_SNAPSHOT_PATH)
+
+    # Deletions only once the whole source was read, so that a crash never deletes summaries
+    deleted_ids = list(previous_summaries.keys() - seen_ids)
+    if deleted_ids:
+        _write_summaries(spark, [], deleted_ids, full_refresh=False)
+    logger.info(
+        f"{n_summarized} issues summarized, {n_failed} failed, {len(seen_ids) - n_summarized - n_failed} unchanged, "
+        f"{len(deleted_ids)} deleted"
     )
-    summarized_df.write.mode("overwrite").option("overwriteSchema", "true").saveAsTable(DESTINATION_TABLE)
+    logger.info(f"Completion cache: {completion_cache.stats}, hit rate {completion_cache.stats.hit_rate:.1%}")
+    logger.info(f"LLM usage per model: {json.dumps(usage.summary(), indent=2)}")
+    if missing_titles:
+        _backfill_titles(spark)
@@ -1,11 +1,18 @@
 import contextlib
 import logging
 from base64 import b64decode
+from collections.abc import Iterator
+from itertools import islice
+from typing import Any
 
+import pandas as pd
 from databricks.connect import DatabricksSession
 from databricks.sdk import WorkspaceClient
 from databricks.vector_search.client import VectorSearchClient
 from databricks.vector_search.index import VectorSearchIndex
+from embeddings import Embedder, LocalEmbedder, embed_corpus
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql import functions as F
 
 SOURCE_TABLE = "workspace.default.summarized_tracked_issues"
 PRIMARY_KEY = "Id"
@@ -17,6 +24,19 @@ EMBEDDING_MODEL = "databricks-gte-large-en"
 INDEX_PIPELINE_TYPE = "TRIGGERED"
 FORCE_RECREATE = False
 
+# "endpoint": Databricks embeds the source column with `EMBEDDING_MODEL` (managed embeddings)
+# "local": this job embeds it on the CPU with `LOCAL_EMBEDDING_MODEL` (int8 ONNX) into `EMBEDDINGS_TABLE`, and the
+# index uses these self-managed embeddings. The webapp must then run with `EMBEDDING_PROVIDER=local` too.
+EMBEDDING_PROVIDER = "endpoint"
+LOCAL_EMBEDDING_MODEL = "Alibaba-NLP/gte-large-en-v1.5"
+EMBEDDINGS_TABLE = "workspace.default.embedded_tracked_issues"
+EMBEDDING_VECTOR_COLUMN = "Embedding"
+# Hash of the embedding model and of a row's columns: only the rows whose hash changed since the last run are embedded
+# again and merged into `EMBEDDINGS_TABLE`, so the index only re-syncs them
+EMBEDDING_HASH_COLUMN = "EmbeddingHash"
+# Issues embedded and written at a time, so that the source table is never collected whole on the driver
+EMBEDDING_CHUNK_ROWS = 50_000
+
 DATABRICKS_TOKEN_SECRET = dict(scope="eng-rec-scope", key="databricks-token")
 
 
@@ -26,6 +46,80 @@ def _get_dbx_secret(workspace_client: WorkspaceClient, scope: str, key: str) ->
     return b64decode(_encoded_secret).decode()
 
 
+def _read_chunks(rows_df: DataFrame, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    rows = rows_df.toLocalIterator(prefetchPartitions=True)
+    while chunk := list(islice(rows, chunk_rows)):
+        yield pd.DataFrame([row.asDict() for row in chunk])
+
+
+def _changed_rows(spark: SparkSession, model: str) -> DataFrame:
+    """The rows of the source table, with their embedding hash, that are not in `EMBEDDINGS_TABLE` with that hash."""
+    source_df = spark.read.table(SOURCE_TABLE)
+    row_json = F.to_json(F.struct(*[F.col(c) for c in source_df.columns]))
+    source_df = source_df.withColumn(EMBEDDING_HASH_COLUMN, F.sha2(F.concat_ws("\x1f", F.lit(model), row_json), 256))
+    if not spark.catalog.tableExists(EMBEDDINGS_TABLE):
+        return source_df
+    embedded_df = spark.read.table(EMBEDDINGS_TABLE)
+    if EMBEDDING_HASH_COLUMN not in embedded_df.columns:
+        logging.warning(f"{EMBEDDINGS_TABLE} predates incremental embedding, embedding all issues")
+        return source_df
+    return source_df.join(
+        embedded_df.select(PRIMARY_KEY, EMBEDDING_HASH_COLUMN), [PRIMARY_KEY, EMBEDDING_HASH_COLUMN], "left_anti"
+    )
+
+
+def _merge_embeddings(spark: SparkSession, chunk: pd.DataFrame) -> None:
+    updates_df = spark.createDataFrame(chunk).withColumn(
+        EMBEDDING_VECTOR_COLUMN, F.col(EMBEDDING_VECTOR_COLUMN).cast("array<float>")
+    )
+    if not spark.catalog.tableExists(EMBEDDINGS_TABLE):
+        updates_df.write.saveAsTable(EMBEDDINGS_TABLE)
+        return
+    updates_df.createOrReplaceTempView("embedding_updates")
+    spark.sql(f"""
+        MERGE INTO {EMBEDDINGS_TABLE} AS t USING embedding_updates AS s ON t.{PRIMARY_KEY} = s.{PRIMARY_KEY}
+        WHEN MATCHED THEN UPDATE SET *
+        WHEN NOT MATCHED THEN INSERT *
+    """)
+
+
+def _sync_embeddings_table(
+    spark: SparkSession, embed: Embedder, model: str, chunk_rows: int = EMBEDDING_CHUNK_ROWS
+) -> int:
+    """Embeds the new or changed issues of the source table into `EMBEDDINGS_TABLE` and deletes the removed ones,
+    returns the number of issues embedded.
+
+    The changed issues are read, embedded and merged by chunks of `chunk_rows` issues.
+    """
+    n_issues = 0
+    for chunk in _read_chunks(_changed_rows(spark, model), chunk_rows):
+        vectors = embed_corpus(embed, chunk[EMBEDDING_SOURCE_COLUMN].fillna("").tolist())
+        chunk[EMBEDDING_VECTOR_COLUMN] = vectors.tolist()
+        _merge_embeddings(spark, chunk)
+        n_issues += len(chunk)
+        logging.info(f"Embedded {n_issues} new or changed issues with {model}")
+    if spark.catalog.tableExists(EMBEDDINGS_TABLE):
+        spark.sql(f"""
+            MERGE INTO {EMBEDDINGS_TABLE} AS t USING (SELECT {PRIMARY_KEY} FROM {SOURCE_TABLE}) AS s
+            ON t.{PRIMARY_KEY} = s.{PRIMARY_KEY}
+            WHEN NOT MATCHED BY SOURCE THEN DELETE
+        """)
+    return n_issues
+
+
+def _embedding_dimension(spark: SparkSession) -> int:
+    row = spark.read.table(EMBEDDINGS_TABLE).select(F.size(EMBEDDING_VECTOR_COLUMN).alias("dimension")).first()
+    if row is None:
+        raise ValueError(f"No issues to embed in {SOURCE_TABLE}")
+    return int(row["dimension"])
+
+
+def _find_index(client: VectorSearchClient, index_name: str) -> VectorSearchIndex | None:
+    with contextlib.suppress(Exception):
+        return client.get_index(endpoint_name=ENDPOINT_NAME, index_name=index_name)
+    return None
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
 
@@ -37,27 +131,43 @@ if __name__ == "__main__":
     )
 
     spark = DatabricksSession.builder.profile(w.config.profile).getOrCreate()
-    spark.sql(f"ALTER TABLE {SOURCE_TABLE} SET TBLPROPERTIES (delta.enableChangeDataFeed = true)")
+    # New columns of the source table are added to the embeddings table by the MERGE
+    spark.conf.set("spark.databricks.delta.schema.autoMerge.enabled", "true")
+
+    index_source_table = SOURCE_TABLE
+    embedding_args: dict[str, Any] = dict(
+        embedding_source_column=EMBEDDING_SOURCE_COLUMN, embedding_model_endpoint_name=EMBEDDING_MODEL
+    )
+    if EMBEDDING_PROVIDER == "local":
+        _sync_embeddings_table(spark, LocalEmbedder(LOCAL_EMBEDDING_MODEL), model=f"{LOCAL_EMBEDDING_MODEL}@int8")
+        embedding_dimension = _embedding_dimension(spark)
+        index_source_table = EMBEDDINGS_TABLE
+        embedding_args = dict(embedding_dimension=embedding_dimension, embedding_vector_column=EMBEDDING_VECTOR_COLUMN)
+    spark.sql(f"ALTER TABLE {index_source_table} SET TBLPROPERTIES (delta.enableChangeDataFeed = true)")
 
     if ENDPOINT_NAME not in {i["name"] for i in client.list_endpoints().get("endpoints", {})}:
         client.create_endpoint(name=ENDPOINT_NAME, endpoint_type="STANDARD")
 
     index_name = ".".join([*SOURCE_TABLE.split(".")[:-1], INDEX_NAME])
 
-    if FORCE_RECREATE:
-        idx: VectorSearchIndex | None = None
-        with contextlib.suppress(Exception):
-            idx = client.get_index(endpoint_name=ENDPOINT_NAME, index_name=index_name)
-
-        if idx is not None:
-            client.delete_index(endpoint_name=ENDPOINT_NAME, index_name=index_name)
-
-    index = client.create_delta_sync_index(
-        endpoint_name=ENDPOINT_NAME,
-        index_name=index_name,
-        primary_key=PRIMARY_KEY,
-        source_table_name=SOURCE_TABLE,
-        pipeline_type=INDEX_PIPELINE_TYPE,
-        embedding_source_column=EMBEDDING_SOURCE_COLUMN,
-        embedding_model_endpoint_name=EMBEDDING_MODEL,
-    )
+    index = _find_index(client, index_name)
+    source_table = index.describe().get("delta_sync_index_spec", {}).get("source_table") if index else None
+    if index is not None and (FORCE_RECREATE or source_table != index_source_table):
+        logging.info(f"Recreating {index_name}, which syncs from {source_table}, from {index_source_table}")
+        client.delete_index(endpoint_name=ENDPOINT_NAME, index_name=index_name)
+        index = None
+
+    if index is None:
+        # The index is synced from the table when it is created
+        index = client.create_delta_sync_index(
+            endpoint_name=ENDPOINT_NAME,
+            index_name=index_name,
+            primary_key=PRIMARY_KEY,
+            source_table_name=index_source_table,
+            pipeline_type=INDEX_PIPELINE_TYPE,
+            **embedding_args,
+        )
+    elif INDEX_PIPELINE_TYPE == "TRIGGERED":
+        # Continuous indexes sync themselves
+        logging.info(f"Syncing {index_name} with {index_source_table}")
+        index.sync()
@@ -0,0 +1,87 @@
+import json
+import threading
+import time
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+FAKE_ISSUE = {"symptoms": "fake symptoms", "recommendation": "fake recommendation", "resolution": "fake resolution"}
+
+
+@dataclass
+class FakeOpenAIServer:
+    """Minimal OpenAI-compatible `/chat/completions` server answering in instructor's MD_JSON format."""
+
+    base_url: str = ""
+    latency: float = 0.0
+    fail_first: int = 0
+    fail_status: int = 429
+    # Models whose answers are not valid JSON, or not confident (echoing the whole prompt as the symptoms)
+    invalid_models: set[str] = field(default_factory=set)
+    verbose_models: set[str] = field(default_factory=set)
+    requests: list[dict] = field(default_factory=list)
+    max_concurrency: int = 0
+    _in_flight: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def handle(self, body: dict) -> tuple[int, dict]:
+        with self._lock:
+            self.requests.append(body)
+            n_request = len(self.requests)
+            self._in_flight += 1
+            self.max_concurrency = max(self.max_concurrency, self._in_flight)
+        try:
+            time.sleep(self.latency)
+            if n_request <= self.fail_first:
+                return self.fail_status, {"error": {"message": "fake failure", "type": "fake"}}
+            issue = FAKE_ISSUE
+            if body["model"] in self.verbose_models:
+                issue = {**issue, "symptoms": body["messages"][0]["content"] * 2}
+            content = f"```json\n{json.dumps(issue)}\n```"
+            if body["model"] in self.invalid_models:
+                content = "not json"
+            return 200, {
+                "id": f"chatcmpl-{n_request}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}
+                ],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20},
+            }
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+
+@pytest.fixture
+def fake_openai_server() -> Iterator[FakeOpenAIServer]:
+    fake = FakeOpenAIServer()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            status, payload = fake.handle(body)
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            if status == 429:
+                self.send_header("Retry-After", "0")
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format: str, *args: object) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    fake.base_url = f"http://127.0.0.1:{server.server_port}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield fake
+    server.shutdown()
+    server.server_close()
+    thread.join()
@@ -0,0 +1,103 @@
+from pathlib import Path
+
+import instructor
+import pytest
+from completion_cache import SQLiteCompletionCache, completion_cache_key
+from openai import OpenAI
+
+from notebooks.t01_summarize import DistilledIssue, Distiller
+
+ISSUE = {"Issue Title": "title", "Description": "description", "Closing Comment": "closing_comment"}
+MESSAGES = [{"role": "user", "content": "prompt"}]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = SQLiteCompletionCache(tmp_path / "cache.sqlite")
+    yield cache
+    cache.close()
+
+
+def test_completion_cache_key_depends_on_model_prompt_and_schema():
+    key = completion_cache_key("model", MESSAGES, {"title": "schema"})
+    assert key == completion_cache_key("model", [dict(i) for i in MESSAGES], {"title": "schema"})
+    assert key != completion_cache_key("other_model", MESSAGES, {"title": "schema"})
+    assert key != completion_cache_key("model", [{"role": "user", "content": "other"}], {"title": "schema"})
+    assert key != completion_cache_key("model", MESSAGES, None)
+    # The webapp's keys, at temperature 0 too, follow the same scheme
+    assert completion_cache_key("model", MESSAGES) == completion_cache_key("model", MESSAGES, temperature=0.0)
+    assert completion_cache_key("model", MESSAGES) != completion_cache_key("model", MESSAGES, temperature=0.7)
+
+
+def test_cache_hits_and_misses(cache):
+    assert cache.get("key") is None
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+    assert (cache.stats.hits, cache.stats.misses, cache.stats.writes) == (1, 1, 1)
+
+
+def test_cache_ttl(cache):
+    cache.set("key", "value")
+    cache.ttl_seconds = -1
+    assert cache.get("key") is None
+    assert cache.evict() == 1
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = SQLiteCompletionCache(tmp_path / "cache.sqlite", max_entries=2, evict_every=1)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    cache.get("a")
+    cache.set("c", "3")
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == ("1", None, "3")
+    cache.close()
+
+
+def test_cache_bypass(cache):
+    cache.set("key", "value")
+    cache.bypass = True
+    assert cache.get("key") is None
+
+
+def test_sync_merges_the_snapshot_both_ways(tmp_path):
+    job = SQLiteCompletionCache(tmp_path / "job" / "cache.sqlite")
+    app = SQLiteCompletionCache(tmp_path / "app" / "cache.sqlite")
+    snapshot = tmp_path / "volume" / "cache.sqlite"
+    job.set("summary", "from the job")
+    assert job.sync(snapshot) == 0
+    app.set("recommendation", "from the app")
+    assert app.sync(snapshot) == 1
+    assert app.get("summary") == "from the job"
+    assert job.sync(snapshot) == 1
+    assert job.get("recommendation") == "from the app"
+    assert not any(p.name.endswith(".snapshot") for p in (tmp_path / "job").iterdir())
+    job.close()
+    app.close()
+
+
+def test_sync_is_skipped_when_bypassed(tmp_path):
+    cache = SQLiteCompletionCache(tmp_path / "cache.sqlite", bypass=True)
+    assert cache.sync(tmp_path / "snapshot.sqlite") == 0
+    assert not (tmp_path / "snapshot.sqlite").exists()
+    cache.close()
+
+
+def test_webapp_copy_is_identical():
+    # The webapp and the job share the cache, so they must agree on its keys and schema
+    notebooks = Path(__file__).parents[1] / "notebooks"
+    webapp = Path(__file__).parents[2] / "webapp" / "src"
+    assert (notebooks / "completion_cache.py").read_text() == (webapp / "completion_cache.py").read_text()
+
+
+def test_distiller_reuses_cached_completions(fake_openai_server, cache):
+    client = OpenAI(api_key="fake", base_url=fake_openai_server.base_url, max_retries=0)
+    instructor_client = instructor.from_openai(client, mode=instructor.Mode.MD_JSON)
+    distiller = Distiller(main_prompt="distill", cache=cache)
+
+    assert distiller.from_cache(ISSUE) is None
+    distilled_issue = distiller.run_instructor(ISSUE, instructor_client)
+    assert isinstance(distilled_issue, DistilledIssue)
+    assert distiller.from_cache(ISSUE).model_dump() == distilled_issue.model_dump()
+    assert Distiller(main_prompt="other prompt", cache=cache).from_cache(ISSUE) is None
+    assert len(fake_openai_server.requests) == 1
+    client.close()
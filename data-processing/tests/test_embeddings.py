@@ -0,0 +1,86 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pytest
+from embeddings import MicroBatchingEmbedder, SQLiteEmbeddingStore, embed_corpus, embedding_key, stored_embedder
+
+
+class FakeEmbedder:
+    """Deterministic embedding of each text's length, recording the batches it is called with."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: list[list[str]] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, texts):
+        with self._lock:
+            self.calls.append(list(texts))
+        time.sleep(self.latency)
+        return np.array([[len(t), 1.0] for t in texts], dtype=np.float32)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SQLiteEmbeddingStore(tmp_path / "embeddings.sqlite")
+    yield store
+    store.close()
+
+
+def test_embedding_key_depends_on_model_and_text():
+    assert embedding_key("model", "text") == embedding_key("model", "text")
+    assert embedding_key("model", "text") != embedding_key("other_model", "text")
+    assert embedding_key("model", "text") != embedding_key("model", "other text")
+
+
+def test_store_round_trip(store):
+    store.put_many({"a": np.array([1.0, 2.0]), "b": np.array([3.0, 4.0])})
+    found = store.get_many(["a", "b", "c"])
+    assert set(found) == {"a", "b"}
+    np.testing.assert_array_equal(found["b"], np.array([3.0, 4.0], dtype=np.float32))
+
+
+def test_stored_embedder_only_embeds_new_texts(store):
+    fake = FakeEmbedder()
+    embed = stored_embedder(fake, store, model="model")
+    np.testing.assert_array_equal(embed(["a", "bb", "a"])[:, 0], [1, 2, 1])
+    np.testing.assert_array_equal(embed(["ccc", "bb"])[:, 0], [3, 2])
+    assert fake.calls == [["a", "bb"], ["ccc"]]
+    # Another model's embeddings are not reused
+    stored_embedder(fake, store, model="other_model")(["a"])
+    assert fake.calls[-1] == ["a"]
+
+
+def test_micro_batching_coalesces_concurrent_calls():
+    fake = FakeEmbedder(latency=0.02)
+    embed = MicroBatchingEmbedder(fake, max_batch_size=64, max_wait_seconds=0.01)
+    texts = [f"query {'x' * (i % 10)}" for i in range(40)]
+    with ThreadPoolExecutor(max_workers=40) as executor:
+        results = list(executor.map(lambda t: embed([t]), texts))
+    assert [r[0, 0] for r in results] == [len(t) for t in texts]
+    assert len(fake.calls) < len(texts)
+    # Identical texts of a batch are embedded once
+    assert all(len(c) == len(set(c)) for c in fake.calls)
+
+
+def test_micro_batching_propagates_failures():
+    def failing(texts):
+        raise RuntimeError("endpoint down")
+
+    with pytest.raises(RuntimeError, match="endpoint down"):
+        MicroBatchingEmbedder(failing)(["query"])
+
+
+def test_embed_corpus_keeps_order():
+    texts = ["x" * i for i in range(1, 11)]
+    np.testing.assert_array_equal(embed_corpus(FakeEmbedder(), texts, batch_size=3)[:, 0], range(1, 11))
+
+
+def test_webapp_copy_is_identical():
+    # The index build and the search queries must embed texts the same way
+    notebooks = Path(__file__).parents[1] / "notebooks"
+    webapp = Path(__file__).parents[2] / "webapp" / "src"
+    assert (notebooks / "embeddings.py").read_text() == (webapp / "embeddings.py").read_text()
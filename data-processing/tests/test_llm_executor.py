@@ -0,0 +1,67 @@
+import time
+
+import instructor
+import pytest
+from llm_executor import LLMExecutor, RateLimiter, RetryPolicy
+from openai import OpenAI
+
+from notebooks.t01_summarize import Censor, CensorIssue, Distiller, _summarize_issue
+
+ISSUE = {"Issue Title": "title", "Description": "description", "Closing Comment": "closing_comment"}
+
+
+@pytest.fixture
+def instructor_client(fake_openai_server):
+    client = OpenAI(api_key="fake", base_url=fake_openai_server.base_url, max_retries=0)
+    yield instructor.from_openai(client, mode=instructor.Mode.MD_JSON)
+    client.close()
+
+
+def _summarize_all(instructor_client, executor, n_issues):
+    distiller, censor = Distiller(main_prompt="distill"), Censor(main_prompt="censor")
+    return dict(
+        executor.map_pipeline(
+            lambda issue: _summarize_issue(issue, distiller, censor, instructor_client, executor), [ISSUE] * n_issues
+        )
+    )
+
+
+def test_map_pipeline_runs_distill_and_censor_concurrently(fake_openai_server, instructor_client):
+    fake_openai_server.latency = 0.05
+    executor = LLMExecutor(max_in_flight=4)
+
+    results = _summarize_all(instructor_client, executor, n_issues=8)
+
+    assert sorted(results) == list(range(8))
+    assert all(isinstance(i[1], CensorIssue) for i in results.values())
+    assert len(fake_openai_server.requests) == 16
+    assert 1 < fake_openai_server.max_concurrency <= 4
+
+
+def test_map_pipeline_retries_throttled_requests(fake_openai_server, instructor_client):
+    fake_openai_server.fail_first = 3
+    executor = LLMExecutor(max_in_flight=2, retry_policy=RetryPolicy(base_delay=0.01))
+
+    results = _summarize_all(instructor_client, executor, n_issues=2)
+
+    assert all(isinstance(i[1], CensorIssue) for i in results.values())
+    assert len(fake_openai_server.requests) == 4 + 3
+
+
+def test_map_pipeline_yields_non_retryable_errors(fake_openai_server, instructor_client):
+    fake_openai_server.fail_first, fake_openai_server.fail_status = 1, 400
+    executor = LLMExecutor(max_in_flight=1, retry_policy=RetryPolicy(base_delay=0.01))
+
+    results = _summarize_all(instructor_client, executor, n_issues=2)
+
+    assert isinstance(results[0], Exception)
+    assert isinstance(results[1][1], CensorIssue)
+
+
+def test_rate_limiter_paces_requests():
+    limiter = RateLimiter(requests_per_second=50)
+    start = time.monotonic()
+    for _ in range(60):
+        limiter.acquire()
+    # The first second's worth of requests is allowed as a burst
+    assert time.monotonic() - start >= 10 / 50 * 0.9
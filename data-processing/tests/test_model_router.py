@@ -0,0 +1,123 @@
+import instructor
+import pytest
+from completion_cache import SQLiteCompletionCache
+from model_router import ModelRouter, UsageRecorder
+from openai import OpenAI
+
+from notebooks.t01_summarize import (
+    Censor,
+    CensorIssue,
+    DistilledIssue,
+    Distiller,
+    _identifier_replacements,
+    _is_confident,
+)
+
+ISSUE = {"Issue Title": "title", "Description": "description", "Closing Comment": "closing_comment"}
+SMALL, LARGE = "small-model", "large-model"
+
+
+@pytest.fixture
+def instructor_client(fake_openai_server):
+    client = OpenAI(api_key="fake", base_url=fake_openai_server.base_url, max_retries=0)
+    yield instructor.from_openai(client, mode=instructor.Mode.MD_JSON)
+    client.close()
+
+
+@pytest.fixture
+def usage():
+    return UsageRecorder()
+
+
+def _requested_models(fake_openai_server):
+    return [request["model"] for request in fake_openai_server.requests]
+
+
+def test_short_prompts_go_to_the_small_model(fake_openai_server, instructor_client, usage):
+    distiller = Distiller(main_prompt="distill", router=ModelRouter(LARGE, small_model=SMALL, usage=usage))
+
+    distilled_issue = distiller.run_instructor(ISSUE, instructor_client)
+
+    assert distilled_issue._answered_by == SMALL
+    assert _requested_models(fake_openai_server) == [SMALL]
+    [recorded] = usage.drain()
+    assert (recorded["model"], recorded["stage"], recorded["outcome"]) == (SMALL, "distiller", "ok")
+    assert (recorded["prompt_tokens"], recorded["completion_tokens"], recorded["attempts"]) == (10, 10, 1)
+
+
+def test_long_prompts_go_to_the_large_model(fake_openai_server, instructor_client):
+    router = ModelRouter(LARGE, small_model=SMALL, max_small_tokens=1)
+
+    Distiller(main_prompt="distill", router=router).run_instructor(ISSUE, instructor_client)
+
+    assert _requested_models(fake_openai_server) == [LARGE]
+
+
+def test_invalid_answers_escalate_once_the_small_model_attempts_are_used_up(
+    fake_openai_server, instructor_client, usage
+):
+    fake_openai_server.invalid_models = {SMALL}
+    router = ModelRouter(LARGE, small_model=SMALL, small_max_attempts=2, usage=usage)
+
+    distilled_issue = Distiller(main_prompt="distill", router=router).run_instructor(ISSUE, instructor_client)
+
+    assert distilled_issue._answered_by == LARGE
+    assert _requested_models(fake_openai_server) == [SMALL, SMALL, LARGE]
+    recorded = usage.drain()
+    assert [(u["model"], u["outcome"], u["attempts"]) for u in recorded] == [(SMALL, "invalid", 2), (LARGE, "ok", 1)]
+    # The re-ask's tokens count too
+    assert recorded[0]["prompt_tokens"] == 20
+    assert usage.summary()[SMALL]["rejected"] == 1
+
+
+def test_low_confidence_answers_escalate(fake_openai_server, instructor_client, usage):
+    fake_openai_server.verbose_models = {SMALL}
+    router = ModelRouter(LARGE, small_model=SMALL, usage=usage)
+
+    distilled_issue = Distiller(main_prompt="distill", router=router).run_instructor(ISSUE, instructor_client)
+
+    assert distilled_issue._answered_by == LARGE
+    assert [(u["model"], u["outcome"]) for u in usage.drain()] == [(SMALL, "low_confidence"), (LARGE, "ok")]
+
+
+def test_escalated_answers_are_cached_under_the_large_model(fake_openai_server, instructor_client, tmp_path):
+    fake_openai_server.invalid_models = {SMALL}
+    cache = SQLiteCompletionCache(tmp_path / "cache.sqlite")
+    distiller = Distiller(main_prompt="distill", cache=cache, router=ModelRouter(LARGE, small_model=SMALL))
+
+    distiller.run_instructor(ISSUE, instructor_client)
+    cached = distiller.from_cache(ISSUE)
+
+    assert cached is not None
+    assert cached._answered_by == LARGE
+    cache.close()
+
+
+def test__is_confident():
+    source = "The T4 gearbox of the Nordex turbine overheated, the oil filter was replaced."
+    issue = DistilledIssue(symptoms="The gearbox overheated.", recommendation="", resolution="Replaced the filter.")
+    assert _is_confident(issue, source)
+    assert not _is_confident(issue.model_copy(update={"symptoms": " "}), source)
+    assert not _is_confident(issue.model_copy(update={"symptoms": source * 2}), source)
+    leaky = issue.model_copy(update={"symptoms": "The T4 gearbox overheated."})
+    assert _is_confident(leaky, source)
+    assert not _is_confident(leaky, source, _identifier_replacements({}))
+
+
+def test_censor_checks_the_identifiers_of_its_issue(instructor_client):
+    class CapturingRouter:
+        def create(self, instructor_client, response_model, messages, stage, confident=None):
+            self.confident = confident
+            return response_model(symptoms="The gearbox overheated.", recommendation="", resolution=""), LARGE
+
+    router = CapturingRouter()
+    distilled_issue = DistilledIssue(
+        symptoms="The gearbox of the Blyth turbine overheated at 45 degrees.", recommendation="", resolution=""
+    )
+    Censor(main_prompt="censor", router=router).run_instructor(distilled_issue, instructor_client, {"Site": "Blyth"})
+
+    answer = CensorIssue(
+        symptoms="The gearbox of the SITE turbine overheated at 45 degrees.", recommendation="", resolution=""
+    )
+    assert router.confident(answer)
+    assert not router.confident(answer.model_copy(update={"symptoms": "The Blyth gearbox overheated."}))
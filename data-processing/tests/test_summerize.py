@@ -1,6 +1,20 @@
 import textwrap
 
-from notebooks.t01_summarize import DistilledIssue, _distilled_issue_to_single_markdown, _raw_issue_to_single_markdown
+from notebooks.t01_summarize import (
+    CensorIssue,
+    DistilledIssue,
+    _chunked,
+    _content_hash,
+    _distilled_issue_to_single_markdown,
+    _plan_action,
+    _plan_work,
+    _pre_censor_issue,
+    _prompt_version,
+    _quality_diff,
+    _quality_report,
+    _raw_issue_to_single_markdown,
+    _written_versions,
+)
 
 
 def test__raw_issue_to_single_markdown():
@@ -26,3 +40,89 @@ def test__distilled_issue_to_single_markdown():
         sample_resolution
         """)
     assert _distilled_issue_to_single_markdown(distilled_issue) == expected
+
+
+def test__content_hash_ignores_metadata_but_not_content():
+    issue = {"Id": 1, "Issue Title": "title", "Description": "description", "Closing Comment": None}
+    assert _content_hash(issue) == _content_hash({**issue, "Id": 2, "Site": "site"})
+    assert _content_hash(issue) != _content_hash({**issue, "Closing Comment": "closing_comment"})
+
+
+def test__plan_action():
+    previous = {"ContentHash": "hash", "Distilled": "{}", "DistillerVersion": "d1", "CensorVersion": "c1"}
+    assert _plan_action("hash", None, {"d1"}, {"c1"}) == "summarize"
+    assert _plan_action("new_hash", previous, {"d1"}, {"c1"}) == "summarize"
+    assert _plan_action("hash", previous, {"d2"}, {"c1"}) == "summarize"
+    assert _plan_action("hash", previous, {"d1"}, {"c2"}) == "censor"
+    assert _plan_action("hash", previous, {"d1"}, {"c1"}) == "skip"
+    # Written by either of the models the stages are routed to
+    assert _plan_action("hash", previous, {"d0", "d1"}, {"c0", "c1"}) == "skip"
+
+
+def test__written_versions_are_those_of_the_models_that_answered():
+    fields = {"symptoms": "s", "recommendation": "r", "resolution": "r"}
+    distilled_issue, censored_issue = DistilledIssue(**fields), CensorIssue(**fields)
+    distilled_issue._answered_by, censored_issue._answered_by = "small", "large"
+    distiller_version, censor_version = _written_versions("summarize", None, distilled_issue, censored_issue)
+    assert distiller_version == _prompt_version("distiller", "small") != _prompt_version("distiller", "large")
+    assert censor_version == _prompt_version("censor", "large")
+    # Only the censor ran again, on the stored distilled issue
+    previous = {"DistillerVersion": "d1"}
+    assert _written_versions("censor", previous, distilled_issue, censored_issue) == ("d1", censor_version)
+
+
+def test__plan_work_skips_unchanged_issues_and_records_every_id():
+    issues = [{"Id": i, "Issue Title": f"title {i}", "Description": "d", "Closing Comment": "c"} for i in range(3)]
+    previous = {
+        0: {
+            "ContentHash": _content_hash(issues[0]),
+            "Distilled": True,
+            "DistillerVersion": "d1",
+            "CensorVersion": "c1",
+        },
+        1: {
+            "ContentHash": _content_hash(issues[1]),
+            "Distilled": True,
+            "DistillerVersion": "d1",
+            "CensorVersion": "c0",
+        },
+    }
+    seen_ids: set = set()
+    work = list(_plan_work(issues, previous, {"d1"}, {"c1"}, seen_ids))
+    assert [(issue["Id"], action) for issue, _, action in work] == [(1, "censor"), (2, "summarize")]
+    assert work[1][1] == _content_hash(issues[2])
+    assert seen_ids == {0, 1, 2}
+
+
+def test__chunked():
+    assert list(_chunked(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(_chunked([], 2)) == []
+
+
+def test__pre_censor_issue():
+    issue = {
+        "Site": "Whitelee",
+        "Turbine": "WTG-07",
+        "Issue Title": "T4 and WTG-07 yaw misalignment at Whitelee",
+        "Description": "The Siemens Gamesa 2.3 MW turbines (101 m rotor) stop at 12 m/s.",
+        "Closing Comment": None,
+    }
+    censored = _pre_censor_issue(issue)
+    assert censored["Issue Title"] == "TURBINE and TURBINE yaw misalignment at SITE"
+    assert censored["Description"] == "The OEM RATING turbines (RATING rotor) stop at 12 m/s."
+    assert censored["Closing Comment"] is None
+
+
+def test__quality_report():
+    issue = {"Site": "Whitelee", "Turbine": None}
+    two_pass = CensorIssue(symptoms="Gearbox overheated at Whitelee", recommendation="Replace oil", resolution="")
+    fused = CensorIssue(symptoms="Gearbox overheated at SITE", recommendation="Replace oil", resolution="")
+    diff = _quality_diff(issue, two_pass, fused)
+    assert diff["recommendation_similarity"] == 1.0
+    assert diff["symptoms_similarity"] == 0.75
+    assert (diff["two_pass_identifiers"], diff["fused_identifiers"]) == (1, 0)
+
+    report = _quality_report([diff, {**diff, "two_pass_identifiers": 0, "symptoms_similarity": 0.25}])
+    assert report["n_issues"] == 2
+    assert report["symptoms_similarity"] == 0.5
+    assert (report["two_pass_leaky_fraction"], report["fused_leaky_fraction"]) == (0.5, 0.0)
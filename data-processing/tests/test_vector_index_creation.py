@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pytest
+import t02_vector_index_creation as t02
+
+
+class FakeRow(dict):
+    def asDict(self):
+        return dict(self)
+
+
+class FakeFrame:
+    def __init__(self, spark, rows):
+        self.spark = spark
+        self.rows = rows
+
+    def toLocalIterator(self, prefetchPartitions=False):
+        return iter(self.rows)
+
+    def withColumn(self, name, column):
+        return self
+
+    @property
+    def write(self):
+        return self
+
+    def saveAsTable(self, name):
+        self.spark.tables[name] = list(self.rows)
+
+    def createOrReplaceTempView(self, name):
+        self.spark.views[name] = self.rows
+
+
+class FakeSpark:
+    """Tables as lists of rows, applying the MERGEs of embedding updates by primary key."""
+
+    def __init__(self):
+        self.tables = {}
+        self.views = {}
+        self.queries = []
+        self.catalog = self
+
+    def tableExists(self, name):
+        return name in self.tables
+
+    def createDataFrame(self, chunk: pd.DataFrame):
+        return FakeFrame(self, chunk.to_dict("records"))
+
+    def sql(self, query):
+        self.queries.append(" ".join(query.split()))
+        if "USING embedding_updates" in query:
+            rows = {row[t02.PRIMARY_KEY]: row for row in self.tables[t02.EMBEDDINGS_TABLE]}
+            rows |= {row[t02.PRIMARY_KEY]: row for row in self.views["embedding_updates"]}
+            self.tables[t02.EMBEDDINGS_TABLE] = list(rows.values())
+
+
+@pytest.fixture
+def embedded():
+    return []
+
+
+@pytest.fixture
+def embed(embedded):
+    def _embed(texts):
+        embedded.extend(texts)
+        return np.array([[len(t), 1.0] for t in texts], dtype=np.float32)
+
+    return _embed
+
+
+def changed(monkeypatch, spark, rows):
+    monkeypatch.setattr(t02, "_changed_rows", lambda spark_, model: FakeFrame(spark, [FakeRow(r) for r in rows]))
+
+
+def test_embeddings_table_is_created_by_chunks(monkeypatch, embed):
+    spark = FakeSpark()
+    changed(monkeypatch, spark, [{"Id": i, "Summary": "x" * i, "EmbeddingHash": f"h{i}"} for i in range(5)])
+
+    assert t02._sync_embeddings_table(spark, embed, model="model", chunk_rows=2) == 5
+
+    rows = spark.tables[t02.EMBEDDINGS_TABLE]
+    assert [row[t02.EMBEDDING_VECTOR_COLUMN][0] for row in rows] == [0, 1, 2, 3, 4]
+    # The first chunk creates the table, the next ones are merged into it
+    assert sum("USING embedding_updates" in q for q in spark.queries) == 2
+
+
+def test_only_changed_issues_are_embedded_and_merged(monkeypatch, embed, embedded):
+    spark = FakeSpark()
+    spark.tables[t02.EMBEDDINGS_TABLE] = [
+        {"Id": i, "Summary": "x" * i, "EmbeddingHash": f"h{i}", t02.EMBEDDING_VECTOR_COLUMN: [i, 1.0]} for i in range(3)
+    ]
+    changed(monkeypatch, spark, [{"Id": 1, "Summary": "changed", "EmbeddingHash": "h1'"}])
+
+    assert t02._sync_embeddings_table(spark, embed, model="model") == 1
+
+    assert embedded == ["changed"]
+    rows = {row["Id"]: row for row in spark.tables[t02.EMBEDDINGS_TABLE]}
+    assert rows[1]["Summary"] == "changed" and rows[1][t02.EMBEDDING_VECTOR_COLUMN] == [7, 1.0]
+    assert rows[0][t02.EMBEDDING_VECTOR_COLUMN] == [0, 1.0]
+    # The issues removed from the source table are deleted
+    assert "WHEN NOT MATCHED BY SOURCE THEN DELETE" in spark.queries[-1]
+
+
+def test_nothing_to_embed(monkeypatch, embed, embedded):
+    spark = FakeSpark()
+    changed(monkeypatch, spark, [])
+    assert t02._sync_embeddings_table(spark, embed, model="model") == 0
+    assert embedded == [] and spark.queries == []
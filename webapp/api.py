@@ -0,0 +1,179 @@
+"""Headless HTTP API of the Engineering Recommendation Helper, e.g. for the alerting system or load tests.
+
+Run with `uvicorn api:app` or `APP_MODE=api python run.py`. It shares the clients, caches and telemetry of the
+Streamlit app (`src/resources.py`, `src/vector_search.py`).
+"""
+
+import asyncio
+import logging
+import os
+from collections.abc import AsyncIterator, Callable, Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Any, TypeVar
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+
+from src.batching import SearchBatcher
+from src.rec_suggestion import LLMUnavailableError, get_suggested_recommendation, stream_suggested_recommendation
+from src.resources import OPEN_AI_MAX_CONNECTIONS, get_completion_cache, get_open_ai_client
+from src.telemetry import registry, span, start_exporters
+from src.vector_search import N_SIMILAR_ISSUES, Filters, SimilarIssue, fetch_originals, get_vector_searcher
+from src.warmup import start_warmup, startup_report
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+MAX_NUM_RESULTS = 50
+# The API's own pools, rather than the orchestrator's shared with the Streamlit sessions. Searches are short round
+# trips, while a generation holds its thread for the whole completion, so they do not queue behind each other
+API_SEARCH_WORKERS = int(os.getenv("API_SEARCH_WORKERS", 32))
+API_GENERATION_WORKERS = int(os.getenv("API_GENERATION_WORKERS", OPEN_AI_MAX_CONNECTIONS))
+
+_search_executor = ThreadPoolExecutor(max_workers=API_SEARCH_WORKERS, thread_name_prefix="api-search")
+_generation_executor = ThreadPoolExecutor(max_workers=API_GENERATION_WORKERS, thread_name_prefix="api-generation")
+
+
+class SearchRequest(BaseModel):
+    query: str = Field(min_length=1)
+    num_results: int = Field(N_SIMILAR_ISSUES, ge=1, le=MAX_NUM_RESULTS)
+    # e.g. {"Market": "US", "Turbine": ["T28", "T29"]}, pushed down to the index
+    filters: Filters | None = None
+
+
+class SearchResponse(BaseModel):
+    similar_issues: list[SimilarIssue]
+
+
+class RecommendationRequest(BaseModel):
+    description: str = Field(min_length=1)
+    num_results: int = Field(N_SIMILAR_ISSUES, ge=1, le=MAX_NUM_RESULTS)
+    filters: Filters | None = None
+    # Skips the search, e.g. when the caller already searched or edited the similar issues
+    similar_issues: list[SimilarIssue] | None = None
+    stream: bool = False
+
+
+class RecommendationResponse(BaseModel):
+    # None when the serving endpoint failed or missed its deadline: the similar issues only
+    recommendation: str | None
+    similar_issues: list[SimilarIssue]
+
+
+_batcher: SearchBatcher | None = None
+_batcher_lock = asyncio.Lock()
+
+
+async def _run_blocking(func: Callable[[], T], executor: ThreadPoolExecutor = _search_executor) -> T:
+    return await asyncio.get_running_loop().run_in_executor(executor, func)
+
+
+async def _get_batcher() -> SearchBatcher:
+    global _batcher
+    if _batcher is not None:
+        return _batcher
+    # Creating the searcher awaits, so concurrent first requests would each create one without the lock
+    async with _batcher_lock:
+        if _batcher is None:
+            # Creating the searcher calls Databricks, so it is kept off the event loop
+            searcher = await _run_blocking(get_vector_searcher)
+            _batcher = SearchBatcher(searcher, executor=_search_executor)
+        return _batcher
+
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI) -> AsyncIterator[None]:
+    start_exporters()
+    start_warmup()
+    try:
+        await _get_batcher()
+        await _run_blocking(get_open_ai_client)
+    except Exception:
+        logger.exception("Could not create the clients at startup, /healthz reports unhealthy until they can be")
+    yield
+
+
+app = FastAPI(title="Engineering Recommendation Helper", lifespan=_lifespan)
+
+
+@app.get("/healthz")
+async def healthz() -> dict[str, str]:
+    try:
+        await _get_batcher()
+        await _run_blocking(get_open_ai_client)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"{type(e).__name__}: {e}") from e
+    return {"status": "ok"}
+
+
+@app.get("/startup")
+async def startup() -> dict[str, Any]:
+    """How long the warm-up stages took (imports, secrets, clients, first query), and which ones failed."""
+    return startup_report.to_dict()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> str:
+    return registry.to_prometheus()
+
+
+@app.post("/search")
+async def search(request: SearchRequest) -> SearchResponse:
+    with span("api.search"):
+        batcher = await _get_batcher()
+        similar_issues = await batcher.search(request.query, request.num_results, request.filters)
+        # The responses are the only place the results are needed as (serializable) models
+        return SearchResponse(similar_issues=list(similar_issues))
+
+
+@app.get("/issues/{issue_id}/original", response_class=PlainTextResponse)
+async def original(issue_id: float) -> str:
+    searcher = (await _get_batcher()).searcher
+    originals = await _run_blocking(partial(fetch_originals, searcher, [issue_id]))
+    if issue_id not in originals:
+        raise HTTPException(status_code=404, detail=f"Issue {issue_id} not found")
+    return originals[issue_id]
+
+
+@app.post("/recommendation", response_model=None)
+async def recommendation(request: RecommendationRequest) -> RecommendationResponse | StreamingResponse:
+    with span("api.recommendation"):
+        similar_issues: Sequence[SimilarIssue] | None = request.similar_issues
+        if similar_issues is None:
+            batcher = await _get_batcher()
+            similar_issues = await batcher.search(request.description, request.num_results, request.filters)
+
+        if request.stream:
+            # Iterated on a worker thread by Starlette, and closed (cancelling the generation) if the client leaves
+            tokens = stream_suggested_recommendation(
+                get_open_ai_client(), request.description, similar_issues, cache=get_completion_cache()
+            )
+            return StreamingResponse(_until_unavailable(tokens), media_type="text/plain")
+
+        try:
+            recommendation = await _run_blocking(
+                partial(
+                    get_suggested_recommendation,
+                    get_open_ai_client(),
+                    request.description,
+                    similar_issues,
+                    cache=get_completion_cache(),
+                ),
+                executor=_generation_executor,
+            )
+        except LLMUnavailableError as e:
+            logger.warning(f"Returning the similar issues only: {e}")
+            recommendation = None
+        return RecommendationResponse(recommendation=recommendation, similar_issues=list(similar_issues))
+
+
+def _until_unavailable(tokens: Iterator[str]) -> Iterator[str]:
+    """Ends the stream early, rather than failing the response, when the serving endpoint stops answering."""
+    try:
+        yield from tokens
+    except LLMUnavailableError as e:
+        logger.warning(f"Recommendation stream ended early: {e}")
@@ -0,0 +1,334 @@
+"""Local stand-ins for the Databricks services the app calls, so that it can be load-tested without a workspace.
+
+- Vector Search: `get_index`, `describe` and `similarity_search` (with filters) over synthetic issues
+- Serving endpoints (OpenAI API): chat completions, streamed or not, and embeddings
+
+Latencies are drawn from configurable distributions (`fixed:<s>`, `uniform:<min s>:<max s>` or
+`lognormal:<median s>:<sigma>`), and a fraction of the requests fail with a 503 or a 429. `GET /fake/stats` reports the
+requests served and the largest number of concurrent requests per API, which shows how much concurrency the app's
+threads and connection pools let through (`POST /fake/stats/reset` resets them). The `--small-model` serving endpoint
+answers `--small-model-speedup` times faster, to load-test the routing of the recommendations.
+
+Usage (from the webapp directory), with the app pointed at the stand-ins by `FAKE_SERVICES_URL`:
+    python -m benchmarks.fakes --port 8100 --search-latency lognormal:0.08:0.5 --error-rate 0.01
+    FAKE_SERVICES_URL=http://localhost:8100 APP_MODE=api python run.py
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import defaultdict
+from collections.abc import AsyncIterator, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any
+
+import numpy as np
+import pandas as pd
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from benchmarks.synthetic import FakeEmbedder, synthetic_embeddings, synthetic_issues
+
+logger = logging.getLogger(__name__)
+
+COMPLETION_TEXT = (
+    "Inspect the component and check the alarm history. Replace the worn parts if the readings stay out of range, "
+    "then monitor the turbine for a week and compare with the neighbouring turbines."
+)
+
+
+@dataclass(frozen=True)
+class Latency:
+    kind: str = "fixed"
+    a: float = 0.0
+    b: float = 0.0
+
+    @classmethod
+    def parse(cls, spec: str) -> "Latency":
+        kind, *params = spec.split(":")
+        if kind not in ("fixed", "uniform", "lognormal") or len(params) != (1 if kind == "fixed" else 2):
+            raise argparse.ArgumentTypeError(
+                f"Invalid latency {spec!r}, e.g. fixed:0.1, uniform:0.05:0.2 or lognormal:0.1:0.5"
+            )
+        return cls(kind, *map(float, params))
+
+    def sample(self) -> float:
+        if self.kind == "uniform":
+            return random.uniform(self.a, self.b)
+        if self.kind == "lognormal":
+            return random.lognormvariate(np.log(self.a), self.b)
+        return self.a
+
+
+@dataclass
+class FakeConfig:
+    n_issues: int = 10_000
+    dim: int = 256
+    search_latency: Latency = field(default_factory=lambda: Latency("lognormal", 0.08, 0.5))
+    embedding_latency: Latency = field(default_factory=lambda: Latency("lognormal", 0.03, 0.3))
+    time_to_first_token: Latency = field(default_factory=lambda: Latency("lognormal", 0.8, 0.4))
+    tokens_per_second: float = 40.0
+    completion_tokens: int = 120
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    small_model: str | None = None
+    small_model_speedup: float = 3.0
+
+
+class Stats:
+    """Requests served, failed and in flight per API, and the largest number in flight at once."""
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.requests: dict[str, int] = defaultdict(int)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.in_flight: dict[str, int] = defaultdict(int)
+        self.max_in_flight: dict[str, int] = defaultdict(int)
+        self.started_at = time.time()
+
+    @contextmanager
+    def track(self, api: str) -> Iterator[None]:
+        # Handlers run on the event loop, so no lock is needed
+        self.requests[api] += 1
+        self.in_flight[api] += 1
+        self.max_in_flight[api] = max(self.max_in_flight[api], self.in_flight[api])
+        try:
+            yield
+        except HTTPException:
+            self.errors[api] += 1
+            raise
+        finally:
+            self.in_flight[api] -= 1
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "seconds": time.time() - self.started_at,
+            "requests": dict(self.requests),
+            "errors": dict(self.errors),
+            "max_in_flight": dict(self.max_in_flight),
+        }
+
+
+class FakeIndex:
+    """Exact search of the synthetic issues, with the results laid out like the Vector Search API's."""
+
+    def __init__(self, n_issues: int, dim: int):
+        self.embed = FakeEmbedder(dim)
+        self.issues = synthetic_issues(n_issues)
+        embeddings = synthetic_embeddings(self.embed, n_issues)
+        self.embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        # The app's INDEX_PRIMARY_KEY and the columns may not have the synthetic issues' case
+        self.columns = {c.lower(): c for c in self.issues.columns}
+
+    def _mask(self, filters: dict[str, Any]) -> np.ndarray:
+        mask = np.ones(len(self.issues), dtype=bool)
+        for column, value in filters.items():
+            values = self.issues[self.columns[column.lower()]]
+            mask &= values.isin(value).to_numpy() if isinstance(value, list) else (values == value).to_numpy()
+        return mask
+
+    def query(self, body: dict[str, Any]) -> dict[str, Any]:
+        vector = np.asarray(body.get("query_vector") or self.embed([body.get("query_text") or ""])[0])
+        if vector.shape[0] != self.embeddings.shape[1]:
+            # Embedded by another model, e.g. a local one: only the latency matters then
+            vector = np.resize(vector, self.embeddings.shape[1])
+        scores = self.embeddings @ vector.astype(np.float32)
+        if body.get("filters_json"):
+            scores = np.where(self._mask(json.loads(body["filters_json"])), scores, -np.inf)
+        num_results = min(int(body.get("num_results", 5)), len(scores))
+        top = np.argpartition(-scores, num_results - 1)[:num_results]
+        top = top[np.argsort(-scores[top])]
+        top = top[np.isfinite(scores[top])]
+        columns = [self.columns[c.lower()] for c in body["columns"]]
+        rows = pd.DataFrame(self.issues.iloc[top][columns]).astype(object).to_numpy().tolist()
+        return {
+            "manifest": {
+                "column_count": len(columns) + 1,
+                "columns": [{"name": c} for c in [*body["columns"], "score"]],
+            },
+            "result": {"row_count": len(rows), "data_array": [[*r, float(s)] for r, s in zip(rows, scores[top])]},
+            "next_page_token": None,
+        }
+
+
+def _completion_words(n_words: int) -> list[str]:
+    words = COMPLETION_TEXT.split()
+    return [words[i % len(words)] for i in range(n_words)]
+
+
+def _usage(prompt_tokens: int, words: list[str]) -> dict[str, int]:
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)}
+
+
+def _chat_completion(completion_id: str, model: str | None, words: list[str], prompt_tokens: int) -> dict[str, Any]:
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}
+        ],
+        "usage": _usage(prompt_tokens, words),
+    }
+
+
+def _chat_completion_chunk(
+    completion_id: str, model: str | None, delta: dict[str, str] | None, usage: dict[str, int] | None = None
+) -> str:
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        # The last chunk only has the usage, like OpenAI's with `stream_options={"include_usage": True}`
+        "choices": [{"index": 0, "delta": delta, "finish_reason": None}] if delta is not None else [],
+        "usage": usage,
+    }
+    return f"data: {json.dumps(chunk)}\n\n"
+
+
+class FakeServices:
+    """Request handlers of the stand-ins, registered on an app by `create_app`."""
+
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self.stats = Stats()
+        self.index = FakeIndex(config.n_issues, config.dim)
+
+    async def _respond_after(self, latency: Latency, speedup: float = 1.0) -> None:
+        roll = random.random()
+        if roll < self.config.error_rate:
+            raise HTTPException(status_code=503, detail="Fake server error")
+        if roll < self.config.error_rate + self.config.throttle_rate:
+            raise HTTPException(status_code=429, detail="Fake rate limit", headers={"Retry-After": "1"})
+        await asyncio.sleep(latency.sample() / speedup)
+
+    async def get_stats(self) -> dict[str, Any]:
+        return self.stats.to_dict()
+
+    async def reset_stats(self) -> dict[str, Any]:
+        snapshot = self.stats.to_dict()
+        self.stats.reset()
+        return snapshot
+
+    async def describe_index(self, index_name: str, endpoint_name: str = "fake_endpoint") -> dict[str, Any]:
+        with self.stats.track("vector_search.describe"):
+            return {
+                "name": index_name,
+                "endpoint_name": endpoint_name,
+                "status": {"ready": True, "detailed_state": "ONLINE", "indexed_row_count": len(self.index.issues)},
+            }
+
+    async def similarity_search(self, request: Request) -> dict[str, Any]:
+        with self.stats.track("vector_search.query"):
+            await self._respond_after(self.config.search_latency)
+            return self.index.query(await request.json())
+
+    async def embeddings(self, request: Request) -> dict[str, Any]:
+        with self.stats.track("embeddings"):
+            body = await request.json()
+            texts = [body["input"]] if isinstance(body["input"], str) else body["input"]
+            await self._respond_after(self.config.embedding_latency)
+            vectors = self.index.embed(texts)
+            return {
+                "object": "list",
+                "model": body.get("model"),
+                "data": [{"object": "embedding", "index": i, "embedding": v.tolist()} for i, v in enumerate(vectors)],
+                "usage": {"prompt_tokens": sum(len(t.split()) for t in texts), "total_tokens": 0},
+            }
+
+    async def chat_completions(self, request: Request) -> dict[str, Any] | StreamingResponse:
+        body = await request.json()
+        words = _completion_words(self.config.completion_tokens)
+        completion_id, model = f"chatcmpl-fake-{random.getrandbits(32):08x}", body.get("model")
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in body.get("messages", []))
+        speedup = self.config.small_model_speedup if model and model == self.config.small_model else 1.0
+        tokens_per_second = self.config.tokens_per_second * speedup
+
+        with self.stats.track("chat.completions"):
+            await self._respond_after(self.config.time_to_first_token, speedup)
+            if not body.get("stream"):
+                await asyncio.sleep(len(words) / tokens_per_second)
+                return _chat_completion(completion_id, model, words, prompt_tokens)
+
+        async def _chunks() -> AsyncIterator[str]:
+            with self.stats.track("chat.completions.streaming"):
+                for i, word in enumerate(words):
+                    delta = {"role": "assistant", "content": word} if i == 0 else {"content": f" {word}"}
+                    yield _chat_completion_chunk(completion_id, model, delta)
+                    await asyncio.sleep(1 / tokens_per_second)
+                yield _chat_completion_chunk(completion_id, model, None, _usage(prompt_tokens, words))
+                yield "data: [DONE]\n\n"
+
+        return StreamingResponse(_chunks(), media_type="text/event-stream")
+
+
+def create_app(config: FakeConfig) -> FastAPI:
+    app = FastAPI(title="Fake Databricks services")
+    services = FakeServices(config)
+    vector_search = "/api/2.0/vector-search"
+    app.add_api_route("/fake/stats", services.get_stats, methods=["GET"])
+    app.add_api_route("/fake/stats/reset", services.reset_stats, methods=["POST"])
+    app.add_api_route(f"{vector_search}/indexes/{{index_name}}", services.describe_index, methods=["GET"])
+    app.add_api_route(
+        f"{vector_search}/endpoints/{{endpoint_name}}/indexes/{{index_name}}", services.describe_index, methods=["GET"]
+    )
+    # The client sends the query as the JSON body of a GET
+    app.add_api_route(
+        f"{vector_search}/endpoints/{{endpoint_name}}/indexes/{{index_name}}/query",
+        services.similarity_search,
+        methods=["GET", "POST"],
+    )
+    app.add_api_route("/serving-endpoints/embeddings", services.embeddings, methods=["POST"])
+    app.add_api_route(
+        "/serving-endpoints/chat/completions", services.chat_completions, methods=["POST"], response_model=None
+    )
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--issues", type=int, default=10_000, help="Synthetic issues in the fake index")
+    parser.add_argument("--dim", type=int, default=256, help="Embedding size of the fake embedding model")
+    parser.add_argument("--search-latency", type=Latency.parse, default=Latency("lognormal", 0.08, 0.5))
+    parser.add_argument("--embedding-latency", type=Latency.parse, default=Latency("lognormal", 0.03, 0.3))
+    parser.add_argument(
+        "--ttft", type=Latency.parse, default=Latency("lognormal", 0.8, 0.4), help="Time to first token"
+    )
+    parser.add_argument("--tokens-per-second", type=float, default=40.0)
+    parser.add_argument("--completion-tokens", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failing with a 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests failing with a 429")
+    parser.add_argument("--small-model", default=None, help="Model name of the faster serving endpoint, if any")
+    parser.add_argument("--small-model-speedup", type=float, default=3.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    config = FakeConfig(
+        n_issues=args.issues,
+        dim=args.dim,
+        search_latency=args.search_latency,
+        embedding_latency=args.embedding_latency,
+        time_to_first_token=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        small_model=args.small_model,
+        small_model_speedup=args.small_model_speedup,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
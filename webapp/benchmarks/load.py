@@ -0,0 +1,257 @@
+"""Load test of the app API: concurrent engineer sessions searching for similar issues, then asking for a
+recommendation, at increasing concurrency levels, against the fake Databricks services of `benchmarks/fakes.py`.
+
+Usage (from the webapp directory):
+    python -m benchmarks.fakes --search-latency lognormal:0.15:0.5 --ttft lognormal:0.8:0.4 --tokens-per-second 40 &
+    FAKE_SERVICES_URL=http://localhost:8100 VECTOR_SEARCH_BACKEND=databricks ... uvicorn api:app --port 8001 &
+    python -m benchmarks.load --url http://localhost:8001 --fakes-url http://localhost:8100 --sessions 1 4 16 64
+
+The Streamlit app shares the clients and connection pools of the API, so where these saturate the app's sessions do
+too. The threads are not shared: the API has its own search and generation pools, the app its orchestrator.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import time
+from collections import defaultdict
+from collections.abc import Sequence
+from contextlib import nullcontext
+from itertools import pairwise
+from pathlib import Path
+from typing import Any
+
+import httpx
+import numpy as np
+
+from api import API_GENERATION_WORKERS, API_SEARCH_WORKERS
+from benchmarks.run import RESULTS_DIR, _git_commit
+from benchmarks.synthetic import synthetic_queries
+from src.resources import OPEN_AI_MAX_CONNECTIONS
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (50, 95, 99)
+# Connections per host of the vector search client (`databricks.vector_search.utils`), and threads Starlette iterates
+# the streamed recommendations on (anyio's default limiter)
+VECTOR_SEARCH_POOL_SIZE = 50
+STREAMING_THREADS = 40
+# A level saturates the app when it adds less throughput than this over the previous one...
+MIN_THROUGHPUT_GAIN = 0.1
+# ... or when the p95 of a step grows by more than this factor
+MAX_P95_GROWTH = 2.0
+
+
+class Recorder:
+    """Latencies of the successful steps and the errors of the failed ones, of all the sessions of a level."""
+
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.flows = 0
+
+    def stats(self, wall_s: float) -> dict[str, Any]:
+        steps = {}
+        for step, latencies in self.latencies.items():
+            latencies_ms = np.asarray(latencies) * 1000
+            steps[step] = {
+                "count": len(latencies),
+                "mean_ms": float(latencies_ms.mean()),
+                **{f"p{p}_ms": float(np.percentile(latencies_ms, p)) for p in PERCENTILES},
+            }
+        requests = sum(len(v) for k, v in self.latencies.items() if k != "recommendation.ttft") + sum(
+            self.errors.values()
+        )
+        return {
+            "flows": self.flows,
+            "flows_per_s": self.flows / wall_s,
+            "error_rate": sum(self.errors.values()) / requests if requests else 0.0,
+            "errors": dict(self.errors),
+            "steps": steps,
+        }
+
+
+async def _timed_step(recorder: Recorder, step: str, request: Any) -> Any:
+    start = time.perf_counter()
+    try:
+        response = await request
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        recorder.errors[step] += 1
+        logger.debug(f"{step} failed: {e}")
+        return None
+    recorder.latencies[step].append(time.perf_counter() - start)
+    return response
+
+
+async def _recommend_streamed(
+    client: httpx.AsyncClient, recorder: Recorder, description: str, similar_issues: list[dict[str, Any]]
+) -> bool:
+    body = {"description": description, "similar_issues": similar_issues, "stream": True}
+    start = time.perf_counter()
+    first_token_s = None
+    try:
+        async with client.stream("POST", "/recommendation", json=body) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_text():
+                if chunk and first_token_s is None:
+                    first_token_s = time.perf_counter() - start
+    except httpx.HTTPError as e:
+        recorder.errors["recommendation"] += 1
+        logger.debug(f"recommendation failed: {e}")
+        return False
+    recorder.latencies["recommendation"].append(time.perf_counter() - start)
+    if first_token_s is not None:
+        recorder.latencies["recommendation.ttft"].append(first_token_s)
+    return True
+
+
+async def session(
+    client: httpx.AsyncClient, recorder: Recorder, args: argparse.Namespace, queries: Sequence[str], deadline: float
+) -> None:
+    """An engineer describing issues one after the other: search, read the similar issues, ask for a recommendation."""
+    rng = random.Random()
+    while time.perf_counter() < deadline:
+        description = rng.choice(queries)
+        search = client.post("/search", json={"query": description, "num_results": args.num_results})
+        if (response := await _timed_step(recorder, "search", search)) is None:
+            continue
+        similar_issues = response.json()["similar_issues"]
+        await asyncio.sleep(rng.expovariate(1 / args.think_time) if args.think_time else 0)
+
+        if args.stream:
+            done = await _recommend_streamed(client, recorder, description, similar_issues)
+        else:
+            body = {"description": description, "similar_issues": similar_issues}
+            done = await _timed_step(recorder, "recommendation", client.post("/recommendation", json=body)) is not None
+        recorder.flows += done
+
+
+async def _fake_stats(fakes: httpx.AsyncClient | None, reset: bool = False) -> dict[str, Any] | None:
+    if fakes is None:
+        return None
+    response = await fakes.post("/fake/stats/reset") if reset else await fakes.get("/fake/stats")
+    response.raise_for_status()
+    return response.json()
+
+
+async def run_level(args: argparse.Namespace, n_sessions: int, queries: Sequence[str]) -> dict[str, Any]:
+    limits = httpx.Limits(max_connections=n_sessions, max_keepalive_connections=n_sessions)
+    timeout = httpx.Timeout(args.timeout)
+    async with (
+        httpx.AsyncClient(base_url=args.url, limits=limits, timeout=timeout) as client,
+        httpx.AsyncClient(base_url=args.fakes_url, timeout=timeout) if args.fakes_url else nullcontext() as fakes,
+    ):
+        await _fake_stats(fakes, reset=True)
+        recorder = Recorder()
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(*(session(client, recorder, args, queries, deadline) for _ in range(n_sessions)))
+        wall_s = time.perf_counter() - start
+        return {"sessions": n_sessions, "wall_s": wall_s, **recorder.stats(wall_s), "fakes": await _fake_stats(fakes)}
+
+
+def saturation(levels: Sequence[dict[str, Any]]) -> dict[str, Any] | None:
+    """The first level adding less than `MIN_THROUGHPUT_GAIN` throughput, or multiplying a step's p95 by more than
+    `MAX_P95_GROWTH`, over the previous one."""
+    for previous, level in pairwise(levels):
+        reasons = []
+        if previous["flows_per_s"] and level["flows_per_s"] < previous["flows_per_s"] * (1 + MIN_THROUGHPUT_GAIN):
+            reasons.append(f"throughput {previous['flows_per_s']:.2f} -> {level['flows_per_s']:.2f} flows/s")
+        for step, stats in level["steps"].items():
+            if (old := previous["steps"].get(step)) and stats["p95_ms"] > old["p95_ms"] * MAX_P95_GROWTH:
+                reasons.append(f"{step} p95 {old['p95_ms']:.0f} -> {stats['p95_ms']:.0f}ms")
+        if reasons:
+            return {"sessions": level["sessions"], "reasons": reasons, "hints": _hints(level)}
+    return None
+
+
+def _hints(level: dict[str, Any]) -> list[str]:
+    """Which of the app's limits the concurrent calls to the fakes ran into, while the sessions were waiting."""
+    if not level["fakes"]:
+        return ["Run against the fakes (--fakes-url) to see which of the app's pools the calls queue in"]
+    in_flight, n_sessions = level["fakes"]["max_in_flight"], level["sessions"]
+    searches = in_flight.get("vector_search.query", 0)
+    completions = in_flight.get("chat.completions", 0) + in_flight.get("chat.completions.streaming", 0)
+    limits = {
+        "API_SEARCH_WORKERS": API_SEARCH_WORKERS,
+        "the vector search connection pool": VECTOR_SEARCH_POOL_SIZE,
+    }
+    hints = [
+        f"{searches} concurrent searches reached {name} ({limit})"
+        for name, limit in limits.items()
+        if searches < n_sessions and searches >= limit
+    ]
+    for name, limit in {
+        "API_GENERATION_WORKERS": API_GENERATION_WORKERS,
+        "OPEN_AI_MAX_CONNECTIONS": OPEN_AI_MAX_CONNECTIONS,
+    }.items():
+        if completions < n_sessions and completions >= limit:
+            hints.append(f"{completions} concurrent completions reached {name} ({limit})")
+    if completions < n_sessions and completions >= STREAMING_THREADS:
+        hints.append(f"{completions} concurrent streamed completions reached Starlette's {STREAMING_THREADS} threads")
+    if not hints:
+        hints.append(
+            f"At most {searches} searches and {completions} completions were in flight for {n_sessions} sessions: "
+            "the calls are not queued in the app's pools, look at the event loop and the batcher instead"
+        )
+    return hints
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8001", help="Base URL of the app API")
+    parser.add_argument("--fakes-url", default=None, help="Base URL of `benchmarks.fakes`, for its call statistics")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 4, 16, 64], help="Concurrency levels")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds per concurrency level")
+    parser.add_argument("--think-time", type=float, default=2.0, help="Mean seconds spent reading the similar issues")
+    parser.add_argument("--num-results", type=int, default=5)
+    parser.add_argument("--stream", action="store_true", help="Streams the recommendations, measuring the TTFT")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", type=Path, default=None, help="Defaults to benchmarks/results/load-<commit>.json")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    queries = synthetic_queries(args.queries, seed=args.seed)
+    levels = []
+    for n_sessions in args.sessions:
+        level = asyncio.run(run_level(args, n_sessions, queries))
+        levels.append(level)
+        p95s = ", ".join(f"{step} p95 {stats['p95_ms']:.0f}ms" for step, stats in level["steps"].items())
+        logger.info(
+            f"{n_sessions} sessions: {level['flows_per_s']:.2f} flows/s, {p95s}, errors {level['error_rate']:.1%}"
+        )
+
+    commit = _git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "config": {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()},
+        "levels": levels,
+        "saturation": (saturated := saturation(levels)),
+    }
+    if saturated is None:
+        logger.info("No saturation up to the last level")
+    else:
+        logger.info(f"Saturates at {saturated['sessions']} sessions: {'; '.join(saturated['reasons'])}")
+        for hint in saturated["hints"]:
+            logger.info(f"  {hint}")
+
+    output = args.output or RESULTS_DIR / f"load-{(commit or 'local')[:12]}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    logger.info(f"Wrote load test results to {output}")
+
+
+if __name__ == "__main__":
+    main()
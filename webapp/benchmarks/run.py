@@ -0,0 +1,225 @@
+"""Offline retrieval and prompt-building benchmark over synthetic corpora.
+
+Usage (from the webapp directory):
+    python -m benchmarks.run --scales 1000 100000 1000000 --output benchmarks/results/my-change.json
+    python -m benchmarks.run --hybrid --baseline benchmarks/results/main.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from benchmarks.synthetic import (
+    FakeEmbedder,
+    is_relevant,
+    synthetic_embeddings,
+    synthetic_issues,
+    synthetic_queries,
+)
+from src.context_builder import build_context
+from src.hybrid_search import HeuristicReranker, HybridSearcher
+from src.local_index import LocalVectorIndex, LocalVectorSearcher, recall_at_k, write_snapshot
+from src.rec_suggestion import _augment_prompt
+from src.telemetry import registry
+from src.vector_search import SimilarIssue, SimilarIssueSearcher
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DIR = Path(__file__).parent / "results"
+PERCENTILES = (50, 95, 99)
+
+
+def _latency_stats(latencies_s: Sequence[float], wall_s: float) -> dict[str, float]:
+    latencies_ms = np.asarray(latencies_s) * 1000
+    return {
+        "qps": len(latencies_ms) / wall_s,
+        "mean_ms": float(latencies_ms.mean()),
+        **{f"p{p}_ms": float(np.percentile(latencies_ms, p)) for p in PERCENTILES},
+    }
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024**2 if sys.platform == "darwin" else 1024)
+
+
+def _timed_calls(fn: Callable[[str], Any], queries: Sequence[str], threads: int) -> tuple[list[Any], dict[str, float]]:
+    def _call(query: str) -> tuple[Any, float]:
+        start = time.perf_counter()
+        result = fn(query)
+        return result, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        outputs = list(executor.map(_call, queries))
+    wall_s = time.perf_counter() - start
+    return [r for r, _ in outputs], _latency_stats([t for _, t in outputs], wall_s)
+
+
+def benchmark_searcher(
+    searcher: SimilarIssueSearcher, queries: Sequence[str], num_results: int, threads: int = 1
+) -> tuple[list[list[SimilarIssue]], dict[str, float]]:
+    """Drives any searcher through the `VectorSearcher.search` contract."""
+    return _timed_calls(lambda q: searcher.search(q, num_results=num_results), queries, threads)
+
+
+def benchmark_prompt_building(
+    queries: Sequence[str], results: Sequence[list[SimilarIssue]], token_budget: int
+) -> dict[str, float]:
+    latencies, tokens = [], []
+    start = time.perf_counter()
+    for query, similar_issues in zip(queries, results):
+        _start = time.perf_counter()
+        context = build_context(similar_issues, token_budget=token_budget)
+        _augment_prompt(query, context.text)
+        latencies.append(time.perf_counter() - _start)
+        tokens.append(context.tokens)
+    return {**_latency_stats(latencies, time.perf_counter() - start), "mean_context_tokens": float(np.mean(tokens))}
+
+
+def benchmark_scale(args: argparse.Namespace, n_rows: int, index_dir: Path) -> list[dict[str, Any]]:
+    embed = FakeEmbedder(dim=args.dim)
+    start = time.perf_counter()
+    n_lists = args.n_lists or max(1, int(4 * np.sqrt(n_rows)))
+    write_snapshot(
+        index_dir,
+        synthetic_embeddings(embed, n_rows, seed=args.seed),
+        synthetic_issues(n_rows, seed=args.seed),
+        n_lists=n_lists,
+    )
+    build_s = time.perf_counter() - start
+    index = LocalVectorIndex.load(index_dir)
+    logger.info(f"Built a {n_rows} rows index with {n_lists} IVF lists in {build_s:.1f}s")
+
+    queries = synthetic_queries(args.queries, seed=args.seed)
+    # Warm up the page cache and the word vectors, so that the first mode does not pay for them
+    benchmark_searcher(LocalVectorSearcher(index, embed=embed), queries[:10], num_results=args.k)
+
+    exact_searcher = LocalVectorSearcher(index, embed=embed, mode="exact")
+    searchers: dict[str, SimilarIssueSearcher] = {
+        "exact": exact_searcher,
+        "ivf": LocalVectorSearcher(index, embed=embed, mode="ivf", nprobe=args.nprobe),
+    }
+    lexical_build_s = None
+    if args.hybrid:
+        start = time.perf_counter()
+        hybrid = HybridSearcher(exact_searcher, index.metadata, vector_budget_seconds=None)
+        lexical_build_s = time.perf_counter() - start
+        searchers["hybrid"] = hybrid
+        searchers["hybrid_rerank"] = HybridSearcher(
+            exact_searcher, index.metadata, reranker=HeuristicReranker(), vector_budget_seconds=None
+        )
+
+    rows, exact_ids = [], None
+    for mode, searcher in searchers.items():
+        results, search_stats = benchmark_searcher(searcher, queries, num_results=args.k, threads=args.threads)
+        ids = np.array([[i.id for i in r] + [-1] * (args.k - len(r)) for r in results])
+        exact_ids = ids if mode == "exact" else exact_ids
+        relevant = [is_relevant(q, i.original or "") for q, r in zip(queries, results) for i in r]
+        rows.append(
+            {
+                "n_rows": n_rows,
+                "mode": mode,
+                "nprobe": args.nprobe if mode == "ivf" else None,
+                "n_lists": n_lists,
+                "build_s": lexical_build_s if mode.startswith("hybrid") else build_s,
+                "index_mb": index.embeddings.nbytes / 1024**2,
+                "peak_rss_mb": _peak_rss_mb(),
+                "search": search_stats,
+                f"recall_at_{args.k}": recall_at_k(ids, exact_ids) if exact_ids is not None else None,
+                # Fraction of the retrieved issues matching the component and symptom (or alarm code) of the query
+                f"precision_at_{args.k}": float(np.mean(relevant)) if relevant else 0.0,
+                "prompt": benchmark_prompt_building(queries, results, token_budget=args.token_budget),
+            }
+        )
+        logger.info(
+            f"{n_rows} rows, {mode}: {search_stats['qps']:.0f} QPS, p95 {search_stats['p95_ms']:.2f}ms, "
+            f"recall@{args.k} {rows[-1][f'recall_at_{args.k}']:.3f}, "
+            f"precision@{args.k} {rows[-1][f'precision_at_{args.k}']:.3f}"
+        )
+    return rows
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict[str, Any], current: dict[str, Any]) -> list[str]:
+    """Relative change of the headline numbers of every (scale, mode) present in both result files."""
+    metrics = (("search", "qps"), ("search", "p95_ms"), ("search", "p99_ms"), ("prompt", "p95_ms"))
+    previous = {(r["n_rows"], r["mode"]): r for r in baseline["results"]}
+    lines = []
+    for row in current["results"]:
+        if (old := previous.get((row["n_rows"], row["mode"]))) is None:
+            continue
+        changes = [
+            f"{group}.{name} {(row[group][name] / old[group][name] - 1):+.1%}"
+            for group, name in metrics
+            if old[group][name]
+        ]
+        lines.append(f"{row['n_rows']} rows, {row['mode']}: " + ", ".join(changes))
+    return lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1_000, 100_000])
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=5, help="Number of similar issues retrieved per query")
+    parser.add_argument("--dim", type=int, default=256, help="Embedding size of the fake embedding model")
+    parser.add_argument("--n-lists", type=int, default=None, help="IVF lists, 4 * sqrt(rows) by default")
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--hybrid", action="store_true", help="Also benchmarks hybrid (BM25 + vector) retrieval")
+    parser.add_argument("--threads", type=int, default=1, help="Concurrent searches")
+    parser.add_argument("--token-budget", type=int, default=1500)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", type=Path, default=None, help="Defaults to benchmarks/results/<commit>.json")
+    parser.add_argument("--baseline", type=Path, default=None, help="Result file to compare against")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    logging.getLogger("src").setLevel(logging.WARNING)
+
+    commit = _git_commit()
+    results = []
+    for n_rows in args.scales:
+        with tempfile.TemporaryDirectory(prefix="eng-rec-benchmark-") as index_dir:
+            results += benchmark_scale(args, n_rows, Path(index_dir))
+
+    report = {
+        "commit": commit,
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "config": {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()},
+        "results": results,
+        "stages": registry.snapshot()["stages"],
+    }
+    output = args.output or RESULTS_DIR / f"{(commit or 'local')[:12]}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    logger.info(f"Wrote benchmark results to {output}")
+
+    if args.baseline is not None:
+        for line in compare(json.loads(args.baseline.read_text()), report):
+            logger.info(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""Synthetic turbine issues and a fake embedding model, so that retrieval can be benchmarked without Databricks."""
+
+import zlib
+from collections.abc import Sequence
+
+import numpy as np
+import pandas as pd
+
+MARKETS = ("US", "Australia", "Germany", "Spain", "Brazil", "India", "UK", "Canada")
+SITES = tuple(
+    f"{a} {b}"
+    for a in ("Windwhisper", "Galeforce", "Stormridge", "Breezehaven", "Cyclone", "Zephyr", "Tempest", "Aeolus")
+    for b in ("Park", "Energy Center", "Wind Farm", "Ridge")
+)
+COMPONENTS = (
+    "pitch motor",
+    "pitch hydraulic unit",
+    "gearbox",
+    "main bearing",
+    "generator",
+    "converter",
+    "yaw drive",
+    "transformer",
+    "anemometer",
+    "blade",
+    "cooling pump",
+    "slip ring",
+)
+SYMPTOMS = (
+    "overtemperature alarms",
+    "high vibration",
+    "oil pressure drop",
+    "intermittent communication loss",
+    "unexpected shutdowns",
+    "power curve underperformance",
+    "abnormal noise",
+    "insulation resistance faults",
+    "oil leakage",
+    "sensor readings stuck",
+)
+CONDITIONS = (
+    "at high wind speeds",
+    "after grid events",
+    "during cold starts",
+    "at rated power",
+    "during yaw misalignment",
+    "in high ambient temperatures",
+)
+ACTIONS = (
+    "Inspect and replace the temperature sensor",
+    "Flush the oil and replace the filters",
+    "Re-torque the bolts and check the alignment",
+    "Update the controller firmware",
+    "Replace the worn bearing",
+    "Clean the cooling circuit and check the fan",
+    "Recalibrate the sensor and verify the wiring",
+    "Replace the faulty encoder",
+)
+RESOLUTIONS = (
+    "The alarms stopped after the replacement.",
+    "Vibration levels returned to normal.",
+    "Production recovered to the expected power curve.",
+    "No recurrence in the following three months.",
+    "The issue reappeared and was escalated to the OEM.",
+)
+
+PARTS = {
+    "component": COMPONENTS,
+    "symptom": SYMPTOMS,
+    "condition": CONDITIONS,
+    "action": ACTIONS,
+    "resolution": RESOLUTIONS,
+}
+
+
+class FakeEmbedder:
+    """Deterministic bag-of-words embedding: the sum of one pseudo-random vector per (lowercased) word.
+
+    Texts sharing words get similar embeddings, so nearest neighbours are meaningful, and every vector is a pure
+    function of the text, so results are reproducible across runs and machines.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self._word_vectors: dict[str, np.ndarray] = {}
+
+    def _word_vector(self, word: str) -> np.ndarray:
+        if (vector := self._word_vectors.get(word)) is None:
+            rng = np.random.default_rng(zlib.crc32(word.encode()))
+            vector = self._word_vectors[word] = rng.standard_normal(self.dim).astype(np.float32)
+        return vector
+
+    def embed_unnormalized(self, text: str) -> np.ndarray:
+        words = text.casefold().split()
+        return np.sum([self._word_vector(w) for w in words], axis=0) if words else np.zeros(self.dim, np.float32)
+
+    def __call__(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = np.array([self.embed_unnormalized(t) for t in texts], dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), np.finfo(np.float32).tiny)
+
+
+def _choices(n_rows: int, seed: int) -> dict[str, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    return {k: rng.integers(len(v), size=n_rows) for k, v in PARTS.items()}
+
+
+def _alarm_codes(components: np.ndarray, symptoms: np.ndarray) -> pd.Series:
+    return pd.Series(components * 100 + symptoms).map("E-{:04d}".format)
+
+
+def synthetic_issues(n_rows: int, seed: int = 42) -> pd.DataFrame:
+    """Issues with the columns of the index (`TABLE_COLS`), their summaries written like the summarization job's."""
+    rng = np.random.default_rng(seed + 1)
+    choices = _choices(n_rows, seed)
+    texts = {k: pd.Series(np.asarray(PARTS[k], dtype=object)[v]) for k, v in choices.items()}
+    title = texts["component"].str.capitalize() + " " + texts["symptom"]
+    symptoms = (
+        "Alarm "
+        + _alarm_codes(choices["component"], choices["symptom"])
+        + ": the "
+        + texts["component"]
+        + " shows "
+        + texts["symptom"]
+        + " "
+        + texts["condition"]
+        + "."
+    )
+    return pd.DataFrame(
+        {
+            "Id": np.arange(n_rows, dtype=np.float64),
+            "Market": np.asarray(MARKETS, dtype=object)[rng.integers(len(MARKETS), size=n_rows)],
+            "Site": np.asarray(SITES, dtype=object)[rng.integers(len(SITES), size=n_rows)],
+            "Turbine": pd.Series(rng.integers(1, 100, size=n_rows)).map("T{:02d}".format),
+            "Title": title,
+            "Original": "# " + title + "\n\n" + symptoms,
+            "Summary": (
+                "### Symptoms:\n" + symptoms + "\n### Recommendation:\n" + texts["action"] + "."
+                "\n### Resolution:\n" + texts["resolution"]
+            ),
+        }
+    )
+
+
+def synthetic_embeddings(embed: FakeEmbedder, n_rows: int, seed: int = 42, noise: float = 0.5) -> np.ndarray:
+    """Embeddings of `synthetic_issues(n_rows, seed)`, built from the embeddings of their parts plus some noise.
+
+    Close to embedding every summary with `embed`, without embedding millions of texts.
+    """
+    rng = np.random.default_rng(seed + 2)
+    embeddings = rng.standard_normal((n_rows, embed.dim), dtype=np.float32) * noise
+    for part, choices in _choices(n_rows, seed).items():
+        part_vectors = np.array([embed.embed_unnormalized(t) for t in PARTS[part]], dtype=np.float32)
+        for start in range(0, n_rows, 65_536):
+            embeddings[start : start + 65_536] += part_vectors[choices[start : start + 65_536]]
+    return embeddings
+
+
+def synthetic_queries(n_queries: int, seed: int = 0, code_fraction: float = 0.2) -> list[str]:
+    """Descriptions of a new issue, as typed by an engineer: a component, a symptom and sometimes a condition.
+
+    A `code_fraction` of them only give the alarm code and the component, which embeddings alone match poorly.
+    """
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(n_queries):
+        component, symptom = rng.integers(len(COMPONENTS)), rng.integers(len(SYMPTOMS))
+        if rng.random() < code_fraction:
+            queries.append(
+                f"{_alarm_codes(np.array([component]), np.array([symptom]))[0]} on the {COMPONENTS[component]}"
+            )
+        else:
+            condition = f" {rng.choice(CONDITIONS)}" if rng.random() < 0.5 else ""
+            queries.append(f"{COMPONENTS[component]} {SYMPTOMS[symptom]}{condition}")
+    return queries
+
+
+def is_relevant(query: str, original: str) -> bool:
+    """Whether an issue has the component and symptom (or the alarm code) the query describes."""
+    title, _, body = original.partition("\n\n")
+    code = body.split(":", maxsplit=1)[0].removeprefix("Alarm ")
+    return query.startswith(code) or query.casefold().startswith(title.removeprefix("# ").casefold())
@@ -1,26 +1,60 @@
+import threading
+from collections.abc import Iterator
+
 import streamlit as st
-from annotated_text import annotated_text
 
 from src.custom_mocks import mock_chart
-from src.rec_suggestion import get_suggested_recommendation
-from src.resources import get_open_ai_client
+from src.ingestion import Submission, get_ingestion_queue, start_ingestion_writer
+from src.orchestration import get_orchestrator_executor, get_search_orchestrator, prefetch
+from src.rec_suggestion import GenerationTiming, LLMUnavailableError, stream_suggested_recommendation
+from src.resources import get_completion_cache, get_open_ai_client
+from src.scada import SCADA_MAX_CHANNELS, scada_channels, scada_extent, scada_figure, window_step
 from src.styling import CUSTOM_STYLES_TO_APPLY
-from src.vector_search import SimilarIssue, get_vector_searcher
+from src.telemetry import start_exporters
+from src.vector_search import Filters, SimilarIssue, fetch_originals, get_vector_searcher
+from src.warmup import start_warmup
+
+
+def _search_scopes() -> list[Filters]:
+    """Narrowest first: the same turbine, the same site, then the same market, as given in the URL by the alert."""
+    params = st.query_params
+    scopes: list[Filters] = []
+    if "site" in params and "turbine" in params:
+        scopes.append({"Site": params["site"], "Turbine": params["turbine"]})
+    if "site" in params:
+        scopes.append({"Site": params["site"]})
+    if "market" in params:
+        scopes.append({"Market": params["market"]})
+    return scopes
 
 
 def _show_similar() -> None:
     st.session_state.sidebar_state = "expanded"
-    with st.spinner("Searching for similar issues..."):
-        _get_similar_issues()
+    st.session_state.show_similar = True
+    get_search_orchestrator().submit(st.session_state.issue_description, scopes=_search_scopes())
 
 
-def _get_similar_issues() -> None:
-    vector_searcher = get_vector_searcher()
-    st.session_state.similar_issues = vector_searcher.search(st.session_state.issue_description)
+def _on_description_change() -> None:
+    _cancel_generation()
+    # Speculatively start the search, so that it is done (or in flight) by the time a button is clicked
+    get_search_orchestrator().submit(st.session_state.issue_description, scopes=_search_scopes())
 
 
 def _submit_recommendation() -> None:
     if st.session_state.recommendation_text:
+        if (queue := get_ingestion_queue()) is not None:
+            # Only enqueued: the background writer adds it to the table and the index
+            params = st.query_params
+            queue.put(
+                Submission(
+                    description=st.session_state.issue_description,
+                    recommendation=st.session_state.recommendation_text,
+                    similar_issue_ids=st.session_state.get("recommendation_issue_ids", []),
+                    market=params.get("market", ""),
+                    site=params.get("site", ""),
+                    turbine=params.get("turbine", ""),
+                )
+            )
         st.toast("Recommendation submitted", icon="🚀")
         st.balloons()
     else:
@@ -28,16 +62,81 @@ def _submit_recommendation() -> None:
 
 
 def _show_recommendation() -> None:
-    if not st.session_state.get("similar_issues", None):
-        _get_similar_issues()
-    open_ai_client = get_open_ai_client()
-    st.session_state.recommendation_text = get_suggested_recommendation(
-        open_ai_client, prompt=st.session_state.issue_description, similar_issues=st.session_state["similar_issues"]
+    st.session_state.show_similar = True
+    st.session_state.generate_requested = True
+    get_search_orchestrator().submit(st.session_state.issue_description, scopes=_search_scopes())
+
+
+def _cancel_generation() -> None:
+    if (cancel_event := st.session_state.get("cancel_generation")) is not None:
+        cancel_event.set()
+
+
+def _start_recommendation(similar_issues: list[SimilarIssue]) -> tuple[Iterator[str], GenerationTiming]:
+    cancel_event = st.session_state.cancel_generation = threading.Event()
+    timing = st.session_state.generation_timing = GenerationTiming()
+    st.session_state.recommendation_issue_ids = [i.id for i in similar_issues]
+    tokens = stream_suggested_recommendation(
+        get_open_ai_client(),
+        prompt=st.session_state.issue_description,
+        similar_issues=similar_issues,
+        cache=get_completion_cache(),
+        cancel_event=cancel_event,
+        timing=timing,
     )
+    # Generation runs in the background while the rest of the page (e.g. the sidebar) renders
+    return prefetch(tokens, get_orchestrator_executor()), timing
+
+
+def _stream_recommendation(tokens: Iterator[str], timing: GenerationTiming) -> None:
+    placeholder = st.empty()
+    try:
+        recommendation = placeholder.write_stream(tokens)
+    except LLMUnavailableError:
+        placeholder.warning("No recommendation could be generated in time, see the similar issues instead", icon="⏱️")
+        st.session_state.recommendation_text = ""
+        return
+    finally:
+        # Stops the background generation when this script run is interrupted by a rerun
+        _cancel_generation()
+    placeholder.empty()
+    if not timing.cancelled:
+        st.session_state.recommendation_text = recommendation
+
+
+def _telemetry_panel(turbine: str) -> bool:
+    """The turbine's SCADA signals over a time window, or False if it has none."""
+    if (extent := scada_extent(turbine)) is None:
+        return False
+    channels = scada_channels(turbine)
+    selected = st.multiselect(
+        "Signals",
+        channels,
+        default=channels[:SCADA_MAX_CHANNELS],
+        max_selections=SCADA_MAX_CHANNELS,
+        key=f"scada_channels_{turbine}",
+    )
+    # Narrowing the window (zooming in) only reads that range, downsampled to the same number of points
+    window = st.slider(
+        "Time window",
+        min_value=extent[0],
+        max_value=extent[1],
+        value=extent,
+        step=window_step(extent),
+        key=f"scada_window_{turbine}",
+    )
+    if (figure := scada_figure(turbine, *window, tuple(selected))) is not None:
+        st.plotly_chart(figure, use_container_width=True)
+    return True
 
 
 TITLE = "🛠️🔍 Engineering Recommendation Helper"
 
+start_exporters()
+# Imports the heavy modules, creates the clients and searches once in the background, while the page renders
+start_warmup()
+start_ingestion_writer()
+
 if "sidebar_state" not in st.session_state:
     st.session_state.sidebar_state = "collapsed"
 
@@ -54,34 +153,61 @@ for i in CUSTOM_STYLES_TO_APPLY:
 st.title(TITLE)
 
 
+@st.cache_data(ttl=3600, show_spinner=False)
+def _load_original_body(issue_id: float) -> str:
+    original = fetch_originals(get_vector_searcher(), [issue_id]).get(issue_id, "")
+    # The first line of the original markdown is the title, shown separately
+    return original.partition("\n")[2] if original.startswith("#") else original
+
+
 @st.dialog("Full Issue Details", width="large")
 def _issue_popup(_issue: SimilarIssue) -> None:
-    title, content = _issue.original.split("\n", maxsplit=1)
-    st.title(title.lstrip("# "))
-    annotated_text(_issue.get_tags())
-    st.markdown(content)
+    from annotated_text import annotated_text
+
+    st.title(_issue.display_title)
+    annotated_text(_issue.tags)
+    with st.spinner("Loading the issue..."):
+        st.markdown(_load_original_body(_issue.id))
 
 
+similar_issues: list[SimilarIssue] = []
+if st.session_state.get("show_similar", False):
+    with st.spinner("Searching for similar issues..."):
+        # Reuses the search started speculatively, or by a previous rerun, for the current description
+        similar_issues = get_search_orchestrator().search(st.session_state.issue_description, scopes=_search_scopes())
+
+recommendation_stream = None
+if st.session_state.pop("generate_requested", False):
+    recommendation_stream = _start_recommendation(similar_issues)
+
 with st.sidebar:
-    if st.session_state.get("similar_issues", None):
+    if similar_issues:
         st.title("Similar Issues")
-        for _issue in st.session_state.similar_issues:
-            _issue_title = _issue.original.split("\n")[0].lstrip("# ")
-            with st.expander(_issue_title, expanded=True):
+        for _issue in similar_issues:
+            with st.expander(_issue.display_title, expanded=True):
                 st.write(_issue.summary)
-                if st.button(label=":eye: view details", key=_issue.id):
+                if st.button(label=":eye: view details", key=str(_issue.id)):
                     _issue_popup(_issue)
 
+alert_turbine = st.query_params.get("turbine")
 with st.container(border=True):
-    st.markdown("A new issue has been detected on Turbine 1. Please provide a recommendation.")
-    st.plotly_chart(mock_chart(), use_container_width=True)
-
-st.text_area("Issue Description", height=100, key="issue_description", value="E.g. Pitch hydraulic oil issue")
+    st.markdown(f"A new issue has been detected on {alert_turbine or 'Turbine 1'}. Please provide a recommendation.")
+    if not alert_turbine or not _telemetry_panel(alert_turbine):
+        st.plotly_chart(mock_chart(), use_container_width=True)
+
+st.text_area(
+    "Issue Description",
+    height=100,
+    key="issue_description",
+    value="E.g. Pitch hydraulic oil issue",
+    on_change=_on_description_change,
+)
 
 col1, col2 = st.columns(2)
 col1.button("Search similar issues", on_click=_show_similar)
-gen_rec = col2.button("Generate recommendation", on_click=_show_recommendation)
+col2.button("Generate recommendation", on_click=_show_recommendation)
 
-if gen_rec:
+if recommendation_stream is not None:
+    _stream_recommendation(*recommendation_stream)
     st.text_area("Engineer Recommendation", height=100, key="recommendation_text")
     st.button("Submit recommendation", on_click=_submit_recommendation)
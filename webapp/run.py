@@ -0,0 +1,71 @@
+"""Entry point of the Databricks App, serving the Streamlit UI, the HTTP API (`api.py`) or both, per `APP_MODE`."""
+
+import asyncio
+import contextlib
+import logging
+import os
+import signal
+import subprocess
+import sys
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+APP_MODE = os.getenv("APP_MODE", "streamlit")
+APP_PORT = int(os.getenv("DATABRICKS_APP_PORT", 8000))
+# Local ports of the API and the UI when they run together, behind the proxy that keeps the app port (`src/proxy.py`)
+API_PORT = int(os.getenv("API_PORT", 8001))
+STREAMLIT_PORT = int(os.getenv("STREAMLIT_PORT", 8501))
+CHILD_STOP_TIMEOUT_SECONDS = 10.0
+
+
+def _stop_children(children: list[subprocess.Popen]) -> None:
+    for child in children:
+        if child.poll() is None:
+            child.terminate()
+    for child in children:
+        try:
+            child.wait(timeout=CHILD_STOP_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            child.kill()
+            child.wait()
+
+
+async def _serve_both() -> int:
+    """Serves the proxy until SIGTERM (or SIGINT), or until the API or the UI exits, then stops both."""
+    from src.proxy import make_proxy
+
+    children = [
+        subprocess.Popen([sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(API_PORT)]),
+        subprocess.Popen(
+            ["streamlit", "run", "main.py", "--server.address", "127.0.0.1", "--server.port", str(STREAMLIT_PORT)]
+        ),
+    ]
+    stop = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+    server = make_proxy(f"http://127.0.0.1:{API_PORT}", f"http://127.0.0.1:{STREAMLIT_PORT}").listen(APP_PORT)
+    logger.info(f"Serving the UI and the API (under /api) on port {APP_PORT}")
+    try:
+        while not stop.is_set() and all(child.poll() is None for child in children):
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(stop.wait(), timeout=1)
+    finally:
+        server.stop()
+        _stop_children(children)
+    if stop.is_set():
+        return 0
+    # So that the platform restarts the app
+    logger.error("The API or the UI exited, stopping the app")
+    return 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if APP_MODE == "api":
+        uvicorn.run("api:app", host="0.0.0.0", port=APP_PORT)
+    elif APP_MODE == "both":
+        sys.exit(asyncio.run(_serve_both()))
+    else:
+        os.execvp("streamlit", ["streamlit", "run", "main.py"])
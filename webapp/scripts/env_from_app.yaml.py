@@ -15,5 +15,5 @@ if __name__ == "__main__":
             f.write(f"{env_spec['name']}={env_spec['value']}\n")
 
         f.write("\n\n")
-        f.write("DEBUG=1\n")
+        f.write("VECTOR_SEARCH_BACKEND=mock\n")
         f.write("DATABRICKS_CONFIG_PROFILE=dev-eng-rec-helper\n")
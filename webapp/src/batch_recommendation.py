@@ -0,0 +1,301 @@
+"""Batch recommendations for alert backlogs.
+
+Usage (from the webapp directory):
+    python -m src.batch_recommendation --input alerts.parquet --output recommendations.parquet
+    python -m src.batch_recommendation --input-table workspace.default.scada_alerts \\
+        --output-table workspace.default.alert_recommendations --staging-dir /Volumes/workspace/default/eng_rec/batch
+
+Inputs need a `Description` column and may have an `Id` column (the row number is used otherwise). Tables are read
+and written through the SQL warehouse `DATABRICKS_WAREHOUSE_ID`; the output table is appended to with `COPY INTO`
+from a Parquet file staged in a Unity Catalog volume.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import time
+import uuid
+from collections.abc import Callable, Iterator, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from databricks.sdk import WorkspaceClient
+from databricks.sdk.service.sql import StatementResponse, StatementState
+from openai import OpenAI
+
+from src.completion_cache import CompletionCache
+from src.rec_suggestion import get_suggested_recommendation
+from src.vector_search import N_SIMILAR_ISSUES, SimilarIssue, SimilarIssueSearcher, issue_ids
+
+logger = logging.getLogger(__name__)
+
+SEARCH_BATCH_SIZE = 32
+MAX_CONCURRENCY = 8
+STATEMENT_POLL_SECONDS = 5
+
+
+@dataclass
+class BatchItem:
+    id: str
+    description: str
+
+
+@dataclass
+class BatchResult:
+    id: str
+    description: str
+    recommendation: str | None = None
+    similar_issue_ids: list[float] = field(default_factory=list)
+    status: str = "ok"
+    error: str | None = None
+    search_s: float | None = None
+    generation_s: float | None = None
+
+
+@dataclass
+class BatchReport:
+    n_items: int
+    n_failed: int
+    wall_s: float
+    items_per_s: float
+    search_p50_s: float | None
+    search_p95_s: float | None
+    generation_p50_s: float | None
+    generation_p95_s: float | None
+    failures: dict[str, str]
+
+    @classmethod
+    def from_results(cls, results: Sequence[BatchResult], wall_s: float) -> "BatchReport":
+        def _percentile(values: list[float | None], q: int) -> float | None:
+            _values = [v for v in values if v is not None]
+            return float(np.percentile(_values, q)) if _values else None
+
+        search_s, generation_s = [r.search_s for r in results], [r.generation_s for r in results]
+        failures = {r.id: f"{r.status}: {r.error}" for r in results if r.status != "ok"}
+        return cls(
+            n_items=len(results),
+            n_failed=len(failures),
+            wall_s=wall_s,
+            items_per_s=len(results) / wall_s if wall_s else 0.0,
+            search_p50_s=_percentile(search_s, 50),
+            search_p95_s=_percentile(search_s, 95),
+            generation_p50_s=_percentile(generation_s, 50),
+            generation_p95_s=_percentile(generation_s, 95),
+            failures=failures,
+        )
+
+
+def _search_chunk(
+    searcher: SimilarIssueSearcher, chunk: Sequence[BatchItem], num_results: int, executor: ThreadPoolExecutor
+) -> list[Sequence[SimilarIssue] | Exception]:
+    """Searches a chunk in one `search_batch` call when the searcher has one, or concurrently otherwise.
+
+    A failed batch is retried item by item, so that one bad description only fails its own item.
+    """
+    if (search_batch := getattr(searcher, "search_batch", None)) is not None:
+        try:
+            return search_batch([i.description for i in chunk], num_results=num_results)
+        except Exception:
+            logger.exception(f"Batch search of {len(chunk)} items failed, retrying them one by one")
+
+    def _search(item: BatchItem) -> Sequence[SimilarIssue] | Exception:
+        try:
+            return searcher.search(item.description, num_results=num_results)
+        except Exception as e:
+            return e
+
+    return list(executor.map(_search, chunk))
+
+
+def _generate(
+    open_ai_client: OpenAI, result: BatchResult, similar_issues: Sequence[SimilarIssue], cache: CompletionCache | None
+) -> BatchResult:
+    start = time.perf_counter()
+    try:
+        result.recommendation = get_suggested_recommendation(
+            open_ai_client, result.description, similar_issues, cache=cache
+        )
+    except Exception as e:
+        result.status, result.error = "generation_failed", f"{type(e).__name__}: {e}"
+    result.generation_s = time.perf_counter() - start
+    return result
+
+
+def recommend_batch(
+    items: Sequence[BatchItem],
+    searcher: SimilarIssueSearcher,
+    open_ai_client: OpenAI,
+    cache: CompletionCache | None = None,
+    num_results: int = N_SIMILAR_ISSUES,
+    search_batch_size: int = SEARCH_BATCH_SIZE,
+    max_concurrency: int = MAX_CONCURRENCY,
+) -> Iterator[BatchResult]:
+    """Yields the recommendation of every item, in order, failed items included (with their `status` and `error`).
+
+    Searches run by chunks of `search_batch_size` while the recommendations of the previous chunks are generated,
+    with at most `max_concurrency` LLM calls (and searches) in flight.
+    """
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="batch-recommendation") as executor:
+        futures: list[Future[BatchResult]] = []
+        for start in range(0, len(items), search_batch_size):
+            chunk = items[start : start + search_batch_size]
+            search_start = time.perf_counter()
+            searched = _search_chunk(searcher, chunk, num_results=num_results, executor=executor)
+            search_s = (time.perf_counter() - search_start) / len(chunk)
+            for item, similar_issues in zip(chunk, searched):
+                result = BatchResult(id=item.id, description=item.description, search_s=search_s)
+                if isinstance(similar_issues, Exception):
+                    result.status, result.error = "search_failed", f"{type(similar_issues).__name__}: {similar_issues}"
+                    future: Future[BatchResult] = Future()
+                    future.set_result(result)
+                else:
+                    result.similar_issue_ids = issue_ids(similar_issues)
+                    future = executor.submit(_generate, open_ai_client, result, similar_issues, cache)
+                futures.append(future)
+
+            # Yield what is already done, without waiting for the chunk being generated
+            while futures and futures[0].done():
+                yield futures.pop(0).result()
+        for future in futures:
+            yield future.result()
+
+
+def execute_sql(workspace_client: WorkspaceClient, statement: str) -> StatementResponse:
+    warehouse_id = os.environ["DATABRICKS_WAREHOUSE_ID"]
+    response = workspace_client.statement_execution.execute_statement(
+        statement, warehouse_id=warehouse_id, wait_timeout="30s"
+    )
+    while response.status is not None and response.status.state in (StatementState.PENDING, StatementState.RUNNING):
+        time.sleep(STATEMENT_POLL_SECONDS)
+        assert response.statement_id is not None  # mypy fix
+        response = workspace_client.statement_execution.get_statement(response.statement_id)
+    if response.status is None or response.status.state != StatementState.SUCCEEDED:
+        raise RuntimeError(f"Statement failed: {response.status}")
+    return response
+
+
+def read_statement_chunks(workspace_client: WorkspaceClient, statement: str) -> Iterator[pd.DataFrame]:
+    """The result of a query, chunk by chunk as the warehouse returns it (the values come back as strings)."""
+    response = execute_sql(workspace_client, statement)
+    assert response.statement_id is not None and response.manifest is not None  # mypy fix
+    assert response.manifest.schema is not None  # mypy fix
+    columns = [c.name for c in response.manifest.schema.columns or []]
+    chunk = response.result
+    while chunk is not None:
+        yield pd.DataFrame(chunk.data_array or [], columns=columns)
+        if chunk.next_chunk_index is None:
+            break
+        chunk = workspace_client.statement_execution.get_statement_result_chunk_n(
+            response.statement_id, chunk.next_chunk_index
+        )
+
+
+def read_items(
+    input_path: Path | None = None, input_table: str | None = None, workspace_client: WorkspaceClient | None = None
+) -> list[BatchItem]:
+    if input_table is not None:
+        assert workspace_client is not None, "Reading a table needs a workspace client"
+        df = pd.concat(list(read_statement_chunks(workspace_client, f"SELECT * FROM {input_table}")), ignore_index=True)
+    elif input_path is not None:
+        readers: dict[str, Callable[[Path], pd.DataFrame]] = {
+            ".parquet": pd.read_parquet,
+            ".csv": pd.read_csv,
+            ".jsonl": lambda p: pd.read_json(p, lines=True),
+        }
+        df = readers[input_path.suffix](input_path)
+    else:
+        raise ValueError("Either an input file or an input table is needed")
+
+    ids = df["Id"] if "Id" in df.columns else pd.Series(range(len(df)))
+    return [BatchItem(id=str(i), description=str(d)) for i, d in zip(ids, df["Description"]) if pd.notna(d)]
+
+
+def _results_to_df(results: Sequence[BatchResult]) -> pd.DataFrame:
+    df = pd.DataFrame([asdict(r) for r in results])
+    df.columns = ["".join(p.title() for p in c.split("_")) for c in df.columns]
+    return df.assign(CreatedAt=pd.Timestamp.now(tz="UTC"))
+
+
+def write_results(
+    results: Sequence[BatchResult],
+    output_path: Path | None = None,
+    output_table: str | None = None,
+    staging_dir: str | None = None,
+    workspace_client: WorkspaceClient | None = None,
+) -> None:
+    df = _results_to_df(results)
+    if output_path is not None:
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(output_path)
+        logger.info(f"Wrote {len(df)} recommendations to {output_path}")
+    if output_table is not None:
+        assert workspace_client is not None and staging_dir, "Writing a table needs a workspace client and a volume"
+        staged_file = f"{staging_dir.rstrip('/')}/{uuid.uuid4().hex}.parquet"
+        buffer = io.BytesIO()
+        df.to_parquet(buffer)
+        buffer.seek(0)
+        workspace_client.files.upload(staged_file, buffer, overwrite=True)
+        execute_sql(workspace_client, f"CREATE TABLE IF NOT EXISTS {output_table}")
+        execute_sql(
+            workspace_client,
+            f"COPY INTO {output_table} FROM '{staged_file}' FILEFORMAT = PARQUET COPY_OPTIONS ('mergeSchema' = 'true')",
+        )
+        workspace_client.files.delete(staged_file)
+        logger.info(f"Appended {len(df)} recommendations to {output_table}")
+
+
+def main() -> None:
+    from src.resources import get_completion_cache, get_open_ai_client, get_workspace_client
+    from src.vector_search import get_vector_searcher
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", type=Path, help="Parquet, CSV or JSON lines file")
+    source.add_argument("--input-table")
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--output-table")
+    parser.add_argument("--staging-dir", help="Unity Catalog volume directory to stage the output table files in")
+    parser.add_argument("--report", type=Path, help="Writes the throughput and failures report as JSON")
+    parser.add_argument("--num-results", type=int, default=N_SIMILAR_ISSUES)
+    parser.add_argument("--search-batch-size", type=int, default=SEARCH_BATCH_SIZE)
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY)
+    args = parser.parse_args()
+    if args.output is None and args.output_table is None:
+        parser.error("One of --output or --output-table is needed")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    workspace_client = get_workspace_client() if args.input_table or args.output_table else None
+    items = read_items(args.input, args.input_table, workspace_client=workspace_client)
+    logger.info(f"Generating recommendations for {len(items)} issues")
+
+    start = time.perf_counter()
+    results = []
+    for result in recommend_batch(
+        items,
+        get_vector_searcher(),
+        get_open_ai_client(),
+        cache=get_completion_cache(),
+        num_results=args.num_results,
+        search_batch_size=args.search_batch_size,
+        max_concurrency=args.max_concurrency,
+    ):
+        results.append(result)
+        if result.status != "ok":
+            logger.warning(f"Issue {result.id} failed ({result.status}): {result.error}")
+    report = BatchReport.from_results(results, wall_s=time.perf_counter() - start)
+
+    write_results(results, args.output, args.output_table, args.staging_dir, workspace_client=workspace_client)
+    logger.info(
+        f"{report.n_items} issues in {report.wall_s:.1f}s ({report.items_per_s:.2f} issues/s), {report.n_failed} failed"
+    )
+    if args.report is not None:
+        args.report.write_text(json.dumps(asdict(report), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+from collections.abc import Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+
+from src.search_cache import normalize_query
+from src.telemetry import increment
+from src.vector_search import N_SIMILAR_ISSUES, Filters, SimilarIssue, SimilarIssueSearcher, filters_key
+
+logger = logging.getLogger(__name__)
+
+BatchSearch = Callable[..., list[Sequence[SimilarIssue]]]
+
+
+def _batch_search(searcher: SimilarIssueSearcher) -> BatchSearch | None:
+    """`search_batch` of the searcher, if it (or the backend behind its cache) can search several queries at once."""
+    backend = getattr(searcher, "searcher", searcher)
+    if getattr(backend, "search_batch", None) is None:
+        return None
+    return getattr(searcher, "search_batch", None)
+
+
+class SearchBatcher:
+    """Coalesces the searches of concurrent requests into batches, for the async API.
+
+    Requests arriving within `max_wait_seconds` of each other (up to `max_batch_size`) share one `search_batch` call
+    when the backend supports it, e.g. one embedding round trip for the local index. Otherwise each distinct query is
+    searched on its own thread. Either way, identical (normalized) queries of a batch are searched once.
+    """
+
+    def __init__(
+        self,
+        searcher: SimilarIssueSearcher,
+        executor: ThreadPoolExecutor,
+        max_batch_size: int = 32,
+        max_wait_seconds: float = 0.005,
+    ):
+        self.searcher = searcher
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self._search_batch = _batch_search(searcher)
+        self._pending: list[tuple[str, int, Filters | None, asyncio.Future[Sequence[SimilarIssue]]]] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def search(
+        self, query: str, num_results: int = N_SIMILAR_ISSUES, filters: Filters | None = None
+    ) -> Sequence[SimilarIssue]:
+        # Only ever touched from the event loop thread, so no locking is needed
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[Sequence[SimilarIssue]] = loop.create_future()
+        self._pending.append((query, num_results, filters, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait_seconds, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, []
+        increment("api.search_batches")
+        increment("api.searches", len(pending))
+
+        # Only searches with the same parameters can share a batch
+        batches: dict[tuple, dict[str, list[tuple[str, asyncio.Future[Sequence[SimilarIssue]]]]]] = {}
+        filters_by_key: dict[tuple, Filters | None] = {}
+        for query, num_results, filters, future in pending:
+            batch_key = (num_results, filters_key(filters))
+            filters_by_key[batch_key] = filters
+            batches.setdefault(batch_key, {}).setdefault(normalize_query(query), []).append((query, future))
+        for batch_key, by_query in batches.items():
+            groups = [list(by_query.values())] if self._search_batch is not None else [[w] for w in by_query.values()]
+            for group in groups:
+                task = asyncio.ensure_future(self._run_batch(group, batch_key[0], filters_by_key[batch_key]))
+                # The event loop only keeps weak references to tasks
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(
+        self,
+        waiters: Sequence[list[tuple[str, asyncio.Future[Sequence[SimilarIssue]]]]],
+        num_results: int,
+        filters: Filters | None,
+    ) -> None:
+        queries = [w[0][0] for w in waiters]
+        loop = asyncio.get_running_loop()
+        try:
+            if self._search_batch is not None:
+                search_batch = self._search_batch
+                results = await loop.run_in_executor(
+                    self.executor, lambda: search_batch(queries, num_results=num_results, filters=filters)
+                )
+            else:
+                results = [
+                    await loop.run_in_executor(
+                        self.executor,
+                        lambda: self.searcher.search(queries[0], num_results=num_results, filters=filters),
+                    )
+                ]
+        except Exception as e:
+            logger.exception(f"Search of a batch of {len(queries)} queries failed")
+            for _, future in (w for ws in waiters for w in ws):
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for _waiters, _results in zip(waiters, results):
+            for _, future in _waiters:
+                if not future.done():
+                    future.set_result(_results)
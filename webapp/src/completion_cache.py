@@ -0,0 +1,184 @@
+"""Persistent, content-addressed cache for deterministic LLM completions.
+
+This module is kept identical in `data-processing/notebooks` and `webapp/src` (checked by the tests), so that the
+batch job and the webapp can share a cache through a snapshot of it on a volume (see `SQLiteCompletionCache.sync`).
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from collections.abc import Mapping, Sequence
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Protocol
+
+
+def completion_cache_key(
+    model: str,
+    messages: Sequence[Mapping[str, Any]],
+    response_schema: Mapping[str, Any] | None = None,
+    temperature: float = 0.0,
+    **params: Any,
+) -> str:
+    """Hashes everything that determines a (temperature 0) completion: model, prompt, response schema and params."""
+    params = {"temperature": temperature, **params}
+    payload = {"model": model, "messages": list(messages), "response_schema": response_schema, "params": params}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    writes: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class CompletionCache(Protocol):
+    stats: CacheStats
+
+    def get(self, key: str) -> str | None: ...
+
+    def set(self, key: str, value: str) -> None: ...
+
+
+class SQLiteCompletionCache:
+    """Completion cache stored in a single SQLite file, with TTL and least-recently-used size eviction.
+
+    Connections are per thread, so the cache can be shared by the executor's workers and Streamlit sessions alike.
+    `bypass=True` turns every lookup into a miss and skips writes, to force fresh completions.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        max_entries: int | None = 100_000,
+        ttl_seconds: float | None = 30 * 24 * 3600,
+        bypass: bool = False,
+        evict_every: int = 100,
+    ):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.bypass = bypass
+        self.evict_every = evict_every
+        self.stats = CacheStats()
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS completions_accessed_at ON completions (accessed_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, stat: str, n: int = 1) -> int:
+        with self._stats_lock:
+            setattr(self.stats, stat, getattr(self.stats, stat) + n)
+            return getattr(self.stats, stat)
+
+    def get(self, key: str) -> str | None:
+        if self.bypass:
+            self._count("misses")
+            return None
+
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute("SELECT value, created_at FROM completions WHERE key = ?", (key,)).fetchone()
+        if row is None or (self.ttl_seconds is not None and now - row[1] > self.ttl_seconds):
+            self._count("misses")
+            return None
+
+        conn.execute("UPDATE completions SET accessed_at = ? WHERE key = ?", (now, key))
+        self._count("hits")
+        return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        if self.bypass:
+            return
+
+        now = time.time()
+        self._connection().execute(
+            "INSERT OR REPLACE INTO completions (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, value, now, now),
+        )
+        if self._count("writes") % self.evict_every == 0:
+            self.evict()
+
+    def evict(self) -> int:
+        """Drops expired entries, then the least recently used ones above `max_entries`."""
+        conn = self._connection()
+        evicted = 0
+        if self.ttl_seconds is not None:
+            evicted += conn.execute(
+                "DELETE FROM completions WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+            ).rowcount
+        if self.max_entries is not None:
+            evicted += conn.execute(
+                "DELETE FROM completions WHERE key IN "
+                "(SELECT key FROM completions ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+        self._count("evictions", evicted)
+        return evicted
+
+    def sync(self, snapshot: str | Path) -> int:
+        """Adds the entries of a snapshot (e.g. written by another process) that are missing here, then replaces the
+        snapshot with the merged cache. Returns the number of entries added.
+
+        The snapshot is only ever copied whole, so it can be on a Unity Catalog volume, which does not support the
+        random writes, shared memory and locks of SQLite: the cache itself must stay on local disk.
+        """
+        if self.bypass:
+            return 0
+        snapshot = Path(snapshot)
+        staging = self.path.with_name(f"{self.path.name}.{os.getpid()}.{threading.get_ident()}.snapshot")
+        conn = self._connection()
+        added = 0
+        try:
+            if snapshot.exists():
+                shutil.copyfile(snapshot, staging)
+                conn.execute("ATTACH DATABASE ? AS snapshot", (str(staging),))
+                try:
+                    added = conn.execute(
+                        "INSERT OR IGNORE INTO completions (key, value, created_at, accessed_at) "
+                        "SELECT key, value, created_at, accessed_at FROM snapshot.completions"
+                    ).rowcount
+                finally:
+                    conn.execute("DETACH DATABASE snapshot")
+                staging.unlink()
+            target = sqlite3.connect(staging)
+            try:
+                conn.backup(target)
+            finally:
+                target.close()
+            snapshot.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(staging, snapshot)
+        finally:
+            staging.unlink(missing_ok=True)
+        return added
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
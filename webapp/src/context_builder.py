@@ -0,0 +1,99 @@
+import logging
+import os
+import re
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+
+from src.vector_search import SimilarIssue
+
+logger = logging.getLogger(__name__)
+
+PROMPT_CONTEXT_TOKEN_BUDGET = int(os.getenv("PROMPT_CONTEXT_TOKEN_BUDGET", 1500))
+SUMMARY_SECTIONS = ("Symptoms", "Recommendation", "Resolution")
+DUPLICATE_SIMILARITY = 0.9
+MIN_TRUNCATED_TOKENS = 32
+ISSUE_SEPARATOR = "\n\n"
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count (~4 characters per token for English text with Llama-style tokenizers), rounded up so
+    that the estimates of the parts of a text add up to at least the estimate of the whole."""
+    return (len(text) + 3) // 4
+
+
+def parse_summary(summary: str) -> dict[str, str]:
+    """Splits a summary written by the summarization job (`### Symptoms:\\n...`) into its sections."""
+    sections = re.split(r"^###\s*(\w+):\s*$", summary, flags=re.MULTILINE)
+    return {k.title(): v.strip() for k, v in zip(sections[1::2], sections[2::2])}
+
+
+def _shingles(text: str, size: int = 3) -> set[tuple[str, ...]]:
+    words = re.findall(r"\w+", text.casefold())
+    return {tuple(words[i : i + size]) for i in range(max(1, len(words) - size + 1))}
+
+
+def _jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+@dataclass
+class PackedContext:
+    text: str
+    tokens: int
+    token_budget: int
+    issue_ids: list[float] = field(default_factory=list)
+    n_duplicates: int = 0
+    n_truncated: int = 0
+    n_dropped: int = 0
+
+
+def _render_issue(issue: SimilarIssue, sections: Sequence[str]) -> str:
+    title = issue.display_title
+    parsed = parse_summary(issue.summary)
+    body = "\n".join(f"{k}: {parsed[k]}" for k in sections if parsed.get(k)) or issue.summary
+    return f"Title: {title}\n{body}"
+
+
+def build_context(
+    similar_issues: Sequence[SimilarIssue],
+    token_budget: int = PROMPT_CONTEXT_TOKEN_BUDGET,
+    sections: Sequence[str] = SUMMARY_SECTIONS,
+    duplicate_similarity: float = DUPLICATE_SIMILARITY,
+) -> PackedContext:
+    """Packs the most similar issues into at most `token_budget` tokens of prompt context.
+
+    Only the title and the summary sections are used (never the full original markdown or the metadata), issues
+    are taken by decreasing score, near-duplicates of an already packed issue are skipped, and the last issue that
+    does not fit is truncated if enough budget is left.
+    """
+    packed = PackedContext(text="", tokens=0, token_budget=token_budget)
+    blocks: list[str] = []
+    kept_shingles: list[set] = []
+    for issue in sorted(similar_issues, key=lambda i: i.score, reverse=True):
+        shingles = _shingles(issue.summary)
+        if any(_jaccard(shingles, i) >= duplicate_similarity for i in kept_shingles):
+            packed.n_duplicates += 1
+            continue
+
+        block = f"## Issue {len(blocks) + 1}:\n{_render_issue(issue, sections)}"
+        separator_tokens = estimate_tokens(ISSUE_SEPARATOR) if blocks else 0
+        remaining = token_budget - packed.tokens - separator_tokens
+        if estimate_tokens(block) > remaining:
+            if remaining < MIN_TRUNCATED_TOKENS:
+                packed.n_dropped += 1
+                continue
+            block = block[: (remaining - 1) * 4].rsplit(" ", maxsplit=1)[0] + " ..."
+            packed.n_truncated += 1
+
+        blocks.append(block)
+        kept_shingles.append(shingles)
+        packed.issue_ids.append(issue.id)
+        packed.tokens += separator_tokens + estimate_tokens(block)
+
+    packed.text = ISSUE_SEPARATOR.join(blocks)
+    packed.tokens = estimate_tokens(packed.text)
+    logger.info(
+        f"Packed {len(blocks)} of {len(similar_issues)} similar issues into {packed.tokens}/{token_budget} tokens "
+        f"({packed.n_duplicates} duplicates, {packed.n_truncated} truncated, {packed.n_dropped} dropped)"
+    )
+    return packed
@@ -1,11 +1,20 @@
+from collections.abc import Sequence
+from typing import TYPE_CHECKING
+
 import numpy as np
-import plotly
-from plotly import figure_factory as ff
+import streamlit as st
+
+from src.vector_search import N_SIMILAR_ISSUES, TABLE_COLS, Filters, SimilarIssue
 
-from src.vector_search import SimilarIssue
+if TYPE_CHECKING:
+    import plotly
 
 
-def mock_chart() -> plotly.graph_objs.Figure:
+@st.cache_data(show_spinner=False)
+def mock_chart() -> "plotly.graph_objs.Figure":
+    # figure_factory takes seconds to import
+    from plotly import figure_factory as ff
+
     np.random.seed(42)
 
     x1 = np.random.randn(200) - 2
@@ -52,5 +61,14 @@ SAMPLE_SEARCH_RESULTS = [
 
 
 class MockVectorSearcher:
-    def search(self, query: str, num_results: int = 5) -> list[SimilarIssue]:
+    def search(
+        self,
+        query: str,
+        cols: Sequence[str] = TABLE_COLS,
+        num_results: int = N_SIMILAR_ISSUES,
+        filters: Filters | None = None,
+    ) -> list[SimilarIssue]:
         return SAMPLE_SEARCH_RESULTS
+
+    def fetch_originals(self, ids: Sequence[float]) -> dict[float, str]:
+        return {i.id: i.original for i in SAMPLE_SEARCH_RESULTS if i.id in ids and i.original is not None}
@@ -0,0 +1,361 @@
+"""Hybrid retrieval: BM25 over the issue text fused with the vector search results, then optionally re-ranked.
+
+Lexical matching recovers what embeddings blur: alarm codes, component names and censored tokens (e.g. `TURBINE/S`).
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from collections.abc import Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Protocol
+
+import numpy as np
+import pandas as pd
+
+from src.local_index import METADATA_FILE, resolve_snapshot
+from src.telemetry import increment, span
+from src.vector_search import (
+    N_SIMILAR_ISSUES,
+    TABLE_COLS,
+    DegradedResults,
+    Filters,
+    IssueRecords,
+    SimilarIssue,
+    SimilarIssueSearcher,
+    fetch_originals,
+    is_degraded,
+    issue_fields,
+    issue_ids,
+)
+
+logger = logging.getLogger(__name__)
+
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 20))
+HYBRID_VECTOR_BUDGET_SECONDS = float(os.getenv("HYBRID_VECTOR_BUDGET_SECONDS", 2.0))
+HYBRID_RERANK_BUDGET_SECONDS = float(os.getenv("HYBRID_RERANK_BUDGET_SECONDS", 0.05))
+# How often the searches check the vector index's version, for the lexical index to follow it without a search cache
+HYBRID_VERSION_POLL_SECONDS = float(os.getenv("HYBRID_VERSION_POLL_SECONDS", 60))
+RRF_K = 60
+TEXT_COLS = ("Original", "Summary")
+
+# Keeps codes and censored tokens whole: "E-1023", "TURBINE/S", "T29"
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[/_-][a-z0-9]+)*")
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.casefold())
+
+
+class BM25Index:
+    """Okapi BM25 over an in-memory inverted index, stored as flat postings arrays."""
+
+    def __init__(self, documents: Sequence[str], k1: float = 1.2, b: float = 0.75):
+        self.k1, self.b = k1, b
+        self.vocabulary: dict[str, int] = {}
+        postings: list[list[tuple[int, int]]] = []
+        doc_lengths = np.zeros(len(documents), dtype=np.float32)
+        for doc_id, document in enumerate(documents):
+            tokens = tokenize(document)
+            doc_lengths[doc_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                if (term_id := self.vocabulary.get(term)) is None:
+                    term_id = self.vocabulary[term] = len(postings)
+                    postings.append([])
+                postings[term_id].append((doc_id, tf))
+
+        self.offsets = np.cumsum([0, *(len(p) for p in postings)]).astype(np.int64)
+        self.doc_ids = np.fromiter((d for p in postings for d, _ in p), dtype=np.int64, count=self.offsets[-1])
+        term_freqs = np.fromiter((tf for p in postings for _, tf in p), dtype=np.float32, count=self.offsets[-1])
+        # The BM25 term weights only depend on the document, so they are computed once here, not per query
+        norms = k1 * (1 - b + b * doc_lengths / max(float(doc_lengths.mean()) if len(documents) else 0.0, 1e-6))
+        self.weights = term_freqs * (k1 + 1) / (term_freqs + norms[self.doc_ids])
+        n_docs = len(documents)
+        doc_freqs = np.diff(self.offsets)
+        self.idf = np.log(1 + (n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+        self.n_docs = n_docs
+
+    def search(self, query: str, k: int, rows: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """Top-k (scores, row numbers) of the documents matching at least one query term, among `rows` if given."""
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for term in set(tokenize(query)):
+            if (term_id := self.vocabulary.get(term)) is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            scores[self.doc_ids[start:end]] += self.idf[term_id] * self.weights[start:end]
+        matches = np.flatnonzero(scores) if rows is None else rows[scores[rows] > 0]
+        if len(matches) > k:
+            matches = matches[np.argpartition(-scores[matches], k - 1)[:k]]
+        order = np.argsort(-scores[matches], kind="stable")
+        return scores[matches][order], matches[order]
+
+
+class Reranker(Protocol):
+    def rerank(
+        self, query: str, issues: list[SimilarIssue], texts: list[str], deadline: float
+    ) -> list[SimilarIssue]: ...
+
+
+class HeuristicReranker:
+    """Boosts candidates containing the query's codes (tokens with digits, `/` or `-`) and covering its terms.
+
+    Candidates not scored before `deadline` (a `time.perf_counter()` value) keep their fused score.
+    """
+
+    def __init__(self, code_weight: float = 0.5, coverage_weight: float = 0.3):
+        self.code_weight = code_weight
+        self.coverage_weight = coverage_weight
+
+    def rerank(self, query: str, issues: list[SimilarIssue], texts: list[str], deadline: float) -> list[SimilarIssue]:
+        query_terms = set(tokenize(query))
+        codes = {t for t in query_terms if re.search(r"[\d/_-]", t)}
+        top_score = max((i.score for i in issues), default=0.0) or 1.0
+        reranked = []
+        for n_scored, (issue, text) in enumerate(zip(issues, texts)):
+            if time.perf_counter() > deadline:
+                increment("hybrid.rerank_budget_exceeded")
+                reranked += issues[n_scored:]
+                break
+            terms = set(tokenize(text))
+            score = issue.score / top_score
+            score += self.code_weight * (len(codes & terms) / len(codes) if codes else 0.0)
+            score += self.coverage_weight * (len(query_terms & terms) / len(query_terms) if query_terms else 0.0)
+            reranked.append(issue.model_copy(update={"score": score * top_score}))
+        return sorted(reranked, key=lambda i: i.score, reverse=True)
+
+
+class CrossEncoderReranker:
+    """Scores (query, issue) pairs with a sentence-transformers cross-encoder (optional dependency)."""
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_name)
+
+    def rerank(self, query: str, issues: list[SimilarIssue], texts: list[str], deadline: float) -> list[SimilarIssue]:
+        if not issues or time.perf_counter() > deadline:
+            return issues
+        scores = self.model.predict([(query, t) for t in texts])
+        reranked = [i.model_copy(update={"score": float(s)}) for i, s in zip(issues, scores)]
+        return sorted(reranked, key=lambda i: i.score, reverse=True)
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[float]], rrf_k: int = RRF_K) -> dict[float, float]:
+    """Fused score of every issue id, summing `1 / (rrf_k + rank)` over the rankings it appears in."""
+    fused: dict[float, float] = {}
+    for ranking in rankings:
+        for rank, issue_id in enumerate(ranking, start=1):
+            fused[issue_id] = fused.get(issue_id, 0.0) + 1 / (rrf_k + rank)
+    return fused
+
+
+class LexicalCorpus:
+    """BM25 index over the issues of a corpus (with the `TABLE_COLS`), built for a version of the vector index."""
+
+    def __init__(self, corpus: pd.DataFrame, version: str | None = None):
+        self.corpus = corpus.reset_index(drop=True)
+        self.version = version
+        with span("hybrid.build_lexical_index"):
+            self.texts = (self.corpus[TEXT_COLS[0]] + "\n" + self.corpus[TEXT_COLS[1]]).tolist()
+            self.index = BM25Index(self.texts)
+        self.rows_by_id = dict(zip(self.corpus["Id"], range(len(self.corpus))))
+        self.columns = {c: self.corpus[c].to_numpy() for c in self.corpus.columns}
+
+    def _filter_rows(self, filters: Filters | None) -> np.ndarray | None:
+        if not filters:
+            return None
+        mask = np.ones(len(self.corpus), dtype=bool)
+        for col, values in filters.items():
+            mask &= self.corpus[col].isin(values if isinstance(values, list) else [values]).to_numpy()
+        return np.flatnonzero(mask)
+
+    def search(self, query: str, k: int, cols: Sequence[str], filters: Filters | None) -> IssueRecords:
+        scores, rows = self.index.search(query, k, rows=self._filter_rows(filters))
+        cols = [c for c in cols if c in self.columns]
+        return IssueRecords(issue_fields(tuple(cols)), [self.columns[c][rows].tolist() for c in cols], scores)
+
+
+class HybridSearcher:
+    """Fuses a vector searcher's results with BM25 results over the same issues (`corpus`, with the `TABLE_COLS`).
+
+    The vector search gets `vector_budget_seconds`, if set (the lexical results are used alone past it, as they are
+    local), and the re-ranker, if any, `rerank_budget_seconds`. The results are `DegradedResults` when the vector
+    search's were, or when it missed its budget.
+
+    With `load_corpus`, the lexical index is rebuilt from the corpus it loads on `refresh()`, and in the background
+    when the vector index's version changes, as seen by `index_version()` or by a search at most every
+    `version_poll_seconds`. Its version is part of `index_version()`, so that cached results are dropped again once
+    the rebuilt lexical index is swapped in.
+    """
+
+    def __init__(
+        self,
+        searcher: SimilarIssueSearcher,
+        corpus: pd.DataFrame,
+        reranker: Reranker | None = None,
+        n_candidates: int = HYBRID_CANDIDATES,
+        vector_budget_seconds: float | None = HYBRID_VECTOR_BUDGET_SECONDS,
+        rerank_budget_seconds: float = HYBRID_RERANK_BUDGET_SECONDS,
+        rrf_k: int = RRF_K,
+        load_corpus: Callable[[], pd.DataFrame] | None = None,
+        version_poll_seconds: float = HYBRID_VERSION_POLL_SECONDS,
+    ):
+        self.searcher = searcher
+        self.reranker = reranker
+        self.n_candidates = n_candidates
+        self.vector_budget_seconds = vector_budget_seconds
+        self.rerank_budget_seconds = rerank_budget_seconds
+        self.rrf_k = rrf_k
+        self.load_corpus = load_corpus
+        self.version_poll_seconds = version_poll_seconds
+        self.lexical = LexicalCorpus(corpus, version=self._vector_index_version())
+        self._version_checked_at = time.monotonic()
+        self._rebuild_lock = threading.Lock()
+        self._rebuilding = False
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hybrid-search")
+
+    def _vector_index_version(self) -> str | None:
+        get_version = getattr(self.searcher, "index_version", None)
+        return get_version() if get_version is not None else None
+
+    def index_version(self) -> str | None:
+        version = self._vector_index_version()
+        if version is None:
+            return None
+        if version != self.lexical.version and self.load_corpus is not None:
+            with self._rebuild_lock:
+                rebuild, self._rebuilding = not self._rebuilding, True
+            if rebuild:
+                threading.Thread(
+                    target=self._rebuild, args=(version,), name="hybrid-lexical-rebuild", daemon=True
+                ).start()
+        return f"{version}+lexical@{self.lexical.version}"
+
+    def _poll_version(self) -> None:
+        if self.load_corpus is None:
+            return
+        with self._rebuild_lock:
+            if time.monotonic() - self._version_checked_at < self.version_poll_seconds:
+                return
+            self._version_checked_at = time.monotonic()
+        # Off the search's path, as the version can be a remote call
+        self._executor.submit(self.index_version)
+
+    def refresh(self) -> None:
+        """Rebuilds the lexical index now, on the calling thread, e.g. once the vector index swapped to a new one."""
+        if self.load_corpus is not None:
+            with self._rebuild_lock:
+                self._rebuilding = True
+            self._rebuild(self._vector_index_version())
+
+    def _rebuild(self, version: str | None) -> None:
+        assert self.load_corpus is not None  # mypy fix
+        try:
+            lexical = LexicalCorpus(self.load_corpus(), version=version)
+            logger.info(f"Swapping in the lexical index of {len(lexical.texts)} issues for the index version {version}")
+            self.lexical = lexical
+        except Exception:
+            logger.exception(f"Could not rebuild the lexical index, keeping {self.lexical.version}")
+        finally:
+            with self._rebuild_lock:
+                self._rebuilding = False
+
+    def fetch_originals(self, ids: Sequence[float]) -> dict[float, str]:
+        """Originals of the corpus' issues, and of the others (e.g. added since the corpus was loaded) from the
+        wrapped searcher."""
+        lexical = self.lexical
+        originals = {i: lexical.columns["Original"][row] for i in ids if (row := lexical.rows_by_id.get(i)) is not None}
+        if missing := [i for i in ids if i not in originals]:
+            originals.update(fetch_originals(self.searcher, missing))
+        return originals
+
+    def search(
+        self,
+        query: str,
+        cols: Sequence[str] = TABLE_COLS,
+        num_results: int = N_SIMILAR_ISSUES,
+        filters: Filters | None = None,
+    ) -> list[SimilarIssue]:
+        start = time.perf_counter()
+        self._poll_version()
+        # The same lexical index for the whole search, even if a rebuilt one is swapped in meanwhile
+        lexical = self.lexical
+        n_candidates = max(self.n_candidates, num_results)
+        vector_future = self._executor.submit(
+            self.searcher.search, query, cols=cols, num_results=n_candidates, filters=filters
+        )
+        with span("hybrid.lexical"):
+            lexical_issues = lexical.search(query, n_candidates, cols, filters)
+        timeout = None
+        if self.vector_budget_seconds is not None:
+            timeout = max(0.0, start + self.vector_budget_seconds - time.perf_counter())
+        try:
+            vector_issues = vector_future.result(timeout=timeout)
+            degraded = is_degraded(vector_issues)
+        except FutureTimeoutError:
+            logger.warning(f"Vector search exceeded its {self.vector_budget_seconds}s budget, using lexical results")
+            increment("hybrid.vector_budget_exceeded")
+            vector_issues, degraded = [], True
+
+        with span("hybrid.fusion"):
+            vector_ids, lexical_ids = issue_ids(vector_issues), issue_ids(lexical_issues)
+            fused = reciprocal_rank_fusion([vector_ids, lexical_ids], rrf_k=self.rrf_k)
+            ranked = sorted(fused, key=fused.__getitem__, reverse=True)
+            # Without re-ranking, only the returned candidates need decoding
+            if self.reranker is None:
+                ranked = ranked[:num_results]
+            positions: dict[float, tuple[Sequence[SimilarIssue], int]] = {
+                i: (lexical_issues, n) for n, i in enumerate(lexical_ids)
+            }
+            positions.update((i, (vector_issues, n)) for n, i in enumerate(vector_ids))
+            candidates = [
+                issues[n].model_copy(update={"score": fused[i]}) for i in ranked for issues, n in [positions[i]]
+            ]
+        if self.reranker is not None:
+            with span("hybrid.rerank"):
+                # Re-ranked on the full text, whatever columns were asked for
+                texts = [
+                    lexical.texts[lexical.rows_by_id[i.id]] if i.id in lexical.rows_by_id else i.summary
+                    for i in candidates
+                ]
+                candidates = self.reranker.rerank(
+                    query, candidates, texts, deadline=time.perf_counter() + self.rerank_budget_seconds
+                )
+        return DegradedResults(candidates[:num_results]) if degraded else candidates[:num_results]
+
+
+def get_reranker() -> Reranker | None:
+    reranker = os.getenv("HYBRID_RERANKER", "heuristic")
+    if reranker == "heuristic":
+        return HeuristicReranker()
+    if reranker.startswith("cross-encoder:"):
+        return CrossEncoderReranker(reranker.removeprefix("cross-encoder:"))
+    return None
+
+
+def load_hybrid_corpus() -> pd.DataFrame:
+    """The issues of `HYBRID_CORPUS_PATH`, of `HYBRID_CORPUS_TABLE` (the table the Databricks index syncs from), or of
+    the local index's current snapshot."""
+    corpus_table = os.getenv("HYBRID_CORPUS_TABLE")
+    if corpus_table and not os.getenv("HYBRID_CORPUS_PATH"):
+        from src.index_builder import read_table_chunks
+        from src.resources import get_workspace_client
+
+        corpus = pd.concat(list(read_table_chunks(get_workspace_client(), corpus_table)), ignore_index=True)
+        logger.info(f"Building the lexical index over {len(corpus)} issues from {corpus_table}")
+        return corpus
+    corpus_path = os.getenv("HYBRID_CORPUS_PATH") or str(
+        resolve_snapshot(os.environ["LOCAL_INDEX_PATH"]) / METADATA_FILE
+    )
+    corpus = pd.read_parquet(corpus_path)
+    logger.info(f"Building the lexical index over {len(corpus)} issues from {corpus_path}")
+    return corpus[[c for c in TABLE_COLS if c in corpus.columns]]
+
+
+def get_hybrid_searcher(searcher: SimilarIssueSearcher) -> HybridSearcher:
+    """Hybrid searcher over the issues of `load_hybrid_corpus`, reloaded when the index changes."""
+    return HybridSearcher(searcher, load_hybrid_corpus(), reranker=get_reranker(), load_corpus=load_hybrid_corpus)
@@ -0,0 +1,362 @@
+"""Builds versioned local index snapshots from the summarized issues, reusing the embeddings of unchanged issues.
+
+Usage (from the webapp directory):
+    python -m src.index_builder --input-table workspace.default.summarized_tracked_issues --root ./index
+    python -m src.index_builder --input changed_issues.parquet --root ./index --upsert --delete-ids 12 13
+
+A snapshot root holds the snapshots (`snapshots/<version>`, each with the vectors, the metadata, the ID map and any IVF
+lists) and a `CURRENT` file naming the current one. The local backend, with `LOCAL_INDEX_PATH` set to the root, swaps
+to a new current snapshot without a restart. Every build writes a new snapshot:
+- by default the input has all the issues, and the ones it lacks are deleted
+- with `--upsert` it only has the new or changed issues, merged into the current snapshot (minus `--delete-ids`)
+
+Issues whose summary was already embedded with the same model in the current snapshot keep their embedding, so only
+new or changed summaries are embedded (in parallel batches). The input is read in chunks: Parquet files by row
+batches, and tables through the SQL warehouse `DATABRICKS_WAREHOUSE_ID` by result chunks.
+"""
+
+import argparse
+import fcntl
+import json
+import logging
+import os
+import shutil
+import struct
+import time
+from collections.abc import Iterable, Iterator, Sequence
+from contextlib import contextmanager
+from datetime import UTC, datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from databricks.sdk import WorkspaceClient
+
+from src.batch_recommendation import read_statement_chunks
+from src.embeddings import Embedder, embed_corpus, embedding_key
+from src.local_index import (
+    CURRENT_FILE,
+    EMBEDDINGS_FILE,
+    ID_MAP_FILE,
+    MANIFEST_FILE,
+    METADATA_FILE,
+    SNAPSHOTS_DIR,
+    LocalVectorIndex,
+    assign_ivf,
+    default_n_lists,
+    ivf_assignments,
+    ivf_lists,
+    normalize,
+    save_ivf,
+    train_ivf,
+)
+from src.telemetry import span
+from src.vector_search import TABLE_COLS
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_SOURCE_COLUMN = "Summary"
+# Embedding key (model and text hash) of every row, to find the embeddings that can be reused
+EMBEDDING_KEY_COLUMN = "EmbeddingKey"
+CHUNK_ROWS = 50_000
+COPY_ROWS = 65_536
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+NPY_HEADER_SIZE = 128
+# By default, snapshots only have IVF lists if the app searches them
+IVF_BY_DEFAULT = os.getenv("LOCAL_INDEX_MODE", "exact") == "ivf"
+# Past these, the IVF centroids are retrained rather than the new rows assigned to them
+IVF_RETRAIN_GROWTH = 2.0
+IVF_DRIFT_TOLERANCE = 0.05
+# Held while building, publishing and pruning a snapshot, by this CLI and the app's ingestion alike, as two concurrent
+# builds would each drop the other's issues
+LOCK_FILE = ".ingestion.lock"
+# Unfinished snapshots of other processes untouched for this long are left over by failed builds
+TMP_SNAPSHOT_GRACE_SECONDS = 6 * 3600
+
+
+def read_parquet_chunks(paths: Sequence[Path], chunk_rows: int = CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    for path in paths:
+        parquet_file = pq.ParquetFile(path)
+        columns = [c for c in TABLE_COLS if c in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas()
+
+
+def read_table_chunks(workspace_client: WorkspaceClient, table: str) -> Iterator[pd.DataFrame]:
+    for df in read_statement_chunks(workspace_client, f"SELECT {', '.join(TABLE_COLS)} FROM {table}"):
+        # Results come back as strings
+        yield df.assign(Id=df["Id"].astype(np.float64))
+
+
+def _npy_header(shape: tuple[int, ...]) -> bytes:
+    """`.npy` header of a float32 array, padded to `NPY_HEADER_SIZE` so that it can be rewritten in place."""
+    header = repr({"descr": np.lib.format.dtype_to_descr(np.dtype(np.float32)), "fortran_order": False, "shape": shape})
+    header = header.ljust(NPY_HEADER_SIZE - len(NPY_MAGIC) - 2 - 1) + "\n"
+    return NPY_MAGIC + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+class SnapshotWriter:
+    """Streams a snapshot's vectors to its embeddings file as they come, then lays out the other files when finished.
+
+    The vectors are written after a placeholder `.npy` header, completed with their shape at the end, so the matrix is
+    never copied.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.mkdir(parents=True)
+        self.n_rows = 0
+        self.dim: int | None = None
+        self._embeddings = (path / EMBEDDINGS_FILE).open("wb")
+        self._embeddings.write(_npy_header((0, 0)))
+        self._metadata: list[pd.DataFrame] = []
+
+    def append(self, vectors: np.ndarray, metadata: pd.DataFrame) -> None:
+        assert len(vectors) == len(metadata), f"Mismatched rows: {len(vectors)} != {len(metadata)}"
+        if not len(vectors):
+            return
+        assert self.dim in (None, vectors.shape[1]), f"Mismatched embedding sizes: {self.dim} != {vectors.shape[1]}"
+        self.dim = vectors.shape[1]
+        self._embeddings.write(normalize(vectors).tobytes())
+        self._metadata.append(metadata.reset_index(drop=True))
+        self.n_rows += len(vectors)
+
+    def finish(self) -> np.ndarray:
+        """Writes the metadata and the ID map, and returns the (memory-mapped) embeddings."""
+        if self.dim is None:
+            self._embeddings.close()
+            raise ValueError("No issues to index")
+        self._embeddings.seek(0)
+        self._embeddings.write(_npy_header((self.n_rows, self.dim)))
+        self._embeddings.close()
+        metadata = pd.concat(self._metadata, ignore_index=True)
+        metadata.to_parquet(self.path / METADATA_FILE)
+        np.save(self.path / ID_MAP_FILE, metadata["Id"].to_numpy(dtype=np.float64))
+        return np.load(self.path / EMBEDDINGS_FILE, mmap_mode="r")
+
+
+def write_snapshot_ivf(
+    path: Path,
+    embeddings: np.ndarray,
+    n_lists: int | None,
+    previous: LocalVectorIndex | None = None,
+    carried: np.ndarray | None = None,
+) -> dict | None:
+    """Writes the snapshot's IVF lists, returns their manifest entry (None without IVF lists).
+
+    If the `previous` snapshot has IVF lists, the rows carried over from it (its `carried` rows, after the new ones)
+    keep their list, and the new rows are assigned to its centroids. They are only retrained when the snapshot grew or
+    shrank by `IVF_RETRAIN_GROWTH` since they were trained, or when the new rows are further from their centroids than
+    the trained ones by `IVF_DRIFT_TOLERANCE` on average. With `n_lists` None, the previous snapshot's number of lists
+    is kept, and a snapshot without a previous one only has IVF lists with `LOCAL_INDEX_MODE=ivf`.
+    """
+    previous_ivf = previous.manifest.get("ivf") if previous is not None and previous.ivf is not None else None
+    if n_lists is None and previous is not None and previous.ivf is not None:
+        n_lists = len(previous.ivf[0])
+    elif n_lists is None:
+        n_lists = default_n_lists(len(embeddings)) if IVF_BY_DEFAULT else 0
+    if not n_lists:
+        return None
+    n_lists = min(n_lists, len(embeddings))
+    carried = np.array([], dtype=np.int64) if carried is None else carried
+
+    if (
+        previous is not None
+        and previous.ivf is not None
+        and previous_ivf is not None
+        and previous_ivf["n_lists"] == n_lists
+        and previous_ivf["trained_rows"] / IVF_RETRAIN_GROWTH <= len(embeddings)
+        and len(embeddings) <= previous_ivf["trained_rows"] * IVF_RETRAIN_GROWTH
+    ):
+        centroids, list_offsets, list_rows = previous.ivf
+        assignments, similarities = assign_ivf(embeddings[: len(embeddings) - len(carried)], centroids)
+        mean_similarity = float(similarities.mean()) if len(similarities) else previous_ivf["mean_similarity"]
+        if mean_similarity >= previous_ivf["mean_similarity"] - IVF_DRIFT_TOLERANCE:
+            assignments = np.concatenate([assignments, ivf_assignments(list_offsets, list_rows)[carried]])
+            save_ivf(path, np.asarray(centroids), *ivf_lists(assignments, n_lists))
+            return {**previous_ivf, "retrained": False}
+        logger.info(f"New issues drifted from the IVF centroids ({mean_similarity:.3f} mean similarity), retraining")
+
+    with span("index_builder.train_ivf"):
+        centroids = train_ivf(embeddings, n_lists)
+        assignments, similarities = assign_ivf(embeddings, centroids)
+    save_ivf(path, centroids, *ivf_lists(assignments, n_lists))
+    return {
+        "n_lists": n_lists,
+        "trained_rows": len(embeddings),
+        "mean_similarity": float(similarities.mean()),
+        "retrained": True,
+    }
+
+
+def build_snapshot(
+    root: str | Path,
+    chunks: Iterable[pd.DataFrame],
+    embed: Embedder,
+    model: str,
+    upsert: bool = False,
+    delete_ids: Sequence[float] = (),
+    n_lists: int | None = None,
+    batch_size: int = 256,
+    max_workers: int = 4,
+) -> Path:
+    """Writes a new snapshot of the issues in `chunks` into the snapshot root, returns its path (not yet current)."""
+    root = Path(root)
+    previous = LocalVectorIndex.load(root, partition_col=None) if (root / CURRENT_FILE).exists() else None
+    previous_rows: dict[str, int] = {}
+    if previous is not None and EMBEDDING_KEY_COLUMN in previous.columns:
+        previous_rows = {k: i for i, k in enumerate(previous.columns[EMBEDDING_KEY_COLUMN]) if isinstance(k, str)}
+    if upsert and previous is not None and previous.manifest.get("model") != model:
+        raise ValueError(f"The current snapshot was embedded with {previous.manifest.get('model')}, rebuild it fully")
+
+    version = datetime.now(UTC).strftime("%Y%m%dT%H%M%S%fZ")
+    tmp_path = root / SNAPSHOTS_DIR / f".{version}.{os.getpid()}.tmp"
+    writer = SnapshotWriter(tmp_path)
+    start, n_reused, n_embedded = time.perf_counter(), 0, 0
+    seen_ids: set[float] = set()
+    for chunk in chunks:
+        chunk = chunk[~chunk["Id"].isin(delete_ids)].reset_index(drop=True)
+        texts = chunk[EMBEDDING_SOURCE_COLUMN].fillna("").tolist()
+        keys = [embedding_key(model, t) for t in texts]
+        reuse_rows = np.array([previous_rows.get(k, -1) for k in keys], dtype=np.int64)
+        reused, missing = np.flatnonzero(reuse_rows >= 0), np.flatnonzero(reuse_rows < 0)
+
+        parts = []
+        if len(missing):
+            embedded = embed_corpus(embed, [texts[i] for i in missing], batch_size=batch_size, max_workers=max_workers)
+            parts.append((missing, embedded))
+        if len(reused):
+            assert previous is not None  # mypy fix
+            # Sorted rows read the memory-mapped matrix forward
+            order = np.argsort(reuse_rows[reused])
+            parts.append((reused[order], np.asarray(previous.embeddings[reuse_rows[reused][order]])))
+        if not parts:
+            continue
+        vectors = np.empty((len(chunk), parts[0][1].shape[1]), dtype=np.float32)
+        for rows, part in parts:
+            vectors[rows] = part
+        writer.append(vectors, chunk.assign(**{EMBEDDING_KEY_COLUMN: keys}))
+        seen_ids.update(chunk["Id"])
+        n_reused, n_embedded = n_reused + len(reused), n_embedded + len(missing)
+        logger.info(f"{writer.n_rows} issues written, {n_embedded} embedded, {n_reused} reused")
+
+    carried = None
+    if upsert and previous is not None:
+        # The current snapshot's other issues are carried over as they are
+        carried = np.flatnonzero(~previous.metadata["Id"].isin(seen_ids | set(delete_ids)).to_numpy())
+        for offset in range(0, len(carried), COPY_ROWS):
+            rows = carried[offset : offset + COPY_ROWS]
+            writer.append(np.asarray(previous.embeddings[rows]), previous.metadata.iloc[rows])
+        logger.info(f"{len(carried)} issues carried over from {previous.path}")
+
+    embeddings = writer.finish()
+    ivf = write_snapshot_ivf(tmp_path, embeddings, n_lists, previous=previous, carried=carried)
+    manifest = {
+        "version": version,
+        "model": model,
+        "previous": previous.path.name if previous is not None and previous.path is not None else None,
+        "n_embedded": n_embedded,
+        "n_reused": n_reused,
+        "build_s": time.perf_counter() - start,
+        "n_rows": writer.n_rows,
+        "dim": writer.dim,
+        "ivf": ivf,
+    }
+    (tmp_path / MANIFEST_FILE).write_text(json.dumps(manifest))
+    del embeddings
+    path = root / SNAPSHOTS_DIR / version
+    tmp_path.rename(path)
+    return path
+
+
+def publish(root: str | Path, snapshot: Path) -> None:
+    """Makes `snapshot` the current one, atomically replacing the `CURRENT` file."""
+    tmp_current = Path(root) / f".{CURRENT_FILE}.tmp"
+    tmp_current.write_text(snapshot.name)
+    os.replace(tmp_current, Path(root) / CURRENT_FILE)
+
+
+@contextmanager
+def locked(root: str | Path) -> Iterator[None]:
+    """Holds the snapshot root's lock, waiting for the build in progress, if any."""
+    with open(Path(root) / LOCK_FILE, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _is_abandoned(tmp_path: Path, grace_seconds: float) -> bool:
+    """Whether an unfinished snapshot is one of this process' (whose builds are over, as it holds the lock), or has
+    not been written to for `grace_seconds`."""
+    if tmp_path.name.removesuffix(".tmp").rpartition(".")[2] == str(os.getpid()):
+        return True
+    last_write = max((p.stat().st_mtime for p in [tmp_path, *tmp_path.iterdir()]), default=0.0)
+    return time.time() - last_write > grace_seconds
+
+
+def prune(root: str | Path, keep: int, grace_seconds: float = TMP_SNAPSHOT_GRACE_SECONDS) -> None:
+    """Deletes all but the `keep` latest snapshots (and never the current one), and abandoned unfinished ones."""
+    root = Path(root)
+    current = (root / CURRENT_FILE).read_text().strip()
+    snapshots = sorted(p for p in (root / SNAPSHOTS_DIR).iterdir() if p.is_dir())
+    finished = [p for p in snapshots if not p.name.startswith(".")]
+    unfinished = [p for p in snapshots if p.name.startswith(".") and _is_abandoned(p, grace_seconds)]
+    # Searches still reading a deleted snapshot's memory-mapped files are unaffected until they swap
+    for path in [*finished[:-keep], *unfinished]:
+        if path.name != current:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def main() -> None:
+    from src.resources import get_workspace_client
+    from src.vector_search import build_embedder
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", type=Path, nargs="+", help="Parquet files (exports of the summarized issues)")
+    source.add_argument("--input-table")
+    parser.add_argument("--root", type=Path, required=True, help="Snapshot root, the local backend's LOCAL_INDEX_PATH")
+    parser.add_argument("--upsert", action="store_true", help="The input only has new or changed issues")
+    parser.add_argument("--delete-ids", type=float, nargs="*", default=[])
+    parser.add_argument(
+        "--n-lists",
+        type=int,
+        default=None,
+        help="IVF lists, 0 for none. By default, the current snapshot's, or 4 * sqrt(rows) with LOCAL_INDEX_MODE=ivf",
+    )
+    parser.add_argument("--batch-size", type=int, default=256, help="Texts per embedding call")
+    parser.add_argument("--max-workers", type=int, default=4, help="Concurrent embedding calls")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="Rows read at a time from Parquet files")
+    parser.add_argument("--keep", type=int, default=3, help="Snapshots kept, the previous ones for rolling back")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.input_table is not None:
+        chunks = read_table_chunks(get_workspace_client(), args.input_table)
+    else:
+        chunks = read_parquet_chunks(args.input, chunk_rows=args.chunk_rows)
+    embed, model = build_embedder()
+    args.root.mkdir(parents=True, exist_ok=True)
+    with locked(args.root):
+        snapshot = build_snapshot(
+            args.root,
+            chunks,
+            embed,
+            model=model,
+            upsert=args.upsert,
+            delete_ids=args.delete_ids,
+            n_lists=args.n_lists,
+            batch_size=args.batch_size,
+            max_workers=args.max_workers,
+        )
+        publish(args.root, snapshot)
+        prune(args.root, keep=args.keep)
+    manifest = json.loads((snapshot / MANIFEST_FILE).read_text())
+    logger.info(
+        f"Published {snapshot}: {manifest['n_rows']} issues, {manifest['n_embedded']} embedded, "
+        f"{manifest['n_reused']} reused, in {manifest['build_s']:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""Write-behind ingestion of the recommendations submitted in the app into the searchable corpus.
+
+Submitting a recommendation only enqueues it into the SQLite queue at `INGESTION_QUEUE_PATH`, which survives restarts
+and is shared by the app's processes. A background writer takes the queued submissions in batches every
+`INGESTION_FLUSH_SECONDS` and:
+- merges them into `INGESTION_TABLE` (the summarized issues), staged in the `INGESTION_STAGING_DIR` volume
+- upserts them into the index: a new snapshot of the local index, published and swapped in right away, or a sync of
+  the (triggered) Databricks index, which embeds them
+A batch that fails is retried with an exponential backoff, without repeating the stage it already completed.
+
+Submitted issues have negative Ids, so that they never collide with the tracked issues, and the summarization job
+keeps them.
+"""
+
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections.abc import Callable, Iterator, Sequence
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from functools import partial
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import streamlit as st
+
+from src.telemetry import increment, registry, span
+from src.vector_search import VECTOR_SEARCH_BACKEND, SimilarIssueSearcher
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+INGESTION_QUEUE_PATH = os.getenv("INGESTION_QUEUE_PATH")
+INGESTION_TABLE = os.getenv("INGESTION_TABLE")
+INGESTION_STAGING_DIR = os.getenv("INGESTION_STAGING_DIR")
+INGESTION_FLUSH_SECONDS = float(os.getenv("INGESTION_FLUSH_SECONDS", 2))
+INGESTION_BATCH_SIZE = int(os.getenv("INGESTION_BATCH_SIZE", 100))
+MAX_BACKOFF_SECONDS = 300
+# A writer that dies with a claimed batch (e.g. a restart) leaves it to the others after this
+LEASE_SECONDS = 600
+SNAPSHOTS_KEPT = 3
+
+Stage = Callable[["pd.DataFrame"], None]
+
+
+def _submission_id() -> float:
+    # Exactly representable as a float, like the tracked issues' Ids
+    return -float(uuid.uuid4().int % 2**52 + 1)
+
+
+@dataclass
+class Submission:
+    description: str
+    recommendation: str
+    similar_issue_ids: list[float]
+    market: str = ""
+    site: str = ""
+    turbine: str = ""
+    id: float = field(default_factory=_submission_id)
+    submitted_at: float = field(default_factory=time.time)
+
+    @property
+    def title(self) -> str:
+        return self.description.strip().partition("\n")[0][:120]
+
+    def to_row(self) -> dict[str, float | str]:
+        """The submission as an issue of the summarized issues table, the recommendation as its closing comment."""
+        similar_issues = ", ".join(str(int(i)) for i in self.similar_issue_ids) or "none"
+        original = (
+            f"# {self.title}\n\n## Description\n{self.description}\n\n## Closing Comment\n{self.recommendation}\n\n"
+            f"## Similar Issues\n{similar_issues}\n"
+        )
+        # Laid out like the summarization job's, the resolution left empty as it is not known yet
+        summary = (
+            f"### Symptoms:\n{self.description}\n\n### Recommendation:\n{self.recommendation}\n\n### Resolution:\n"
+        )
+        row: dict[str, float | str] = {"Id": self.id, "Market": self.market, "Site": self.site, "Turbine": self.turbine}
+        return {**row, "Title": self.title, "Original": original, "Summary": summary}
+
+
+class IngestionQueue:
+    """Submissions waiting to be written to the table and the index, in a single SQLite file.
+
+    A submission is claimed by one writer at a time, marked written once it is in the table, and deleted once it is
+    in the index. Connections are per thread, like the completion cache's.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self._local = threading.local()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS submissions (id REAL PRIMARY KEY, payload TEXT NOT NULL, "
+            "enqueued_at REAL NOT NULL, written_at REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_attempt_at REAL NOT NULL DEFAULT 0, locked_until REAL NOT NULL DEFAULT 0, last_error TEXT)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def put(self, submission: Submission) -> None:
+        self._connection().execute(
+            "INSERT INTO submissions (id, payload, enqueued_at) VALUES (?, ?, ?)",
+            (submission.id, json.dumps(asdict(submission)), time.time()),
+        )
+
+    def claim(self, limit: int, lease_seconds: float = LEASE_SECONDS) -> list[tuple[Submission, bool]]:
+        """The oldest submissions due, with whether they are already written to the table, leased to the caller."""
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, payload, written_at FROM submissions WHERE next_attempt_at <= ? AND locked_until <= ? "
+                "ORDER BY enqueued_at LIMIT ?",
+                (now, now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE submissions SET locked_until = ? WHERE id = ?", [(now + lease_seconds, r[0]) for r in rows]
+            )
+        return [(Submission(**json.loads(payload)), written_at is not None) for _, payload, written_at in rows]
+
+    def mark_written(self, ids: Sequence[float]) -> None:
+        self._connection().executemany(
+            "UPDATE submissions SET written_at = ? WHERE id = ?", [(time.time(), i) for i in ids]
+        )
+
+    def complete(self, ids: Sequence[float]) -> None:
+        self._connection().executemany("DELETE FROM submissions WHERE id = ?", [(i,) for i in ids])
+
+    def fail(self, ids: Sequence[float], error: str) -> None:
+        """Releases the submissions, to be retried after a backoff doubling with every failed attempt."""
+        self._connection().executemany(
+            "UPDATE submissions SET attempts = attempts + 1, locked_until = 0, last_error = ?, "
+            f"next_attempt_at = ? + MIN(1 << attempts, {MAX_BACKOFF_SECONDS}) WHERE id = ?",
+            [(error, time.time(), i) for i in ids],
+        )
+
+    def depth(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM submissions").fetchone()[0]
+
+
+class IngestionWriter:
+    """Flushes the queue in batches: into the table with `write_table`, then into the index with `upsert_index`.
+
+    A stage that is `None` is skipped, e.g. the table when developing against a local index.
+    """
+
+    def __init__(
+        self,
+        queue: IngestionQueue,
+        write_table: Stage | None,
+        upsert_index: Stage | None,
+        batch_size: int = INGESTION_BATCH_SIZE,
+    ):
+        self.queue = queue
+        self.write_table = write_table
+        self.upsert_index = upsert_index
+        self.batch_size = batch_size
+
+    def flush(self) -> int:
+        """Writes one batch of the queued submissions, returns how many were ingested."""
+        import pandas as pd
+
+        claimed = self.queue.claim(self.batch_size)
+        if not claimed:
+            return 0
+        ids = [s.id for s, _ in claimed]
+        try:
+            if unwritten := [s for s, written in claimed if not written]:
+                if self.write_table is not None:
+                    with span("ingestion.write_table"):
+                        self.write_table(pd.DataFrame([s.to_row() for s in unwritten]))
+                self.queue.mark_written([s.id for s in unwritten])
+            if self.upsert_index is not None:
+                with span("ingestion.upsert_index"):
+                    self.upsert_index(pd.DataFrame([s.to_row() for s, _ in claimed]))
+        except Exception as e:
+            logger.exception(f"Could not ingest {len(ids)} submitted recommendations, retrying later")
+            self.queue.fail(ids, f"{type(e).__name__}: {e}")
+            increment("ingestion.failures", len(ids))
+            return 0
+        self.queue.complete(ids)
+        increment("ingestion.submissions", len(ids))
+        logger.info(f"Ingested {len(ids)} submitted recommendations")
+        return len(ids)
+
+    def run(self, flush_seconds: float = INGESTION_FLUSH_SECONDS) -> None:
+        while True:
+            try:
+                # A full batch means there may be more waiting
+                while self.flush() == self.batch_size:
+                    pass
+            except Exception:
+                logger.exception("Ingestion writer failed, retrying")
+            time.sleep(flush_seconds)
+
+
+def merge_into_table(rows: "pd.DataFrame", table: str, staging_dir: str) -> None:
+    """Inserts the rows missing from the table, so that retrying a batch that was already merged is a no-op."""
+    from src.batch_recommendation import execute_sql
+    from src.resources import get_workspace_client
+
+    workspace_client = get_workspace_client()
+    staged_file = f"{staging_dir.rstrip('/')}/{uuid.uuid4().hex}.parquet"
+    buffer = io.BytesIO()
+    rows.to_parquet(buffer)
+    buffer.seek(0)
+    workspace_client.files.upload(staged_file, buffer, overwrite=True)
+    try:
+        columns = ", ".join(f"`{c}`" for c in rows.columns)
+        values = ", ".join(f"s.`{c}`" for c in rows.columns)
+        execute_sql(
+            workspace_client,
+            f"MERGE INTO {table} AS t USING read_files('{staged_file}', format => 'parquet') AS s ON t.Id = s.Id "
+            f"WHEN NOT MATCHED THEN INSERT ({columns}) VALUES ({values})",
+        )
+    finally:
+        workspace_client.files.delete(staged_file)
+
+
+def refresh_searchers(searcher: SimilarIssueSearcher) -> None:
+    """Makes every layer of the searcher (the backend first, then e.g. the result cache) pick up a new index now."""
+    layers = []
+    current: object | None = searcher
+    while current is not None:
+        layers.append(current)
+        current = getattr(current, "searcher", None)
+    for layer in reversed(layers):
+        if (refresh := getattr(layer, "refresh", None)) is not None:
+            refresh()
+
+
+class LocalIndexUpserter:
+    """Upserts the rows into a new snapshot of the local index, published and swapped in by this process's searcher.
+
+    The other processes using the snapshot root swap to it at their next check (`LOCAL_INDEX_RELOAD_SECONDS`).
+    """
+
+    def __init__(self, root: str | Path):
+        self.root = Path(root)
+        self._embedder: tuple | None = None
+
+    def __call__(self, rows: "pd.DataFrame") -> None:
+        from src.index_builder import build_snapshot, locked, prune, publish
+        from src.vector_search import build_embedder, get_vector_searcher
+
+        if self._embedder is None:
+            self._embedder = build_embedder()
+        embed, model = self._embedder
+        # Another process publishing at the same time would drop one of the two snapshots' rows
+        with locked(self.root):
+            snapshot = build_snapshot(self.root, [rows], embed, model=model, upsert=True, max_workers=1)
+            publish(self.root, snapshot)
+            prune(self.root, keep=SNAPSHOTS_KEPT)
+        refresh_searchers(get_vector_searcher())
+
+
+def sync_databricks_index(rows: "pd.DataFrame") -> None:
+    """Syncs a triggered Databricks index to the table the rows were merged into; continuous ones sync themselves."""
+    from src.resources import get_vector_search_client, required_env
+
+    index = get_vector_search_client().get_index(
+        endpoint_name=required_env("INDEX_ENDPOINT_NAME"), index_name=required_env("INDEX_NAME")
+    )
+    if index.describe().get("pipeline_type") == "TRIGGERED":
+        index.sync()
+
+
+def _index_stage() -> Stage | None:
+    if VECTOR_SEARCH_BACKEND == "local":
+        from src.local_index import CURRENT_FILE
+
+        root = Path(os.environ["LOCAL_INDEX_PATH"])
+        if (root / CURRENT_FILE).exists():
+            return LocalIndexUpserter(root)
+        logger.warning(f"{root} is not a snapshot root, submitted recommendations are not added to the local index")
+        return None
+    if VECTOR_SEARCH_BACKEND == "databricks":
+        # The index syncs from the table
+        return sync_databricks_index if INGESTION_TABLE else None
+    return None
+
+
+@st.cache_resource(show_spinner=False)
+def get_ingestion_queue() -> IngestionQueue | None:
+    if not INGESTION_QUEUE_PATH:
+        return None
+    queue = IngestionQueue(INGESTION_QUEUE_PATH)
+    registry.register_gauge("ingestion.queue_depth", queue.depth)
+    return queue
+
+
+_writer_started = False
+_writer_lock = threading.Lock()
+
+
+def start_ingestion_writer() -> None:
+    """Starts the background writer, once per process, if there is a queue."""
+    global _writer_started
+    with _writer_lock:
+        if _writer_started or (queue := get_ingestion_queue()) is None:
+            return
+        _writer_started = True
+
+    write_table: Stage | None = None
+    if INGESTION_TABLE:
+        if not INGESTION_STAGING_DIR:
+            raise RuntimeError("The INGESTION_STAGING_DIR environment variable must be set to write INGESTION_TABLE")
+        write_table = partial(merge_into_table, table=INGESTION_TABLE, staging_dir=INGESTION_STAGING_DIR)
+    writer = IngestionWriter(queue, write_table=write_table, upsert_index=_index_stage())
+    threading.Thread(target=writer.run, daemon=True, name="ingestion-writer").start()
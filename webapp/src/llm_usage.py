@@ -0,0 +1,100 @@
+"""Token accounting of the completions.
+
+The model, prompt and completion tokens, latency and outcome of every completion are counted as `llm.usage.*` metrics
+and, with `LLM_USAGE_PATH`, appended to a SQLite table, e.g. to compare the cost and latency of the models the
+recommendations are routed to (see `src/rec_suggestion.py`).
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import astuple, dataclass, field, fields
+from pathlib import Path
+from typing import Literal
+
+import streamlit as st
+
+from src.telemetry import increment
+
+logger = logging.getLogger(__name__)
+
+LLM_USAGE_PATH = os.getenv("LLM_USAGE_PATH")
+
+# "escalated" answers of the small model were discarded for the large model's, "truncated" ones were cut off at the
+# endpoint's token limit, "failed" calls found the endpoint unavailable and "cancelled" streams were stopped by the user
+Outcome = Literal["ok", "escalated", "truncated", "failed", "cancelled"]
+
+
+@dataclass
+class LLMUsage:
+    model: str
+    prompt_tokens: int
+    completion_tokens: int
+    latency_s: float
+    streamed: bool
+    outcome: Outcome = "ok"
+    # Estimated from the text, as the endpoint did not report it (e.g. when streaming)
+    estimated: bool = False
+    timestamp: float = field(default_factory=time.time)
+
+
+class UsageLog:
+    """The usage of every completion, in a single SQLite file. Connections are per thread, like the completion
+    cache's."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self._local = threading.local()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS llm_usage (model TEXT NOT NULL, prompt_tokens INTEGER NOT NULL, "
+            "completion_tokens INTEGER NOT NULL, latency_s REAL NOT NULL, streamed INTEGER NOT NULL, "
+            "outcome TEXT NOT NULL, estimated INTEGER NOT NULL, timestamp REAL NOT NULL)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def record(self, usage: LLMUsage) -> None:
+        columns = ", ".join(f.name for f in fields(LLMUsage))
+        self._connection().execute(
+            f"INSERT INTO llm_usage ({columns}) VALUES ({', '.join('?' * len(fields(LLMUsage)))})", astuple(usage)
+        )
+
+    def summary(self, since: float = 0.0) -> dict[str, dict[str, float]]:
+        """Calls, escalations, failures, tokens and mean latency per model, since the `since` timestamp."""
+        rows = self._connection().execute(
+            "SELECT model, COUNT(*), SUM(outcome = 'escalated'), SUM(outcome = 'failed'), SUM(prompt_tokens), "
+            "SUM(completion_tokens), AVG(latency_s) FROM llm_usage WHERE timestamp >= ? GROUP BY model",
+            (since,),
+        )
+        keys = ("calls", "escalated", "failed", "prompt_tokens", "completion_tokens", "mean_latency_s")
+        return {model: dict(zip(keys, values, strict=True)) for model, *values in rows}
+
+
+@st.cache_resource(show_spinner=False)
+def get_usage_log() -> UsageLog | None:
+    return UsageLog(LLM_USAGE_PATH) if LLM_USAGE_PATH else None
+
+
+def record_usage(usage: LLMUsage) -> None:
+    model = re.sub(r"\W", "_", usage.model)
+    increment(f"llm.usage.{model}.calls")
+    increment(f"llm.usage.{model}.prompt_tokens", usage.prompt_tokens)
+    increment(f"llm.usage.{model}.completion_tokens", usage.completion_tokens)
+    if usage.outcome != "ok":
+        increment(f"llm.usage.{model}.{usage.outcome}")
+    if (usage_log := get_usage_log()) is not None:
+        try:
+            usage_log.record(usage)
+        except sqlite3.Error:
+            # Accounting must never fail a recommendation
+            logger.exception("Could not record the LLM usage")
@@ -0,0 +1,409 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections.abc import Callable, Sequence
+from pathlib import Path
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+
+from src.telemetry import span
+from src.vector_search import N_SIMILAR_ISSUES, TABLE_COLS, Filters, IssueRecords, issue_fields
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_FILE = "embeddings.npy"
+METADATA_FILE = "metadata.parquet"
+IVF_CENTROIDS_FILE = "ivf_centroids.npy"
+IVF_LIST_OFFSETS_FILE = "ivf_list_offsets.npy"
+IVF_LIST_ROWS_FILE = "ivf_list_rows.npy"
+# Issue ID of every row
+ID_MAP_FILE = "ids.npy"
+MANIFEST_FILE = "manifest.json"
+# A snapshot root holds versioned snapshots and the name of the current one (see `src/index_builder.py`)
+CURRENT_FILE = "CURRENT"
+SNAPSHOTS_DIR = "snapshots"
+
+SearchMode = Literal["exact", "ivf"]
+QueryEmbedder = Callable[[Sequence[str]], np.ndarray]
+
+
+def resolve_snapshot(path: str | Path) -> Path:
+    """The snapshot `path` points to: itself, or the current snapshot if `path` is a snapshot root."""
+    path = Path(path)
+    current = path / CURRENT_FILE
+    return path / SNAPSHOTS_DIR / current.read_text().strip() if current.exists() else path
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def _merge_top_k(
+    scores: np.ndarray, indices: np.ndarray, k: int, best_scores: np.ndarray | None, best_indices: np.ndarray | None
+) -> tuple[np.ndarray, np.ndarray]:
+    if best_scores is not None and best_indices is not None:
+        scores, indices = np.hstack([best_scores, scores]), np.hstack([best_indices, indices])
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores, top_indices = np.take_along_axis(scores, top, axis=1), np.take_along_axis(indices, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return np.take_along_axis(top_scores, order, axis=1), np.take_along_axis(top_indices, order, axis=1)
+
+
+def default_n_lists(n_rows: int) -> int:
+    return max(1, int(4 * np.sqrt(n_rows)))
+
+
+def train_ivf(
+    embeddings: np.ndarray, n_lists: int, n_iter: int = 10, sample_size: int = 100_000, seed: int = 42
+) -> np.ndarray:
+    """Spherical k-means centroids of a sample of the embeddings."""
+    rng = np.random.default_rng(seed)
+    sample = embeddings[rng.choice(len(embeddings), size=min(sample_size, len(embeddings)), replace=False)]
+    centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(n_lists):
+            members = sample[assignments == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+        centroids = normalize(centroids)
+    return centroids
+
+
+def assign_ivf(
+    embeddings: np.ndarray, centroids: np.ndarray, chunk_size: int = 65_536
+) -> tuple[np.ndarray, np.ndarray]:
+    """List (closest centroid) of every row, and its similarity to that centroid."""
+    assignments, similarities = np.empty(len(embeddings), np.int64), np.empty(len(embeddings), np.float32)
+    for start in range(0, len(embeddings), chunk_size):
+        scores = embeddings[start : start + chunk_size] @ centroids.T
+        assignments[start : start + chunk_size] = np.argmax(scores, axis=1)
+        similarities[start : start + chunk_size] = np.max(scores, axis=1)
+    return assignments, similarities
+
+
+def ivf_lists(assignments: np.ndarray, n_lists: int) -> tuple[np.ndarray, np.ndarray]:
+    """Inverted lists (offsets, row ids) of the rows' list assignments."""
+    list_rows = np.argsort(assignments, kind="stable").astype(np.int64)
+    list_offsets = np.searchsorted(assignments[list_rows], np.arange(n_lists + 1)).astype(np.int64)
+    return list_offsets, list_rows
+
+
+def ivf_assignments(list_offsets: np.ndarray, list_rows: np.ndarray) -> np.ndarray:
+    """List of every row, the inverse of `ivf_lists`."""
+    assignments = np.empty(len(list_rows), np.int64)
+    assignments[list_rows] = np.repeat(np.arange(len(list_offsets) - 1), np.diff(list_offsets))
+    return assignments
+
+
+def build_ivf(
+    embeddings: np.ndarray, n_lists: int, n_iter: int = 10, sample_size: int = 100_000, seed: int = 42
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Spherical k-means coarse quantizer, returning the centroids and the inverted lists (offsets, row ids)."""
+    centroids = train_ivf(embeddings, n_lists, n_iter=n_iter, sample_size=sample_size, seed=seed)
+    return centroids, *ivf_lists(assign_ivf(embeddings, centroids)[0], n_lists)
+
+
+def write_snapshot(
+    path: str | Path, embeddings: np.ndarray, metadata: pd.DataFrame, n_lists: int | None = None
+) -> None:
+    """Writes an index snapshot: normalized embeddings, the table columns and (optionally) IVF inverted lists."""
+    assert len(embeddings) == len(metadata), f"Mismatched rows: {len(embeddings)} != {len(metadata)}"
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    embeddings = normalize(embeddings)
+    np.save(path / EMBEDDINGS_FILE, embeddings)
+    metadata.reset_index(drop=True).to_parquet(path / METADATA_FILE)
+    if "Id" in metadata.columns:
+        np.save(path / ID_MAP_FILE, metadata["Id"].to_numpy(dtype=np.float64))
+    if n_lists:
+        save_ivf(path, *build_ivf(embeddings, n_lists=n_lists))
+
+
+def save_ivf(path: Path, centroids: np.ndarray, list_offsets: np.ndarray, list_rows: np.ndarray) -> None:
+    np.save(path / IVF_CENTROIDS_FILE, centroids)
+    np.save(path / IVF_LIST_OFFSETS_FILE, list_offsets)
+    np.save(path / IVF_LIST_ROWS_FILE, list_rows)
+
+
+class LocalVectorIndex:
+    """Cosine-similarity index over a memory-mapped embedding matrix, with exact and IVF (approximate) search."""
+
+    def __init__(
+        self,
+        embeddings: np.ndarray,
+        metadata: pd.DataFrame,
+        ivf: tuple[np.ndarray, np.ndarray, np.ndarray] | None = None,
+        chunk_size: int = 65_536,
+        version: str | None = None,
+        partition_col: str | None = "Market",
+        ids: np.ndarray | None = None,
+        path: Path | None = None,
+        manifest: dict | None = None,
+    ):
+        self.embeddings = embeddings
+        self.metadata = metadata
+        self.ivf = ivf
+        self.chunk_size = chunk_size
+        self.version = version
+        self.partition_col = partition_col
+        self.path = path
+        self.manifest = manifest or {}
+        # Column arrays, gathered with the result row ids (no per-row `iloc`)
+        self.columns = {c: metadata[c].to_numpy() for c in metadata.columns}
+        if ids is None:
+            ids = metadata["Id"].to_numpy(dtype=np.float64) if "Id" in metadata.columns else np.arange(len(metadata))
+        self._id_order = np.argsort(ids, kind="stable")
+        self._sorted_ids = np.asarray(ids)[self._id_order]
+        # Sorted row ids of every partition (sub-index), so that a query filtered on it only scans its rows
+        self.partitions: dict[str, np.ndarray] = {}
+        if partition_col is not None and partition_col in metadata.columns:
+            self.partitions = {
+                str(k): np.sort(np.asarray(v, dtype=np.int64))
+                for k, v in metadata.groupby(partition_col).indices.items()
+            }
+
+    @classmethod
+    def load(cls, path: str | Path, partition_col: str | None = "Market") -> "LocalVectorIndex":
+        """Loads a snapshot, or the current snapshot of a snapshot root, memory-mapping its arrays."""
+        path = resolve_snapshot(path)
+        embeddings = np.load(path / EMBEDDINGS_FILE, mmap_mode="r")
+        metadata = pd.read_parquet(path / METADATA_FILE)
+        ids = np.load(path / ID_MAP_FILE, mmap_mode="r") if (path / ID_MAP_FILE).exists() else None
+        manifest = json.loads((path / MANIFEST_FILE).read_text()) if (path / MANIFEST_FILE).exists() else None
+        ivf = None
+        if (path / IVF_CENTROIDS_FILE).exists():
+            ivf = (
+                np.load(path / IVF_CENTROIDS_FILE, mmap_mode="r"),
+                np.load(path / IVF_LIST_OFFSETS_FILE, mmap_mode="r"),
+                np.load(path / IVF_LIST_ROWS_FILE, mmap_mode="r"),
+            )
+        logger.info(f"Loaded local index from {path}: {embeddings.shape[0]} vectors of size {embeddings.shape[1]}")
+        version = f"{path}@{(path / EMBEDDINGS_FILE).stat().st_mtime_ns}"
+        return cls(
+            embeddings,
+            metadata,
+            ivf=ivf,
+            version=version,
+            partition_col=partition_col,
+            ids=ids,
+            path=path,
+            manifest=manifest,
+        )
+
+    def rows_for_ids(self, ids: Sequence[float]) -> np.ndarray:
+        """Row of every issue ID, -1 for the IDs not in the index."""
+        _ids = np.asarray(ids, dtype=np.float64)
+        if not len(self._sorted_ids):
+            return np.full(len(_ids), -1, dtype=np.int64)
+        positions = np.searchsorted(self._sorted_ids, _ids).clip(max=len(self._sorted_ids) - 1)
+        return np.where(self._sorted_ids[positions] == _ids, self._id_order[positions], -1)
+
+    def filter_rows(self, filters: Filters | None) -> np.ndarray | None:
+        """Sorted ids of the rows matching all `filters` (None if unfiltered), starting from the partition's rows."""
+        if not filters:
+            return None
+        filters = dict(filters)
+        rows = None
+        if self.partitions and self.partition_col and (values := filters.pop(self.partition_col, None)) is not None:
+            values = values if isinstance(values, list) else [values]
+            empty = np.array([], dtype=np.int64)
+            rows = np.sort(np.concatenate([self.partitions.get(str(v), empty) for v in values]))
+        for col, values in filters.items():
+            values = values if isinstance(values, list) else [values]
+            column = self.metadata[col] if rows is None else self.metadata[col].iloc[rows]
+            mask = column.isin(values).to_numpy()
+            rows = np.flatnonzero(mask) if rows is None else rows[mask]
+        return rows
+
+    def search_exact(
+        self, queries: np.ndarray, k: int, rows: np.ndarray | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Brute-force top-k for a batch of normalized queries, scanning the matrix in chunks to bound memory.
+
+        With `rows`, only those (sorted) rows are scanned.
+        """
+        n_rows = len(self.embeddings) if rows is None else len(rows)
+        if n_rows == 0:
+            return np.full((len(queries), 0), -np.inf, np.float32), np.full((len(queries), 0), -1)
+        best_scores, best_indices = None, None
+        for start in range(0, n_rows, self.chunk_size):
+            if rows is None:
+                chunk_rows = np.arange(start, min(start + self.chunk_size, n_rows))
+                chunk = self.embeddings[start : start + self.chunk_size]
+            else:
+                chunk_rows = rows[start : start + self.chunk_size]
+                chunk = self.embeddings[chunk_rows]
+            chunk_scores = queries @ chunk.T
+            chunk_indices = np.broadcast_to(chunk_rows, chunk_scores.shape)
+            best_scores, best_indices = _merge_top_k(chunk_scores, chunk_indices, k, best_scores, best_indices)
+        assert best_scores is not None and best_indices is not None  # mypy fix
+        return best_scores, best_indices
+
+    def search_ivf(
+        self, queries: np.ndarray, k: int, nprobe: int = 8, rows: np.ndarray | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Approximate top-k, only scoring the rows in the `nprobe` inverted lists closest to each query.
+
+        With `rows`, probed rows not in `rows` are skipped.
+        """
+        assert self.ivf is not None, "The index snapshot has no IVF lists, use exact search"
+        centroids, list_offsets, list_rows = self.ivf
+        probes = np.argsort(-(queries @ centroids.T), axis=1)[:, :nprobe]
+        allowed = None
+        if rows is not None:
+            allowed = np.zeros(len(self.embeddings), dtype=bool)
+            allowed[rows] = True
+
+        all_scores, all_indices = np.full((len(queries), k), -np.inf, np.float32), np.full((len(queries), k), -1)
+        for i, query in enumerate(queries):
+            # Sorted row ids turn the gather from the memory-mapped matrix into a forward scan
+            probed = np.sort(np.concatenate([list_rows[list_offsets[p] : list_offsets[p + 1]] for p in probes[i]]))
+            probed = probed if allowed is None else probed[allowed[probed]]
+            if not len(probed):
+                continue
+            scores, indices = _merge_top_k((self.embeddings[probed] @ query)[None], probed[None], k, None, None)
+            all_scores[i, : scores.shape[1]], all_indices[i, : indices.shape[1]] = scores[0], indices[0]
+        return all_scores, all_indices
+
+    def search(
+        self, queries: np.ndarray, k: int, mode: SearchMode = "exact", nprobe: int = 8, rows: np.ndarray | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        queries = normalize(np.atleast_2d(queries))
+        # A small partition is cheaper to scan exactly than to probe
+        if mode == "ivf" and self.ivf is not None and (rows is None or len(rows) > self.chunk_size):
+            return self.search_ivf(queries, k, nprobe=nprobe, rows=rows)
+        return self.search_exact(queries, k, rows=rows)
+
+
+def recall_at_k(approximate_indices: np.ndarray, exact_indices: np.ndarray) -> float:
+    hits = sum(len(set(a) & set(e)) for a, e in zip(approximate_indices.tolist(), exact_indices.tolist()))
+    return hits / exact_indices.size
+
+
+class LocalVectorSearcher:
+    """Implements the `VectorSearcher.search` contract over a `LocalVectorIndex`, embedding queries with `embed`.
+
+    With a snapshot root as `source`, the current snapshot is checked every `reload_seconds`. A new one is loaded and
+    warmed up on a background thread, then swapped in, while searches keep using the previous one.
+    """
+
+    def __init__(
+        self,
+        index: LocalVectorIndex,
+        embed: QueryEmbedder,
+        mode: SearchMode = "exact",
+        nprobe: int = 8,
+        source: str | Path | None = None,
+        reload_seconds: float = 30,
+    ):
+        self.index = index
+        self.embed = embed
+        self.mode = mode
+        self.nprobe = nprobe
+        self.source = source
+        self.reload_seconds = reload_seconds
+        self._reload_checked_at = time.monotonic()
+        self._reload_lock = threading.Lock()
+        self._reloading = False
+
+    def index_version(self) -> str | None:
+        self._maybe_reload()
+        return self.index.version
+
+    def _maybe_reload(self, force: bool = False) -> None:
+        if self.source is None or (not force and time.monotonic() - self._reload_checked_at < self.reload_seconds):
+            return
+        with self._reload_lock:
+            if self._reloading or (not force and time.monotonic() - self._reload_checked_at < self.reload_seconds):
+                return
+            self._reload_checked_at = time.monotonic()
+            snapshot = resolve_snapshot(self.source)
+            if snapshot == self.index.path:
+                return
+            self._reloading = True
+        if force:
+            self._reload(snapshot)
+        else:
+            threading.Thread(target=self._reload, args=(snapshot,), name="local-index-reload", daemon=True).start()
+
+    def refresh(self) -> None:
+        """Swaps to the current snapshot now, on the calling thread, e.g. right after publishing one."""
+        self._maybe_reload(force=True)
+
+    def _reload(self, snapshot: Path) -> None:
+        try:
+            with span("local_index.reload"):
+                index = LocalVectorIndex.load(snapshot, partition_col=self.index.partition_col)
+                # Pages the new snapshot in before it serves queries, as exact search reads every vector
+                index.search(np.asarray(index.embeddings[:1]), k=1)
+            logger.info(f"Swapping the local index from {self.index.version} to {index.version}")
+            self.index = index
+        except Exception:
+            logger.exception(f"Could not load the index snapshot {snapshot}, keeping {self.index.version}")
+        finally:
+            self._reloading = False
+
+    def search_batch(
+        self,
+        queries: Sequence[str],
+        cols: Sequence[str] = TABLE_COLS,
+        num_results: int = N_SIMILAR_ISSUES,
+        filters: Filters | None = None,
+    ) -> list[IssueRecords]:
+        self._maybe_reload()
+        # The same snapshot for the whole search, even if a new one is swapped in meanwhile
+        index = self.index
+        with span("local_index.embed"):
+            query_vectors = self.embed(queries)
+        rows = index.filter_rows(filters)
+        with span(f"local_index.search_{self.mode}"):
+            scores, indices = index.search(query_vectors, k=num_results, mode=self.mode, nprobe=self.nprobe, rows=rows)
+        # Snapshots written before the Title column lack it
+        cols = [c for c in cols if c in index.columns]
+        fields = issue_fields(tuple(cols))
+        with span("local_index.decode_results"):
+            results = []
+            for _scores, _indices in zip(scores, indices):
+                found = _indices >= 0
+                _indices = _indices[found]
+                results.append(
+                    IssueRecords(fields, [index.columns[c][_indices].tolist() for c in cols], _scores[found])
+                )
+            return results
+
+    def search(
+        self,
+        query: str,
+        cols: Sequence[str] = TABLE_COLS,
+        num_results: int = N_SIMILAR_ISSUES,
+        filters: Filters | None = None,
+    ) -> IssueRecords:
+        return self.search_batch([query], cols=cols, num_results=num_results, filters=filters)[0]
+
+    def fetch_originals(self, ids: Sequence[float]) -> dict[float, str]:
+        index = self.index
+        rows = index.rows_for_ids(ids)
+        return {i: index.columns["Original"][row] for i, row in zip(ids, rows.tolist()) if row >= 0}
+
+
+def get_local_vector_searcher(embed: QueryEmbedder) -> LocalVectorSearcher:
+    path = os.environ["LOCAL_INDEX_PATH"]
+    index = LocalVectorIndex.load(path, partition_col=os.getenv("LOCAL_INDEX_PARTITION_COLUMN", "Market") or None)
+    mode: SearchMode = "ivf" if os.getenv("LOCAL_INDEX_MODE", "exact") == "ivf" else "exact"
+    return LocalVectorSearcher(
+        index,
+        embed=embed,
+        mode=mode,
+        nprobe=int(os.getenv("LOCAL_INDEX_NPROBE", 8)),
+        # Only a snapshot root gets new snapshots
+        source=path if (Path(path) / CURRENT_FILE).exists() else None,
+        reload_seconds=float(os.getenv("LOCAL_INDEX_RELOAD_SECONDS", 30)),
+    )
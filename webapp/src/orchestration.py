@@ -0,0 +1,157 @@
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterator, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TypeVar
+
+import streamlit as st
+
+from src.search_cache import normalize_query
+from src.telemetry import timed
+from src.vector_search import (
+    N_SIMILAR_ISSUES,
+    SUMMARY_COLS,
+    Filters,
+    SimilarIssue,
+    SimilarIssueSearcher,
+    filters_key,
+    get_vector_searcher,
+    is_degraded,
+    search_scoped,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+ORCHESTRATOR_WORKERS = int(os.getenv("ORCHESTRATOR_WORKERS", 16))
+# The scopes of a search (e.g. turbine, site, market and the unfiltered fallback) are searched concurrently
+SCOPE_SEARCH_WORKERS = int(os.getenv("SCOPE_SEARCH_WORKERS", 4 * ORCHESTRATOR_WORKERS))
+# How long a finished search is still shared, e.g. with the rerun that follows the speculative search (0 disables it)
+ORCHESTRATOR_RESULT_TTL_SECONDS = float(os.getenv("ORCHESTRATOR_RESULT_TTL_SECONDS", 30))
+
+_END = object()
+
+
+def description_fingerprint(
+    description: str, num_results: int = N_SIMILAR_ISSUES, scopes: Sequence[Filters] = ()
+) -> str:
+    _scopes = [filters_key(i) for i in scopes]
+    return hashlib.sha1(f"{num_results}:{_scopes}:{normalize_query(description)}".encode()).hexdigest()
+
+
+class SearchOrchestrator:
+    """Starts similarity searches in the background and shares them by description fingerprint while they run.
+
+    A search in flight is reused by every rerun and session asking for the same description, so speculative searches
+    (started while the user is still editing) are not repeated. Finished searches are still shared for
+    `result_ttl_seconds`, so that the rerun submitting the description does not search again when the search cache is
+    disabled. They are not invalidated when the index changes, so keep it short: caching results (and invalidating
+    them) is the `CachedSearcher`'s job. Failed and degraded searches are forgotten right away.
+    """
+
+    def __init__(
+        self,
+        searcher: SimilarIssueSearcher,
+        executor: ThreadPoolExecutor,
+        result_ttl_seconds: float = ORCHESTRATOR_RESULT_TTL_SECONDS,
+    ):
+        self.searcher = searcher
+        self.executor = executor
+        self.result_ttl_seconds = result_ttl_seconds
+        self._searches: dict[str, Future[list[SimilarIssue]]] = {}
+        # Fingerprint -> when the search finished, oldest first
+        self._finished: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+        # Separate from `executor`, whose searches wait on their scopes: sharing it could deadlock once it is busy
+        self._scope_executor = ThreadPoolExecutor(max_workers=SCOPE_SEARCH_WORKERS, thread_name_prefix="scope-search")
+
+    def submit(
+        self, description: str, num_results: int = N_SIMILAR_ISSUES, scopes: Sequence[Filters] = ()
+    ) -> Future[list[SimilarIssue]]:
+        """Searches the issues similar to `description`, from the narrowest of the `scopes` (filters) first."""
+        key = description_fingerprint(description, num_results, scopes)
+        with self._lock:
+            self._expire()
+            future = self._searches.get(key)
+            if future is not None:
+                return future
+            future = self._searches[key] = self.executor.submit(self._search, description, num_results, scopes)
+        # Outside of the lock, as the callback runs right away if the search already finished
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def _forget(self, key: str, future: Future[list[SimilarIssue]]) -> None:
+        with self._lock:
+            if self._searches.get(key) is not future:
+                return
+            succeeded = not future.cancelled() and future.exception() is None
+            if self.result_ttl_seconds > 0 and succeeded and not is_degraded(future.result()):
+                self._finished[key] = time.monotonic()
+            else:
+                del self._searches[key]
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        while self._finished and now - next(iter(self._finished.values())) >= self.result_ttl_seconds:
+            key, _ = self._finished.popitem(last=False)
+            del self._searches[key]
+
+    @timed("search.total")
+    def _search(self, description: str, num_results: int, scopes: Sequence[Filters]) -> list[SimilarIssue]:
+        # Only what the similar issues list and the prompt need, the full original is fetched when displayed
+        return search_scoped(
+            self.searcher,
+            description,
+            scopes,
+            cols=SUMMARY_COLS,
+            num_results=num_results,
+            executor=self._scope_executor if scopes else None,
+        )
+
+    def search(
+        self, description: str, num_results: int = N_SIMILAR_ISSUES, scopes: Sequence[Filters] = ()
+    ) -> list[SimilarIssue]:
+        return self.submit(description, num_results=num_results, scopes=scopes).result()
+
+
+def prefetch(iterator: Iterator[T], executor: ThreadPoolExecutor) -> Iterator[T]:
+    """Consumes `iterator` on a background thread, so that it makes progress while the caller renders other elements.
+
+    Items (and any exception) are handed over through a queue, in order.
+    """
+    buffer: queue.Queue = queue.Queue()
+
+    def _produce() -> None:
+        try:
+            for item in iterator:
+                buffer.put(item)
+        except Exception as e:
+            buffer.put(e)
+        finally:
+            buffer.put(_END)
+
+    executor.submit(_produce)
+
+    def _consume() -> Iterator[T]:
+        while (item := buffer.get()) is not _END:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    return _consume()
+
+
+@st.cache_resource
+def get_orchestrator_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=ORCHESTRATOR_WORKERS, thread_name_prefix="orchestrator")
+
+
+@st.cache_resource
+def get_search_orchestrator() -> SearchOrchestrator:
+    return SearchOrchestrator(get_vector_searcher(), executor=get_orchestrator_executor())
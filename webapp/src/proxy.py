@@ -0,0 +1,147 @@
+"""Path-routing reverse proxy, serving the UI and the API on the single port of the Databricks App (`APP_MODE=both`).
+
+`/api/...` is forwarded to the API (without the prefix) and everything else to Streamlit, including its websocket.
+Responses are streamed back as they arrive, so streamed recommendations keep their time to first token.
+"""
+
+import logging
+
+from tornado import httputil, web, websocket
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+
+logger = logging.getLogger(__name__)
+
+API_PREFIX = "/api"
+STREAMLIT_WEBSOCKET_PATH = "/_stcore/stream"
+# Streamed recommendations are bounded by the API's own deadlines, this only cuts off a hung upstream
+UPSTREAM_TIMEOUT_SECONDS = 600.0
+
+_HOP_BY_HOP_HEADERS = frozenset(
+    (
+        *("connection", "keep-alive", "proxy-connection", "transfer-encoding", "te", "trailer", "upgrade"),
+        # Recomputed for the forwarded body, which the proxy already read
+        *("content-length", "expect"),
+    )
+)
+# Of the client's handshake, the upstream one has its own
+_WEBSOCKET_HEADERS = frozenset(
+    ("sec-websocket-key", "sec-websocket-version", "sec-websocket-extensions", "sec-websocket-protocol")
+)
+# Set on the proxy's own responses, replaced by the upstream's
+_DEFAULT_HEADERS = ("Content-Type", "Server", "Date")
+
+
+def _forwarded_headers(headers: httputil.HTTPHeaders, exclude: frozenset[str] = _HOP_BY_HOP_HEADERS) -> dict[str, str]:
+    return {k: v for k, v in headers.get_all() if k.lower() not in exclude}
+
+
+class _ProxyHandler(web.RequestHandler):
+    SUPPORTED_METHODS = ("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS")
+
+    def initialize(self, upstream: str, strip_prefix: str = "") -> None:
+        self.upstream = upstream
+        self.strip_prefix = strip_prefix
+
+    def _on_header(self, line: str) -> None:
+        line = line.rstrip("\r\n")
+        if line.startswith("HTTP/"):
+            # Also called for an interim `100 Continue`, whose headers the final response replaces
+            start_line = httputil.parse_response_start_line(line)
+            self.clear()
+            for name in _DEFAULT_HEADERS:
+                self.clear_header(name)
+            self.set_status(start_line.code, start_line.reason)
+        elif ":" in line:
+            name, value = line.split(":", 1)
+            if name.lower() not in _HOP_BY_HOP_HEADERS:
+                self.add_header(name, value.strip())
+
+    def _on_chunk(self, chunk: bytes) -> None:
+        self.write(chunk)
+        self.flush()
+
+    async def _proxy(self) -> None:
+        path = (self.request.uri or "/").removeprefix(self.strip_prefix)
+        request = HTTPRequest(
+            f"{self.upstream}{path if path.startswith('/') else '/' + path}",
+            method=self.request.method or "GET",
+            headers=_forwarded_headers(self.request.headers),
+            body=self.request.body if self.request.method in ("POST", "PUT", "PATCH") else None,
+            follow_redirects=False,
+            decompress_response=False,
+            request_timeout=UPSTREAM_TIMEOUT_SECONDS,
+            header_callback=self._on_header,
+            streaming_callback=self._on_chunk,
+        )
+        try:
+            await AsyncHTTPClient().fetch(request, raise_error=False)
+        except (OSError, HTTPClientError) as e:
+            logger.warning(f"{self.request.method} {self.request.uri} failed upstream ({type(e).__name__}: {e})")
+            raise web.HTTPError(502) from e
+        self.finish()
+
+    get = head = post = put = patch = delete = options = _proxy
+
+
+class _WebSocketProxyHandler(websocket.WebSocketHandler):
+    """Relays the messages of a websocket both ways, connecting upstream before accepting the client."""
+
+    def initialize(self, upstream: str) -> None:
+        self.upstream = upstream
+        self.upstream_connection: websocket.WebSocketClientConnection | None = None
+        self._pending: list[str | bytes] | None = []
+
+    async def prepare(self) -> None:
+        # Streamlit passes its XSRF token as a subprotocol, so the upstream picks the one the client gets
+        subprotocols = [p.strip() for p in self.request.headers.get("Sec-WebSocket-Protocol", "").split(",")]
+        request = HTTPRequest(
+            f"ws{self.upstream.removeprefix('http')}{self.request.uri}",
+            headers=_forwarded_headers(self.request.headers, _HOP_BY_HOP_HEADERS | _WEBSOCKET_HEADERS),
+        )
+        try:
+            self.upstream_connection = await websocket.websocket_connect(
+                request, on_message_callback=self._on_upstream_message, subprotocols=[p for p in subprotocols if p]
+            )
+        except (OSError, HTTPClientError, websocket.WebSocketError) as e:
+            logger.warning(f"Websocket {self.request.uri} failed upstream ({type(e).__name__}: {e})")
+            raise web.HTTPError(502) from e
+
+    def check_origin(self, origin: str) -> bool:
+        # The origin is forwarded, and checked by the upstream
+        return True
+
+    def select_subprotocol(self, subprotocols: list[str]) -> str | None:
+        return self.upstream_connection.selected_subprotocol if self.upstream_connection is not None else None
+
+    def open(self, *args: str, **kwargs: str) -> None:
+        pending, self._pending = self._pending or [], None
+        for message in pending:
+            self.write_message(message, binary=isinstance(message, bytes))
+
+    def _on_upstream_message(self, message: str | bytes | None) -> None:
+        if message is None:
+            self.close()
+        elif self._pending is not None:
+            # The upstream can answer before the client's handshake is complete
+            self._pending.append(message)
+        else:
+            self.write_message(message, binary=isinstance(message, bytes))
+
+    async def on_message(self, message: str | bytes) -> None:
+        if self.upstream_connection is not None:
+            await self.upstream_connection.write_message(message, binary=isinstance(message, bytes))
+
+    def on_close(self) -> None:
+        if self.upstream_connection is not None:
+            self.upstream_connection.close()
+
+
+def make_proxy(api_url: str, streamlit_url: str) -> web.Application:
+    """Routes `/api/...` to `api_url` and everything else to `streamlit_url`, e.g. "http://127.0.0.1:8501"."""
+    return web.Application(
+        [
+            (rf"{API_PREFIX}(?:/.*)?", _ProxyHandler, {"upstream": api_url, "strip_prefix": API_PREFIX}),
+            (STREAMLIT_WEBSOCKET_PATH, _WebSocketProxyHandler, {"upstream": streamlit_url}),
+            (r".*", _ProxyHandler, {"upstream": streamlit_url}),
+        ]
+    )
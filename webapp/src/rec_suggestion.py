@@ -1,24 +1,310 @@
+import logging
 import os
+import threading
+import time
+from collections.abc import Callable, Generator, Iterator, Sequence
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, TypeVar
 
-from openai import OpenAI
-
+from src.completion_cache import CompletionCache, completion_cache_key
+from src.context_builder import PROMPT_CONTEXT_TOKEN_BUDGET, build_context, estimate_tokens
+from src.llm_usage import LLMUsage, Outcome, record_usage
+from src.resilience import CircuitBreaker
+from src.resources import required_env
+from src.telemetry import increment, observe, span, timed
 from src.vector_search import SimilarIssue
 
-INSTRUCT_MODEL = os.environ["INSTRUCT_MODEL"]
+if TYPE_CHECKING:
+    from openai import OpenAI, Stream
+    from openai.types import CompletionUsage
+    from openai.types.chat import ChatCompletionChunk, ChatCompletionMessageParam
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Deadline of a completion (or of its first token, and then of every next one when streamed)
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", 30))
+# Retries of the client, each with the full timeout: none by default, so that the deadline holds for the engineer
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 0))
+
+# Issue descriptions up to this many tokens are sent to the SMALL_INSTRUCT_MODEL serving endpoint first, if any, and
+# escalated to INSTRUCT_MODEL when it is unavailable or gives an empty (or cut off) recommendation
+SMALL_MODEL_MAX_ISSUE_TOKENS = int(os.getenv("SMALL_MODEL_MAX_ISSUE_TOKENS", 200))
+# Chunks of the small model's stream held back before showing it, so that a recommendation that ends (empty, or cut
+# off) within them is still escalated
+SMALL_MODEL_HOLDBACK_CHUNKS = int(os.getenv("SMALL_MODEL_HOLDBACK_CHUNKS", 16))
+
+llm_breaker = CircuitBreaker("llm")
+small_llm_breaker = CircuitBreaker("llm_small")
+
+
+class LLMUnavailableError(RuntimeError):
+    """The serving endpoint failed, missed its deadline or its breaker is open: show the similar issues only."""
+
+
+@dataclass
+class GenerationTiming:
+    time_to_first_token_s: float | None = None
+    total_s: float | None = None
+    cancelled: bool = False
+    context_tokens: int | None = None
+
 
+def _models(issue: str) -> list[str]:
+    """The models a recommendation is asked from, in order, until one gives it."""
+    model, small_model = required_env("INSTRUCT_MODEL"), os.getenv("SMALL_INSTRUCT_MODEL")
+    if small_model and estimate_tokens(issue) <= SMALL_MODEL_MAX_ISSUE_TOKENS:
+        return [small_model, model]
+    return [model]
 
-def _generate_response(open_ai_client: OpenAI, prompt: str) -> str | None:
-    response = open_ai_client.chat.completions.create(
-        model=INSTRUCT_MODEL,
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.0,
+
+def _breaker(model: str) -> CircuitBreaker:
+    return llm_breaker if model == required_env("INSTRUCT_MODEL") else small_llm_breaker
+
+
+def _call_endpoint(create: Callable[[], T], breaker: CircuitBreaker = llm_breaker) -> T:
+    """Calls the serving endpoint through its circuit breaker, raising `LLMUnavailableError` if it is down."""
+    import openai
+
+    if not breaker.allow():
+        raise LLMUnavailableError("The serving endpoint's circuit breaker is open")
+    try:
+        result = create()
+    except (openai.APIConnectionError, openai.InternalServerError, openai.RateLimitError) as e:
+        _record_unavailable(e, breaker)
+        raise LLMUnavailableError(f"{type(e).__name__}: {e}") from e
+    except Exception:
+        # The endpoint answered, e.g. rejecting the request
+        breaker.record_success()
+        raise
+    breaker.record_success()
+    return result
+
+
+def _record_unavailable(error: Exception, breaker: CircuitBreaker) -> None:
+    import httpx
+    import openai
+
+    breaker.record_failure()
+    timed_out = isinstance(error, openai.APITimeoutError | httpx.TimeoutException)
+    increment(f"resilience.{breaker.name}.timeouts" if timed_out else f"resilience.{breaker.name}.failures")
+
+
+def _record_usage(
+    model: str,
+    prompt: str,
+    content: str,
+    usage: "CompletionUsage | None",
+    start: float,
+    streamed: bool,
+    outcome: Outcome,
+) -> None:
+    record_usage(
+        LLMUsage(
+            model=model,
+            prompt_tokens=usage.prompt_tokens if usage is not None else estimate_tokens(prompt),
+            completion_tokens=usage.completion_tokens if usage is not None else estimate_tokens(content),
+            latency_s=time.perf_counter() - start,
+            streamed=streamed,
+            outcome=outcome,
+            estimated=usage is None,
+        )
     )
-    return response.choices[0].message.content
 
 
-def _augment_prompt(prompt: str, similar_issues: list[SimilarIssue]) -> str:
-    previous_issues = "\n\n".join([f"## Issue {i}:\n{_issue}" for i, _issue in enumerate(similar_issues, start=1)])
+@timed("llm.generate")
+def _generate_response(
+    open_ai_client: "OpenAI", prompt: str, cache: CompletionCache | None = None, models: Sequence[str] = ()
+) -> str | None:
+    models = models or [required_env("INSTRUCT_MODEL")]
+    messages: list[ChatCompletionMessageParam] = [{"role": "user", "content": prompt}]
+    cache_keys = {model: completion_cache_key(model, messages, temperature=0.0) for model in models}
+    for cache_key in cache_keys.values():
+        if cache is not None and (cached := cache.get(cache_key)) is not None:
+            return cached
+
+    for n_model, model in enumerate(models):
+        escalable = n_model < len(models) - 1
+        start = time.perf_counter()
+        try:
+            response = _call_endpoint(
+                lambda: open_ai_client.with_options(
+                    timeout=LLM_TIMEOUT_SECONDS, max_retries=LLM_MAX_RETRIES
+                ).chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=0.0,
+                ),
+                breaker=_breaker(model),
+            )
+        except LLMUnavailableError:
+            _record_usage(
+                model, prompt, "", None, start, streamed=False, outcome="escalated" if escalable else "failed"
+            )
+            if not escalable:
+                raise
+            continue
+        choice = response.choices[0]
+        content = choice.message.content
+        cut_off = choice.finish_reason == "length"
+        escalated = escalable and (not (content or "").strip() or cut_off)
+        outcome: Outcome = "escalated" if escalated else "truncated" if cut_off else "ok"
+        _record_usage(model, prompt, content or "", response.usage, start, streamed=False, outcome=outcome)
+        if not escalated:
+            break
+    if cache is not None and content is not None:
+        cache.set(cache_keys[model], content)
+    return content
 
+
+def _read_stream(response: Iterator[T], breaker: CircuitBreaker = llm_breaker) -> Iterator[T]:
+    import httpx
+
+    try:
+        yield from response
+    except httpx.TransportError as e:
+        # A cold or overloaded endpoint stalling before (or between) the tokens
+        _record_unavailable(e, breaker)
+        raise LLMUnavailableError(f"{type(e).__name__}: {e}") from e
+
+
+def _release(content: list[str], n_yielded: int, timing: GenerationTiming, start: float) -> Iterator[str]:
+    """Yields the tokens not yielded yet, if any, recording the time to the first one."""
+    if n_yielded < len(content):
+        if timing.time_to_first_token_s is None:
+            timing.time_to_first_token_s = time.perf_counter() - start
+        yield "".join(content[n_yielded:])
+
+
+def _chunk_delta(chunk: "ChatCompletionChunk") -> tuple[str, str | None]:
+    """The text and the finish reason (if it is the last) of a stream's chunk."""
+    if not chunk.choices:
+        return "", None
+    return chunk.choices[0].delta.content or "", chunk.choices[0].finish_reason
+
+
+def _open_stream(
+    open_ai_client: "OpenAI", model: str, prompt: str, escalable: bool
+) -> "Stream[ChatCompletionChunk] | None":
+    """The model's stream, or None to escalate to the next model when `escalable` and the model is unavailable."""
+    messages: list[ChatCompletionMessageParam] = [{"role": "user", "content": prompt}]
+    start = time.perf_counter()
+    try:
+        return _call_endpoint(
+            lambda: open_ai_client.with_options(
+                timeout=LLM_TIMEOUT_SECONDS, max_retries=LLM_MAX_RETRIES
+            ).chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0.0,
+                stream=True,
+            ),
+            breaker=_breaker(model),
+        )
+    except LLMUnavailableError:
+        _record_usage(model, prompt, "", None, start, streamed=True, outcome="escalated" if escalable else "failed")
+        if not escalable:
+            raise
+        return None
+
+
+def _stream_model(
+    open_ai_client: "OpenAI",
+    model: str,
+    prompt: str,
+    cancel_event: threading.Event | None,
+    timing: GenerationTiming,
+    start: float,
+    escalable: bool,
+) -> Generator[str, None, list[str] | None]:
+    """Yields a model's recommendation as it is generated and returns it, or returns None to escalate it to the next
+    model, when `escalable` and the model is unavailable, or ends without a token or cut off before any was yielded."""
+    breaker, model_start = _breaker(model), time.perf_counter()
+    if (response := _open_stream(open_ai_client, model, prompt, escalable)) is None:
+        return None
+    content: list[str] = []
+    usage, finish_reason, n_yielded = None, None, 0
+    holdback = SMALL_MODEL_HOLDBACK_CHUNKS if escalable else 0
+    outcome: Outcome = "failed"
+    try:
+        for chunk in _read_stream(response, breaker):
+            if cancel_event is not None and cancel_event.is_set():
+                timing.cancelled, outcome = True, "cancelled"
+                return content
+            # Only sent by the endpoints that report the usage of a stream, in its last chunk
+            usage = getattr(chunk, "usage", None) or usage
+            delta, chunk_finish_reason = _chunk_delta(chunk)
+            finish_reason = chunk_finish_reason or finish_reason
+            if delta:
+                content.append(delta)
+            if len(content) > holdback:
+                yield from _release(content, n_yielded, timing, start)
+                n_yielded = len(content)
+        if escalable and not n_yielded and (not "".join(content).strip() or finish_reason == "length"):
+            outcome = "escalated"
+            return None
+        yield from _release(content, n_yielded, timing, start)
+        n_yielded = len(content)
+        outcome = "truncated" if finish_reason == "length" else "ok"
+        return content
+    except LLMUnavailableError:
+        if not escalable or n_yielded:
+            raise
+        outcome = "escalated"
+        return None
+    except GeneratorExit:
+        # The consumer stopped reading
+        timing.cancelled, outcome = True, "cancelled"
+        raise
+    finally:
+        # Closing the stream drops the connection, so the endpoint stops generating tokens nobody will read
+        response.close()
+        _record_usage(model, prompt, "".join(content), usage, model_start, streamed=True, outcome=outcome)
+
+
+def _stream_response(
+    open_ai_client: "OpenAI",
+    prompt: str,
+    cache: CompletionCache | None = None,
+    cancel_event: threading.Event | None = None,
+    timing: GenerationTiming | None = None,
+    models: Sequence[str] = (),
+) -> Iterator[str]:
+    timing = timing if timing is not None else GenerationTiming()
+    start = time.perf_counter()
+    models = models or [required_env("INSTRUCT_MODEL")]
+    messages: list[ChatCompletionMessageParam] = [{"role": "user", "content": prompt}]
+    cache_keys = {model: completion_cache_key(model, messages, temperature=0.0) for model in models}
+    for cache_key in cache_keys.values():
+        if cache is not None and (cached := cache.get(cache_key)) is not None:
+            timing.time_to_first_token_s = timing.total_s = time.perf_counter() - start
+            yield cached
+            return
+
+    content = None
+    try:
+        for n_model, model in enumerate(models):
+            escalable = n_model < len(models) - 1
+            content = yield from _stream_model(open_ai_client, model, prompt, cancel_event, timing, start, escalable)
+            if content is not None:
+                break
+    except GeneratorExit:
+        # The consumer stopped early, e.g. Streamlit interrupted the script run for a rerun
+        timing.cancelled = True
+        raise
+    finally:
+        timing.total_s = time.perf_counter() - start
+        observe("llm.stream_total", timing.total_s)
+        if timing.time_to_first_token_s is not None:
+            observe("llm.time_to_first_token", timing.time_to_first_token_s)
+        logger.info(f"Recommendation generation: {timing}")
+
+    if cache is not None and content is not None and not timing.cancelled:
+        cache.set(cache_keys[model], "".join(content))
+
+
+def _augment_prompt(prompt: str, previous_issues: str) -> str:
     augmented_prompt = f"""
     You are an expert turbine performance engineer.
     You are given a current issue symptoms and previous issues with their symptoms, recommendations and resolutions as
@@ -36,6 +322,37 @@ def _augment_prompt(prompt: str, similar_issues: list[SimilarIssue]) -> str:
     return augmented_prompt
 
 
-def get_suggested_recommendation(open_ai_client: OpenAI, prompt: str, similar_issues: list[SimilarIssue]) -> str | None:
-    augmented_prompt = _augment_prompt(prompt, similar_issues)
-    return _generate_response(open_ai_client, augmented_prompt)
+def get_suggested_recommendation(
+    open_ai_client: "OpenAI",
+    prompt: str,
+    similar_issues: Sequence[SimilarIssue],
+    cache: CompletionCache | None = None,
+    token_budget: int = PROMPT_CONTEXT_TOKEN_BUDGET,
+) -> str | None:
+    with span("prompt.build_context"):
+        context = build_context(similar_issues, token_budget=token_budget)
+    augmented_prompt = _augment_prompt(prompt, context.text)
+    return _generate_response(open_ai_client, augmented_prompt, cache=cache, models=_models(prompt))
+
+
+def stream_suggested_recommendation(
+    open_ai_client: "OpenAI",
+    prompt: str,
+    similar_issues: Sequence[SimilarIssue],
+    cache: CompletionCache | None = None,
+    cancel_event: threading.Event | None = None,
+    timing: GenerationTiming | None = None,
+    token_budget: int = PROMPT_CONTEXT_TOKEN_BUDGET,
+) -> Iterator[str]:
+    """Yields the recommendation as it is generated, stopping early once `cancel_event` is set.
+
+    Time to first token, total latency and the tokens of context used are recorded in `timing`.
+    """
+    timing = timing if timing is not None else GenerationTiming()
+    with span("prompt.build_context"):
+        context = build_context(similar_issues, token_budget=token_budget)
+    timing.context_tokens = context.tokens
+    augmented_prompt = _augment_prompt(prompt, context.text)
+    yield from _stream_response(
+        open_ai_client, augmented_prompt, cache=cache, cancel_event=cancel_event, timing=timing, models=_models(prompt)
+    )
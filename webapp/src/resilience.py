@@ -0,0 +1,272 @@
+"""Tail-latency protection of the remote calls: deadlines, hedged requests, circuit breakers and degraded fallbacks.
+
+A search that has not answered after the p95 of the recent searches (`SEARCH_HEDGE_QUANTILE`) is sent again, and the
+first answer wins. Past `SEARCH_DEADLINE_SECONDS`, or when the breaker is open after `BREAKER_FAILURES` consecutive
+failures, the search fails over to the local index snapshot at `FALLBACK_INDEX_PATH`, if any, then to the last results
+of the same query. Fetching the originals of the displayed issues has the same deadline, breaker and fallback index.
+The breaker lets one call through again after `BREAKER_RESET_SECONDS`. A recommendation that misses
+`LLM_TIMEOUT_SECONDS` (see `src/rec_suggestion.py`) falls back to showing the similar issues only.
+
+Hedges, timeouts, breaker transitions and fallbacks are counted as `resilience.*` metrics.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Sequence
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import TypeVar
+
+from src.search_cache import normalize_query
+from src.telemetry import Histogram, increment
+from src.vector_search import (
+    N_SIMILAR_ISSUES,
+    TABLE_COLS,
+    DegradedResults,
+    Filters,
+    SimilarIssue,
+    SimilarIssueSearcher,
+    fetch_originals,
+    filters_key,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+SEARCH_DEADLINE_SECONDS = float(os.getenv("SEARCH_DEADLINE_SECONDS", 5))
+SEARCH_HEDGE_QUANTILE = float(os.getenv("SEARCH_HEDGE_QUANTILE", 0.95))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", 5))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", 30))
+FALLBACK_INDEX_PATH = os.getenv("FALLBACK_INDEX_PATH")
+# Latencies the hedge delay is computed from, and how many are needed before hedging at all
+HEDGE_SAMPLES = 200
+MIN_HEDGE_SAMPLES = 20
+STALE_RESULTS_SIZE = 1024
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures, rejecting calls for `reset_seconds`, then lets one trial
+    call through (half-open): it closes again if the trial succeeds, and stays open for another period otherwise."""
+
+    def __init__(
+        self, name: str, failure_threshold: int = BREAKER_FAILURES, reset_seconds: float = BREAKER_RESET_SECONDS
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial_in_flight or time.monotonic() - self.opened_at < self.reset_seconds:
+                increment(f"resilience.{self.name}.rejected")
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info(f"Circuit breaker {self.name} closed")
+                increment(f"resilience.{self.name}.closed")
+            self.failures, self.opened_at, self._trial_in_flight = 0, None, False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_flight or (self.opened_at is None and self.failures >= self.failure_threshold):
+                if self.opened_at is None:
+                    logger.warning(f"Circuit breaker {self.name} opened after {self.failures} failures")
+                    increment(f"resilience.{self.name}.opened")
+                self.opened_at, self._trial_in_flight = time.monotonic(), False
+
+    def call(self, fn: Callable[[], T]) -> T:
+        if not self.allow():
+            raise CircuitOpenError(f"Circuit breaker {self.name} is open")
+        try:
+            result = fn()
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+class HedgedCaller:
+    """Runs a call with a deadline, sending a duplicate once it is slower than the `quantile` of the recent calls."""
+
+    def __init__(self, name: str, executor: ThreadPoolExecutor, quantile: float = SEARCH_HEDGE_QUANTILE):
+        self.name = name
+        self.executor = executor
+        self.quantile = quantile
+        self.latencies = Histogram(max_samples=HEDGE_SAMPLES)
+
+    def hedge_delay(self) -> float | None:
+        if self.latencies.count < MIN_HEDGE_SAMPLES:
+            return None
+        return self.latencies.quantiles((self.quantile,))[self.quantile]
+
+    def _timed(self, fn: Callable[[], T]) -> T:
+        start = time.perf_counter()
+        result = fn()
+        self.latencies.observe(time.perf_counter() - start)
+        return result
+
+    def __call__(self, fn: Callable[[], T], deadline_seconds: float) -> T:
+        """The first successful result, raising `TimeoutError` past the deadline. Calls still running past it are
+        left to finish on the executor, as blocking calls cannot be interrupted."""
+        start = time.monotonic()
+        hedge_delay = self.hedge_delay()
+        pending = {self.executor.submit(self._timed, fn)}
+        error: BaseException | None = None
+        while pending:
+            wait_until = deadline_seconds if hedge_delay is None else min(hedge_delay, deadline_seconds)
+            done, pending = wait(
+                pending, timeout=max(0.0, start + wait_until - time.monotonic()), return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                if (error := future.exception()) is None:
+                    return future.result()
+            if time.monotonic() - start >= deadline_seconds:
+                increment(f"resilience.{self.name}.timeouts")
+                raise TimeoutError(f"{self.name} missed its {deadline_seconds}s deadline")
+            if hedge_delay is not None and pending and time.monotonic() - start >= hedge_delay:
+                increment(f"resilience.{self.name}.hedged")
+                pending.add(self.executor.submit(self._timed, fn))
+                hedge_delay = None
+        assert error is not None  # mypy fix
+        raise error
+
+
+class ResilientSearcher:
+    """Protects the searches of a remote index with a deadline, hedged requests and a circuit breaker.
+
+    When the index fails, misses the deadline or its breaker is open, the `fallback` searcher (e.g. a local snapshot of
+    the index) answers instead, then the last results of the same query, if any, as `DegradedResults`.
+    """
+
+    def __init__(
+        self,
+        searcher: SimilarIssueSearcher,
+        fallback: SimilarIssueSearcher | None = None,
+        deadline_seconds: float = SEARCH_DEADLINE_SECONDS,
+        max_workers: int = 32,
+    ):
+        self.searcher = searcher
+        self.fallback = fallback
+        self.deadline_seconds = deadline_seconds
+        self.breaker = CircuitBreaker("search")
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="resilient-search")
+        self.hedged = HedgedCaller("search", self.executor)
+        # Lookups by ID, whose latencies are not the searches'
+        self.hedged_fetch = HedgedCaller("fetch_originals", self.executor)
+        self._version: str | None = None
+        self._stale: OrderedDict[tuple, Sequence[SimilarIssue]] = OrderedDict()
+        self._stale_lock = threading.Lock()
+
+    def index_version(self) -> str | None:
+        """The index's version, or the last one known while the index does not answer in time."""
+        get_version = getattr(self.searcher, "index_version", None)
+        if get_version is None:
+            return None
+        try:
+            self._version = self.executor.submit(get_version).result(timeout=self.deadline_seconds)
+        except Exception as e:
+            increment("resilience.index_version.failures")
+            logger.warning(f"Could not get the index version ({type(e).__name__}: {e}), keeping {self._version}")
+        return self._version
+
+    def search(
+        self,
+        query: str,
+        cols: Sequence[str] = TABLE_COLS,
+        num_results: int = N_SIMILAR_ISSUES,
+        filters: Filters | None = None,
+    ) -> Sequence[SimilarIssue]:
+        key = (normalize_query(query), num_results, tuple(cols), filters_key(filters))
+        try:
+            results = self.breaker.call(
+                lambda: self.hedged(
+                    lambda: self.searcher.search(query, cols=cols, num_results=num_results, filters=filters),
+                    deadline_seconds=self.deadline_seconds,
+                )
+            )
+        except Exception as e:
+            logger.warning(f"Search failed ({type(e).__name__}: {e}), failing over")
+            return DegradedResults(self._degraded_search(key, query, cols, num_results, filters))
+
+        with self._stale_lock:
+            self._stale[key] = results
+            self._stale.move_to_end(key)
+            if len(self._stale) > STALE_RESULTS_SIZE:
+                self._stale.popitem(last=False)
+        return results
+
+    def fetch_originals(self, ids: Sequence[float]) -> dict[float, str]:
+        """Originals of the issues, under the deadline and the breaker of the searches, from the fallback (if it has
+        them) when the index fails."""
+        try:
+            return self.breaker.call(
+                lambda: self.hedged_fetch(
+                    lambda: fetch_originals(self.searcher, ids), deadline_seconds=self.deadline_seconds
+                )
+            )
+        except Exception as e:
+            logger.warning(f"Fetching the originals failed ({type(e).__name__}: {e}), failing over")
+        if self.fallback is not None:
+            try:
+                originals = fetch_originals(self.fallback, ids)
+                increment("resilience.fetch_originals.fallback_index")
+                return originals
+            except Exception:
+                logger.exception("The fallback index failed too")
+        increment("resilience.fetch_originals.fallback_empty")
+        return {}
+
+    def _degraded_search(
+        self, key: tuple, query: str, cols: Sequence[str], num_results: int, filters: Filters | None
+    ) -> Sequence[SimilarIssue]:
+        if self.fallback is not None:
+            try:
+                results = self.fallback.search(query, cols=cols, num_results=num_results, filters=filters)
+                increment("resilience.search.fallback_index")
+                return results
+            except Exception:
+                logger.exception("The fallback index failed too")
+        with self._stale_lock:
+            stale = self._stale.get(key)
+        increment("resilience.search.fallback_stale" if stale is not None else "resilience.search.fallback_empty")
+        return stale if stale is not None else []
+
+
+def get_fallback_searcher() -> SimilarIssueSearcher | None:
+    """The local index snapshot (or snapshot root) at `FALLBACK_INDEX_PATH`, embedding the queries like the index."""
+    if not FALLBACK_INDEX_PATH:
+        return None
+    from src.local_index import CURRENT_FILE, LocalVectorIndex, LocalVectorSearcher
+    from src.vector_search import get_query_embedder
+
+    try:
+        index = LocalVectorIndex.load(FALLBACK_INDEX_PATH)
+    except Exception:
+        logger.exception(f"Could not load the fallback index {FALLBACK_INDEX_PATH}, searching without one")
+        return None
+    source = FALLBACK_INDEX_PATH if (Path(FALLBACK_INDEX_PATH) / CURRENT_FILE).exists() else None
+    return LocalVectorSearcher(index, embed=get_query_embedder(), source=source)
@@ -1,36 +1,118 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
 from base64 import b64decode
+from typing import TYPE_CHECKING
 
 import streamlit as st
-from databricks.sdk import WorkspaceClient
-from databricks.vector_search.client import VectorSearchClient
-from openai import OpenAI
 
+from src.completion_cache import SQLiteCompletionCache
+from src.telemetry import span, timed
 
-def _get_dbx_secret(workspace_client: WorkspaceClient, scope: str, key: str) -> str:
+if TYPE_CHECKING:
+    # Imported when the clients are created instead, they take seconds to import (vector search pulls in mlflow)
+    from databricks.sdk import WorkspaceClient
+    from databricks.vector_search.client import VectorSearchClient
+    from openai import OpenAI
+
+logger = logging.getLogger(__name__)
+
+# Connections to the serving endpoints are pooled by the shared client, across Streamlit sessions and API requests
+OPEN_AI_MAX_CONNECTIONS = int(os.getenv("OPEN_AI_MAX_CONNECTIONS", 64))
+# Base URL of local stand-ins for the Databricks services (`benchmarks/fakes.py`), e.g. for load tests: the clients then
+# need neither a workspace nor a secret
+FAKE_SERVICES_URL = os.getenv("FAKE_SERVICES_URL")
+# Snapshot of the completion cache on a volume, shared with the summarization job: the local cache is merged with it on
+# startup and then every COMPLETION_CACHE_SYNC_SECONDS
+COMPLETION_CACHE_SNAPSHOT_PATH = os.getenv("COMPLETION_CACHE_SNAPSHOT_PATH")
+COMPLETION_CACHE_SYNC_SECONDS = float(os.getenv("COMPLETION_CACHE_SYNC_SECONDS", 600))
+
+
+def required_env(name: str) -> str:
+    """Required configuration, read when it is first used so that importing the app does not depend on it."""
+    if not (value := os.getenv(name)):
+        raise RuntimeError(f"The {name} environment variable must be set")
+    return value
+
+
+@timed("resources.get_secret")
+def _get_dbx_secret(workspace_client: "WorkspaceClient", scope: str, key: str) -> str:
     _encoded_secret = workspace_client.secrets.get_secret(scope=scope, key=key).value
     assert isinstance(_encoded_secret, str)  # mypy fix
     return b64decode(_encoded_secret).decode()
 
 
+def _host_and_token() -> tuple[str, str]:
+    if FAKE_SERVICES_URL:
+        return FAKE_SERVICES_URL, "fake-token"
+    workspace_client = get_workspace_client()
+    token = _get_dbx_secret(workspace_client=workspace_client, scope="eng-rec-scope", key="databricks-token")
+    assert workspace_client.config.host is not None  # mypy fix
+    return workspace_client.config.host, token
+
+
 @st.cache_resource
-def get_workspace_client() -> WorkspaceClient:
-    return WorkspaceClient()
+def get_workspace_client() -> "WorkspaceClient":
+    from databricks.sdk import WorkspaceClient
+
+    with span("resources.workspace_client"):
+        return WorkspaceClient()
 
 
 @st.cache_resource
-def get_open_ai_client() -> OpenAI:
-    workspace_client = get_workspace_client()
-    api_key = _get_dbx_secret(workspace_client=workspace_client, scope="eng-rec-scope", key="databricks-token")
-    return OpenAI(api_key=api_key, base_url=f"{workspace_client.config.host}/serving-endpoints")
+def get_open_ai_client() -> "OpenAI":
+    import httpx
+    from openai import DefaultHttpxClient, OpenAI
+
+    host, api_key = _host_and_token()
+    with span("resources.open_ai_client"):
+        return OpenAI(
+            api_key=api_key,
+            base_url=f"{host}/serving-endpoints",
+            http_client=DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=OPEN_AI_MAX_CONNECTIONS, max_keepalive_connections=OPEN_AI_MAX_CONNECTIONS
+                )
+            ),
+        )
 
 
 @st.cache_resource
-def get_vector_search_client() -> VectorSearchClient:
-    workspace_client = get_workspace_client()
-    personal_access_token = _get_dbx_secret(
-        workspace_client=workspace_client, scope="eng-rec-scope", key="databricks-token"
-    )
-    return VectorSearchClient(
-        workspace_url=workspace_client.config.host,
-        personal_access_token=personal_access_token,
-    )
+def get_vector_search_client() -> "VectorSearchClient":
+    from databricks.vector_search.client import VectorSearchClient
+
+    host, personal_access_token = _host_and_token()
+    with span("resources.vector_search_client"):
+        return VectorSearchClient(
+            workspace_url=host,
+            personal_access_token=personal_access_token,
+            disable_notice=FAKE_SERVICES_URL is not None,
+        )
+
+
+@st.cache_resource
+def get_completion_cache() -> SQLiteCompletionCache | None:
+    cache_path = os.getenv("COMPLETION_CACHE_PATH")
+    if not cache_path:
+        return None
+    cache = SQLiteCompletionCache(cache_path, bypass=os.getenv("COMPLETION_CACHE_BYPASS", "0") == "1")
+    if COMPLETION_CACHE_SNAPSHOT_PATH:
+        threading.Thread(
+            target=_sync_completion_cache_periodically,
+            args=(cache, COMPLETION_CACHE_SNAPSHOT_PATH),
+            daemon=True,
+            name="completion-cache-sync",
+        ).start()
+    return cache
+
+
+def _sync_completion_cache_periodically(cache: SQLiteCompletionCache, snapshot: str) -> None:
+    while True:
+        try:
+            added = cache.sync(snapshot)
+            logger.info(f"Synced the completion cache with {snapshot}, {added} completions added")
+        except (OSError, sqlite3.Error):
+            logger.exception(f"Could not sync the completion cache with {snapshot}")
+        time.sleep(COMPLETION_CACHE_SYNC_SECONDS)
@@ -0,0 +1,163 @@
+"""SCADA signals of a turbine for the telemetry panel, read from Parquet and downsampled server-side.
+
+The signals of every turbine are in `<SCADA_PATH>/<turbine>.parquet`: a `SCADA_TIME_COLUMN` and one numeric column per
+channel, sorted by time and written in row groups (e.g. of a day). Reading a time window only decodes the row groups it
+overlaps, from the memory-mapped file, so zooming in reads the visible range at a higher resolution instead of the
+whole history. Every channel is downsampled to `SCADA_POINT_BUDGET` points before it is plotted.
+"""
+
+import logging
+import os
+import re
+from collections.abc import Sequence
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import streamlit as st
+from plotly import graph_objects as go
+from plotly.subplots import make_subplots
+
+from src.telemetry import span
+
+logger = logging.getLogger(__name__)
+
+SCADA_PATH = os.getenv("SCADA_PATH")
+SCADA_TIME_COLUMN = os.getenv("SCADA_TIME_COLUMN", "timestamp")
+# Points per channel, a few per horizontal pixel of the chart
+SCADA_POINT_BUDGET = int(os.getenv("SCADA_POINT_BUDGET", 2000))
+# "minmax" keeps the extremes of every bucket (spikes), "lttb" the points that best preserve the shape
+SCADA_DOWNSAMPLING = os.getenv("SCADA_DOWNSAMPLING", "minmax")
+SCADA_FIGURE_CACHE_SIZE = int(os.getenv("SCADA_FIGURE_CACHE_SIZE", 256))
+SCADA_MAX_CHANNELS = 4
+
+# Turbine names come from the URL, so they must not escape `SCADA_PATH`
+TURBINE_NAME_PATTERN = re.compile(r"[\w.-]+")
+
+
+def min_max_downsample(x: np.ndarray, y: np.ndarray, n_out: int) -> tuple[np.ndarray, np.ndarray]:
+    """Keeps the minimum and the maximum of `n_out // 2` equal buckets, in time order, so that spikes stay visible."""
+    finite = np.isfinite(y)
+    if not finite.all():
+        x, y = x[finite], y[finite]
+    n_buckets = max(n_out // 2, 1)
+    if len(y) <= n_out:
+        return x, y
+
+    bucket_size = -(-len(y) // n_buckets)
+    n_buckets = -(-len(y) // bucket_size)
+    padding = n_buckets * bucket_size - len(y)
+    # Padded with values that are never the minimum (maximum) of their bucket
+    lows = np.concatenate([y, np.full(padding, np.inf)]).reshape(n_buckets, bucket_size)
+    highs = np.concatenate([y, np.full(padding, -np.inf)]).reshape(n_buckets, bucket_size)
+    offsets = np.arange(n_buckets) * bucket_size
+    indices = np.stack([offsets + lows.argmin(axis=1), offsets + highs.argmax(axis=1)], axis=1)
+    indices = np.unique(indices)
+    return x[indices], y[indices]
+
+
+def lttb_downsample(x: np.ndarray, y: np.ndarray, n_out: int) -> tuple[np.ndarray, np.ndarray]:
+    """Largest-Triangle-Three-Buckets: keeps the first and last points, and from each of the `n_out - 2` buckets in
+    between the point making the largest triangle with the previous kept point and the average of the next bucket."""
+    finite = np.isfinite(y)
+    if not finite.all():
+        x, y = x[finite], y[finite]
+    if len(y) <= n_out or n_out < 3:
+        return x, y
+
+    xf = x.astype(np.float64)
+    edges = np.linspace(1, len(y) - 1, n_out - 1).astype(np.int64)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1] = 0, len(y) - 1
+    previous = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = end, edges[i + 2] if i + 2 < len(edges) else len(y)
+        next_x, next_y = xf[next_start:next_end].mean(), y[next_start:next_end].mean()
+        areas = np.abs(
+            (xf[previous] - next_x) * (y[start:end] - y[previous])
+            - (xf[previous] - xf[start:end]) * (next_y - y[previous])
+        )
+        previous = indices[i + 1] = start + int(areas.argmax())
+    return x[indices], y[indices]
+
+
+def downsample(x: np.ndarray, y: np.ndarray, n_out: int = SCADA_POINT_BUDGET) -> tuple[np.ndarray, np.ndarray]:
+    if SCADA_DOWNSAMPLING == "lttb":
+        return lttb_downsample(x, y, n_out)
+    return min_max_downsample(x, y, n_out)
+
+
+def scada_file(turbine: str) -> Path | None:
+    """The turbine's Parquet file, if there is one."""
+    if not SCADA_PATH or not TURBINE_NAME_PATTERN.fullmatch(turbine):
+        return None
+    path = Path(SCADA_PATH) / f"{turbine}.parquet"
+    return path if path.is_file() else None
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def scada_extent(turbine: str) -> tuple[datetime, datetime] | None:
+    """First and last timestamps of the turbine's signals, from the row group statistics when they are written."""
+    if (path := scada_file(turbine)) is None:
+        return None
+    metadata = pq.ParquetFile(path, memory_map=True).metadata
+    time_type = metadata.schema.to_arrow_schema().field(SCADA_TIME_COLUMN).type
+    column = metadata.schema.to_arrow_schema().get_field_index(SCADA_TIME_COLUMN)
+    statistics = [metadata.row_group(i).column(column).statistics for i in range(metadata.num_row_groups)]
+    if statistics and all(s is not None and s.has_min_max for s in statistics):
+        first, last = min(s.min for s in statistics), max(s.max for s in statistics)
+    else:
+        times = pq.read_table(path, columns=[SCADA_TIME_COLUMN], memory_map=True)[SCADA_TIME_COLUMN]
+        if len(times) == 0:
+            return None
+        extent = pc.min_max(times)
+        first, last = extent["min"], extent["max"]
+    # Streamlit's sliders need datetimes, which have microseconds
+    datetime_type = pa.timestamp("us", tz=time_type.tz)
+    return tuple(pa.scalar(t, type=time_type).cast(datetime_type, safe=False).as_py() for t in (first, last))
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def scada_channels(turbine: str) -> list[str]:
+    if (path := scada_file(turbine)) is None:
+        return []
+    schema = pq.read_schema(path, memory_map=True)
+    numeric = (pa.types.is_floating, pa.types.is_integer)
+    return [f.name for f in schema if f.name != SCADA_TIME_COLUMN and any(is_type(f.type) for is_type in numeric)]
+
+
+def read_signals(path: Path, start: datetime, end: datetime, channels: Sequence[str]) -> pa.Table:
+    """The channels' values between `start` and `end`, only decoding the row groups that overlap them."""
+    time_type = pq.read_schema(path, memory_map=True).field(SCADA_TIME_COLUMN).type
+    in_window = (pc.field(SCADA_TIME_COLUMN) >= pa.scalar(start, type=time_type)) & (
+        pc.field(SCADA_TIME_COLUMN) <= pa.scalar(end, type=time_type)
+    )
+    return pq.read_table(path, columns=[SCADA_TIME_COLUMN, *channels], filters=in_window, memory_map=True)
+
+
+@st.cache_data(max_entries=SCADA_FIGURE_CACHE_SIZE, ttl=3600, show_spinner=False)
+def scada_figure(turbine: str, start: datetime, end: datetime, channels: tuple[str, ...]) -> go.Figure | None:
+    """One subplot per channel over the time window, cached per turbine, window and channels."""
+    if (path := scada_file(turbine)) is None or not channels:
+        return None
+    with span("scada.read"):
+        table = read_signals(path, start, end, channels)
+    with span("scada.downsample"):
+        times = table[SCADA_TIME_COLUMN].to_numpy()
+        series = {c: downsample(times, table[c].to_numpy(zero_copy_only=False).astype(np.float64)) for c in channels}
+
+    figure = make_subplots(rows=len(channels), cols=1, shared_xaxes=True, subplot_titles=channels)
+    for row, (channel, (x, y)) in enumerate(series.items(), start=1):
+        figure.add_trace(go.Scattergl(x=x, y=y, mode="lines", name=channel), row=row, col=1)
+    figure.update_layout(height=max(250, 160 * len(channels)), showlegend=False, margin={"t": 30, "b": 10})
+    logger.debug(f"{turbine}: {table.num_rows} rows from {start} to {end} plotted as {len(series)} channels")
+    return figure
+
+
+def window_step(extent: tuple[datetime, datetime]) -> timedelta:
+    """Step of the time window slider, about a thousandth of the history."""
+    return max((extent[1] - extent[0]) / 1000, timedelta(seconds=1))
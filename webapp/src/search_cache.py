@@ -0,0 +1,191 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable, Sequence
+from dataclasses import dataclass
+from typing import Generic, TypeVar
+
+import numpy as np
+
+from src.embeddings import Embedder
+from src.telemetry import registry
+from src.vector_search import (
+    N_SIMILAR_ISSUES,
+    TABLE_COLS,
+    Filters,
+    SimilarIssue,
+    SimilarIssueSearcher,
+    filters_key,
+    is_degraded,
+)
+
+logger = logging.getLogger(__name__)
+
+V = TypeVar("V")
+
+LOG_STATS_EVERY = 100
+
+
+def normalize_query(query: str) -> str:
+    """Case and whitespace insensitive form of a query, so trivially different descriptions share cache entries."""
+    return re.sub(r"\s+", " ", query).strip().casefold()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    latency_saved_s: float = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.hits} hits, {self.misses} misses ({self.hit_rate:.1%} hit rate), "
+            f"{self.latency_saved_s:.1f}s latency saved"
+        )
+
+
+class TTLCache(Generic[V]):
+    """Thread-safe LRU cache with a time-to-live, remembering how long each value took to compute."""
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: float | None = 3600):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.stats = CacheStats()
+        self._entries: OrderedDict[Hashable, tuple[V, float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> V | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl_seconds is not None and time.monotonic() - entry[1] >= self.ttl_seconds):
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            self.stats.latency_saved_s += entry[2]
+            return entry[0]
+
+    def put(self, key: Hashable, value: V, compute_seconds: float = 0.0) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.monotonic(), compute_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], V]) -> V:
+        value = self.get(key)
+        if value is None:
+            start = time.perf_counter()
+            value = compute()
+            self.put(key, value, compute_seconds=time.perf_counter() - start)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class CachedSearcher:
+    """Process-wide cache of search results in front of any `SimilarIssueSearcher`.
+
+    Entries are keyed on the index version as well, so a sync of the index invalidates them. Searchers exposing
+    `index_version()` are polled at most every `version_poll_seconds`. Cached results are shared, not copied, so they
+    must not be modified.
+    """
+
+    def __init__(
+        self, searcher: SimilarIssueSearcher, cache: TTLCache[Sequence[SimilarIssue]], version_poll_seconds: float = 60
+    ):
+        self.searcher = searcher
+        self.cache = cache
+        self.version_poll_seconds = version_poll_seconds
+        self._version: str | None = None
+        self._version_checked_at = -float("inf")
+        self._version_lock = threading.Lock()
+        registry.register_gauge("search_cache.hit_rate", lambda: self.cache.stats.hit_rate)
+        registry.register_gauge("search_cache.latency_saved_seconds", lambda: self.cache.stats.latency_saved_s)
+
+    def index_version(self) -> str | None:
+        get_version = getattr(self.searcher, "index_version", None)
+        if get_version is None:
+            return None
+        with self._version_lock:
+            if time.monotonic() - self._version_checked_at >= self.version_poll_seconds:
+                version = get_version()
+                if version != self._version:
+                    logger.info(f"Index version changed from {self._version} to {version}, dropping cached results")
+                    self.cache.clear()
+                self._version, self._version_checked_at = version, time.monotonic()
+            return self._version
+
+    def refresh(self) -> None:
+        """Checks the index version at the next search, e.g. once the searcher swapped to a new index."""
+        with self._version_lock:
+            self._version_checked_at = -float("inf")
+
+    def search(
+        self,
+        query: str,
+        cols: Sequence[str] = TABLE_COLS,
+        num_results: int = N_SIMILAR_ISSUES,
+        filters: Filters | None = None,
+    ) -> Sequence[SimilarIssue]:
+        key = (self.index_version(), normalize_query(query), num_results, tuple(cols), filters_key(filters))
+        if (results := self.cache.get(key)) is None:
+            start = time.perf_counter()
+            results = self.searcher.search(query, cols=cols, num_results=num_results, filters=filters)
+            # e.g. a fallback's results while the index is down
+            if not is_degraded(results):
+                self.cache.put(key, results, compute_seconds=time.perf_counter() - start)
+        if (self.cache.stats.hits + self.cache.stats.misses) % LOG_STATS_EVERY == 0:
+            logger.info(f"Search result cache: {self.cache.stats}")
+        return results
+
+    def search_batch(
+        self,
+        queries: Sequence[str],
+        cols: Sequence[str] = TABLE_COLS,
+        num_results: int = N_SIMILAR_ISSUES,
+        filters: Filters | None = None,
+    ) -> list[Sequence[SimilarIssue]]:
+        """Looks every query up in the cache and searches the misses together, with the backend's `search_batch`."""
+        version = self.index_version()
+        keys = [(version, normalize_query(q), num_results, tuple(cols), filters_key(filters)) for q in queries]
+        results = [self.cache.get(k) for k in keys]
+        if missing := [i for i, r in enumerate(results) if r is None]:
+            start = time.perf_counter()
+            searched = self.searcher.search_batch(  # type: ignore[attr-defined]
+                [queries[i] for i in missing], cols=cols, num_results=num_results, filters=filters
+            )
+            per_query_seconds = (time.perf_counter() - start) / len(missing)
+            for i, _results in zip(missing, searched):
+                if not is_degraded(_results):
+                    self.cache.put(keys[i], _results, compute_seconds=per_query_seconds)
+                results[i] = _results
+        return results  # type: ignore[return-value]
+
+
+def cached_embedder(embed: Embedder, cache: TTLCache[np.ndarray]) -> Embedder:
+    """Wraps a query embedder so that repeated (normalized) queries skip the embedding round trip."""
+
+    def _embed(texts: Sequence[str]) -> np.ndarray:
+        keys = [normalize_query(t) for t in texts]
+        vectors = [cache.get(k) for k in keys]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            start = time.perf_counter()
+            embedded = embed([texts[i] for i in missing])
+            per_text_seconds = (time.perf_counter() - start) / len(missing)
+            for i, vector in zip(missing, embedded):
+                cache.put(keys[i], vector, compute_seconds=per_text_seconds)
+                vectors[i] = vector
+        return np.vstack(vectors)  # type: ignore[arg-type]
+
+    return _embed
@@ -0,0 +1,215 @@
+"""Lightweight stage timing for the webapp.
+
+Stages are timed with `span("stage")` (or the `timed("stage")` decorator) and aggregated into per-stage latency
+histograms, exported as JSON (`METRICS_FILE`), as Prometheus text on `METRICS_PORT`, and optionally as
+OpenTelemetry traces (`OTEL_TRACES_ENABLED=1`, needs `opentelemetry-api` and a configured SDK). With
+`TELEMETRY_ENABLED=0` spans are a shared no-op context manager and decorated functions are left untouched.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterator
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, ParamSpec, TypeVar
+
+logger = logging.getLogger(__name__)
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+TELEMETRY_ENABLED = os.getenv("TELEMETRY_ENABLED", "1") == "1"
+METRICS_FILE = os.getenv("METRICS_FILE")
+METRICS_FILE_INTERVAL_SECONDS = float(os.getenv("METRICS_FILE_INTERVAL_SECONDS", 60))
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+OTEL_TRACES_ENABLED = os.getenv("OTEL_TRACES_ENABLED", "0") == "1"
+
+QUANTILES = (0.5, 0.95, 0.99)
+METRIC_PREFIX = "eng_rec"
+
+
+class Histogram:
+    """Latency samples of a stage; percentiles are computed over the most recent `max_samples`."""
+
+    def __init__(self, max_samples: int = 10_000):
+        self.count = 0
+        self.sum = 0.0
+        self._samples: deque[float] = deque(maxlen=max_samples)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self._samples.append(value)
+
+    def quantiles(self, quantiles: tuple[float, ...] = QUANTILES) -> dict[float, float]:
+        samples = sorted(self._samples)
+        if not samples:
+            return {}
+        return {q: samples[min(len(samples) - 1, int(q * len(samples)))] for q in quantiles}
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.histograms: dict[str, Histogram] = {}
+        self.counters: dict[str, float] = {}
+        self.gauges: dict[str, Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            if (histogram := self.histograms.get(stage)) is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def register_gauge(self, name: str, read: Callable[[], float]) -> None:
+        with self._lock:
+            self.gauges[name] = read
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "stages": {
+                    stage: {
+                        "count": h.count,
+                        "sum_s": h.sum,
+                        **{f"p{round(q * 100)}_s": v for q, v in h.quantiles().items()},
+                    }
+                    for stage, h in self.histograms.items()
+                },
+                "counters": dict(self.counters),
+                "gauges": {name: read() for name, read in self.gauges.items()},
+            }
+
+    def to_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = [f"# TYPE {METRIC_PREFIX}_stage_seconds summary"]
+        for stage, stats in snapshot["stages"].items():
+            for q in QUANTILES:
+                if (value := stats.get(f"p{round(q * 100)}_s")) is not None:
+                    lines.append(f'{METRIC_PREFIX}_stage_seconds{{stage="{stage}",quantile="{q}"}} {value}')
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {stats["sum_s"]}')
+        for kind, values in (("counter", snapshot["counters"]), ("gauge", snapshot["gauges"])):
+            for name, value in values.items():
+                metric = f"{METRIC_PREFIX}_{name.replace('.', '_')}"
+                lines += [f"# TYPE {metric} {kind}", f"{metric} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path: str | Path) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({"timestamp": time.time(), **self.snapshot()}, indent=2))
+        tmp_path.replace(path)
+
+
+registry = MetricsRegistry()
+
+_NOOP_SPAN = contextlib.nullcontext()
+_tracer: Any = None
+
+
+@contextlib.contextmanager
+def _span(stage: str) -> Iterator[None]:
+    trace_span = _tracer.start_as_current_span(stage) if _tracer is not None else _NOOP_SPAN
+    start = time.perf_counter()
+    try:
+        with trace_span:
+            yield
+    finally:
+        registry.observe(stage, time.perf_counter() - start)
+
+
+def span(stage: str) -> contextlib.AbstractContextManager:
+    """Times the enclosed block as `stage`."""
+    return _span(stage) if TELEMETRY_ENABLED else _NOOP_SPAN
+
+
+def timed(stage: str) -> Callable[[Callable[P, R]], Callable[P, R]]:
+    """Times every call of the decorated function as `stage`."""
+
+    def _decorator(func: Callable[P, R]) -> Callable[P, R]:
+        if not TELEMETRY_ENABLED:
+            return func
+
+        @wraps(func)
+        def _wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+            with _span(stage):
+                return func(*args, **kwargs)
+
+        return _wrapper
+
+    return _decorator
+
+
+def observe(stage: str, seconds: float) -> None:
+    """Records a duration measured elsewhere, e.g. the time to first token of a stream."""
+    if TELEMETRY_ENABLED:
+        registry.observe(stage, seconds)
+
+
+def increment(name: str, value: float = 1) -> None:
+    if TELEMETRY_ENABLED:
+        registry.increment(name, value)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.to_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def _write_metrics_file_periodically(path: str) -> None:
+    while True:
+        time.sleep(METRICS_FILE_INTERVAL_SECONDS)
+        try:
+            registry.write_json(path)
+        except OSError:
+            logger.exception(f"Could not write metrics to {path}")
+
+
+_exporters_started = False
+_exporters_lock = threading.Lock()
+
+
+def start_exporters() -> None:
+    """Starts the configured exporters, once per process."""
+    global _exporters_started, _tracer
+    with _exporters_lock:
+        if _exporters_started or not TELEMETRY_ENABLED:
+            return
+        _exporters_started = True
+
+        if OTEL_TRACES_ENABLED:
+            try:
+                from opentelemetry import trace
+
+                _tracer = trace.get_tracer("eng-rec-helper")
+            except ImportError:
+                logger.warning("OTEL_TRACES_ENABLED is set but opentelemetry is not installed, traces are disabled")
+        if METRICS_FILE:
+            threading.Thread(target=_write_metrics_file_periodically, args=(METRICS_FILE,), daemon=True).start()
+        if METRICS_PORT:
+            server = ThreadingHTTPServer(("0.0.0.0", METRICS_PORT), _MetricsHandler)
+            threading.Thread(target=server.serve_forever, daemon=True, name="metrics-server").start()
+            logger.info(f"Serving Prometheus metrics on port {METRICS_PORT}/metrics")
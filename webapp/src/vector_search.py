@@ -1,22 +1,48 @@
 import logging
 import os
-from collections.abc import Sequence
+from collections.abc import Iterator, Sequence
+from concurrent.futures import Executor
+from functools import cached_property, lru_cache
+from typing import TYPE_CHECKING, Protocol, overload
 
+import numpy as np
 import streamlit as st
-from databricks.vector_search.client import VectorSearchClient
 from pydantic import BaseModel
 
-from src.resources import get_vector_search_client
+from src.embeddings import Embedder
+from src.resources import get_open_ai_client, get_vector_search_client, required_env
+from src.telemetry import span
 
-logger = logging.getLogger(__name__)
+if TYPE_CHECKING:
+    from databricks.vector_search.client import VectorSearchClient
 
+logger = logging.getLogger(__name__)
 
-INDEX_PRIMARY_KEY = os.environ["INDEX_PRIMARY_KEY"]
-INDEX_NAME = os.environ["INDEX_NAME"]
-INDEX_ENDPOINT_NAME = os.environ["INDEX_ENDPOINT_NAME"]
-EMBEDDING_MODEL = os.environ["EMBEDDING_MODEL"]
+# The Databricks index (`INDEX_PRIMARY_KEY`, `INDEX_NAME`, `INDEX_ENDPOINT_NAME`) and the `EMBEDDING_MODEL` are read
+# with `required_env` when the searcher or the embedder is created, as the other backends do not need them
 N_SIMILAR_ISSUES = int(os.getenv("N_SIMILAR_ISSUES", 5))
-TABLE_COLS = ("Id", "Market", "Site", "Turbine", "Original", "Summary")
+VECTOR_SEARCH_BACKEND = os.getenv("VECTOR_SEARCH_BACKEND", "databricks")
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 1024))
+SEARCH_CACHE_TTL_SECONDS = float(os.getenv("SEARCH_CACHE_TTL_SECONDS", 3600))
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "0") == "1"
+# "endpoint": queries are embedded by the `EMBEDDING_MODEL` serving endpoint (by the Databricks index itself, if used)
+# "local": on the CPU with `LOCAL_EMBEDDING_MODEL`, for the local index or a Databricks index of self-managed embeddings
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "endpoint")
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "Alibaba-NLP/gte-large-en-v1.5")
+LOCAL_EMBEDDING_QUANTIZED = os.getenv("LOCAL_EMBEDDING_QUANTIZED", "1") == "1"
+EMBEDDING_STORE_PATH = os.getenv("EMBEDDING_STORE_PATH")
+TABLE_COLS = ("Id", "Market", "Site", "Turbine", "Title", "Original", "Summary")
+# What the similar issues list and the prompt need, the full `Original` markdown is fetched when it is displayed
+SUMMARY_COLS = ("Id", "Market", "Site", "Turbine", "Title", "Summary")
+FILTER_COLS = ("Market", "Site", "Turbine")
+
+# Column -> value(s), e.g. {"Market": "US", "Turbine": ["T28", "T29"]}
+Filters = dict[str, str | list[str]]
+
+
+def filters_key(filters: Filters | None) -> tuple:
+    """Hashable form of the filters, for cache keys."""
+    return tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in (filters or {}).items()))
 
 
 class SimilarIssue(BaseModel):
@@ -24,11 +50,18 @@ class SimilarIssue(BaseModel):
     market: str
     site: str
     turbine: str
-    original: str
+    title: str = ""
+    original: str | None = None
     summary: str
     score: float
 
-    def get_tags(self) -> list[tuple[str, str]]:
+    @cached_property
+    def display_title(self) -> str:
+        # Indexes built before the Title column only have it as the first line of the original markdown
+        return self.title or (self.original or "").split("\n", maxsplit=1)[0].lstrip("# ")
+
+    @cached_property
+    def tags(self) -> list[tuple[str, str]]:
         return [
             (str(self.id), "Issue ID"),
             (self.market, "Market"),
@@ -37,30 +70,245 @@ class SimilarIssue(BaseModel):
         ]
 
 
+@lru_cache(maxsize=64)
+def issue_fields(cols: tuple[str, ...]) -> tuple[str, ...]:
+    """`SimilarIssue` fields of the index columns, checked once per set of columns rather than for every row."""
+    fields = tuple(c.lower() for c in cols)
+    if unknown := set(fields) - SimilarIssue.model_fields.keys():
+        raise ValueError(f"Unexpected index columns: {sorted(unknown)}")
+    required = {name for name, field in SimilarIssue.model_fields.items() if field.is_required()} - {"score"}
+    if missing := required - set(fields):
+        raise ValueError(f"Missing index columns: {sorted(missing)}")
+    return fields
+
+
+class IssueRecords(Sequence[SimilarIssue]):
+    """Columnar search results, decoded into `SimilarIssue`s only as they are accessed.
+
+    The rows come from our own index, so once `issue_fields` has checked the columns they are not validated again
+    (`model_construct`). Fetching 50-100 candidates to re-rank then no longer costs a validated model per row.
+    """
+
+    __slots__ = ("_issues", "columns", "fields", "scores")
+
+    def __init__(self, fields: tuple[str, ...], columns: Sequence[Sequence], scores: Sequence[float] | np.ndarray):
+        self.fields = fields
+        self.columns = columns
+        self.scores = scores
+        self._issues: list[SimilarIssue | None] = [None] * len(scores)
+
+    @property
+    def ids(self) -> list[float]:
+        return list(self.columns[self.fields.index("id")]) if len(self) else []
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    @overload
+    def __getitem__(self, index: int) -> SimilarIssue: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> "IssueRecords": ...
+
+    def __getitem__(self, index: int | slice) -> "SimilarIssue | IssueRecords":
+        if isinstance(index, slice):
+            return IssueRecords(self.fields, [c[index] for c in self.columns], self.scores[index])
+        issue = self._issues[index]
+        if issue is None:
+            values = {f: c[index] for f, c in zip(self.fields, self.columns)}
+            issue = self._issues[index] = SimilarIssue.model_construct(**values, score=float(self.scores[index]))
+        return issue
+
+    def __iter__(self) -> Iterator[SimilarIssue]:
+        return (self[i] for i in range(len(self)))
+
+
+class DegradedResults(list[SimilarIssue]):
+    """Results of a fallback path (see `src/resilience.py`), which caches must not keep."""
+
+    degraded = True
+
+
+def is_degraded(issues: Sequence[SimilarIssue]) -> bool:
+    return getattr(issues, "degraded", False)
+
+
+def issue_ids(issues: Sequence[SimilarIssue]) -> list[float]:
+    """IDs of the issues, without decoding them when they are `IssueRecords`."""
+    return issues.ids if isinstance(issues, IssueRecords) else [i.id for i in issues]
+
+
+class SimilarIssueSearcher(Protocol):
+    def search(
+        self,
+        query: str,
+        cols: Sequence[str] = TABLE_COLS,
+        num_results: int = N_SIMILAR_ISSUES,
+        filters: Filters | None = None,
+    ) -> Sequence[SimilarIssue]: ...
+
+
+def search_scoped(
+    searcher: SimilarIssueSearcher,
+    query: str,
+    scopes: Sequence[Filters],
+    cols: Sequence[str] = TABLE_COLS,
+    num_results: int = N_SIMILAR_ISSUES,
+    executor: Executor | None = None,
+) -> list[SimilarIssue]:
+    """Fills `num_results` from the narrowest scope first, e.g. the same turbine, then the same site, then anywhere.
+
+    With an `executor`, the scopes are searched concurrently (one round trip of latency rather than one per scope),
+    and the broader ones still queued are cancelled once the narrower ones are full enough. The results are
+    `DegradedResults` if any of the scopes they were taken from was degraded.
+    """
+
+    def _search(filters: Filters) -> Sequence[SimilarIssue]:
+        return searcher.search(query, cols=cols, num_results=num_results, filters=filters or None)
+
+    all_scopes = [*scopes, {}]
+    futures = [executor.submit(_search, filters) for filters in all_scopes] if executor is not None else []
+    issues: dict[float, SimilarIssue] = {}
+    degraded = False
+    for i, filters in enumerate(all_scopes):
+        results = futures[i].result() if futures else _search(filters)
+        degraded |= is_degraded(results)
+        for issue in results:
+            issues.setdefault(issue.id, issue)
+        if len(issues) >= num_results:
+            break
+    for future in futures:
+        future.cancel()
+    merged = list(issues.values())[:num_results]
+    return DegradedResults(merged) if degraded else merged
+
+
+def fetch_originals(searcher: SimilarIssueSearcher, ids: Sequence[float]) -> dict[float, str]:
+    """Full original markdown of the given issues, from the first searcher (or wrapped searcher) that can fetch it."""
+    current: SimilarIssueSearcher | None = searcher
+    while current is not None:
+        if (fetch := getattr(current, "fetch_originals", None)) is not None:
+            return fetch(ids)
+        current = getattr(current, "searcher", None)
+    return {}
+
+
 class VectorSearcher:
-    def __init__(self, vector_search_client: VectorSearchClient):
-        self.index = vector_search_client.get_index(endpoint_name=INDEX_ENDPOINT_NAME, index_name=INDEX_NAME)
+    """Searches the Databricks index, embedding the queries with `embed` if it has self-managed embeddings."""
+
+    def __init__(self, vector_search_client: "VectorSearchClient", embed: Embedder | None = None):
+        self.embed = embed
+        self.primary_key = required_env("INDEX_PRIMARY_KEY")
+        with span("vector_search.get_index"):
+            self.index = vector_search_client.get_index(
+                endpoint_name=required_env("INDEX_ENDPOINT_NAME"), index_name=required_env("INDEX_NAME")
+            )
+
+    def _query(self, query: str) -> dict:
+        if self.embed is None:
+            return {"query_text": query}
+        with span("vector_search.embed"):
+            return {"query_vector": self.embed([query])[0].tolist()}
+
+    def index_version(self) -> str:
+        """Version of the source table the index was last synced to, used to invalidate cached results."""
+        status = self.index.describe().get("status", {})
+        update_status = status.get("triggered_update_status") or status.get("continuous_update_status") or {}
+        return str(update_status.get("last_processed_commit_version", status.get("indexed_row_count")))
 
     def search(
-        self, query: str, cols: Sequence[str] = TABLE_COLS, num_results: int = N_SIMILAR_ISSUES
-    ) -> list[SimilarIssue]:
-        _search_results = self.index.similarity_search(query_text=query, columns=cols, num_results=num_results)
-        _cols = [i["name"] for i in _search_results["manifest"]["columns"]]
-        _fields = SimilarIssue.model_fields.keys()
-        assert tuple(i.lower() for i in _cols) == tuple(_fields), f"Mismatched columns: {_cols} != {_fields}"
+        self,
+        query: str,
+        cols: Sequence[str] = TABLE_COLS,
+        num_results: int = N_SIMILAR_ISSUES,
+        filters: Filters | None = None,
+    ) -> IssueRecords:
+        with span("vector_search.similarity_search"):
+            # Filters are pushed down to the index, so that filtered queries still get `num_results` results
+            _search_results = self.index.similarity_search(
+                **self._query(query), columns=cols, num_results=num_results, filters=filters
+            )
+        # The score is appended as the last column
+        fields = issue_fields(tuple(i["name"] for i in _search_results["manifest"]["columns"][:-1]))
+
+        with span("vector_search.decode_results"):
+            columns = list(zip(*_search_results["result"].get("data_array") or []))
+            return IssueRecords(fields, columns[:-1], columns[-1] if columns else ())
+
+    def fetch_originals(self, ids: Sequence[float]) -> dict[float, str]:
+        """Looks the issues up by primary key, with a filtered query on the index (the query text is irrelevant)."""
+        if not ids:
+            return {}
+        with span("vector_search.fetch_originals"):
+            _search_results = self.index.similarity_search(
+                **self._query("issue"),
+                columns=[self.primary_key, "Original"],
+                num_results=len(ids),
+                filters={self.primary_key: list(ids)},
+            )
+        return {_row[0]: _row[1] for _row in _search_results["result"].get("data_array") or []}
 
-        return [
-            SimilarIssue(**{k: v for k, v in zip(_fields, _issue_data)})
-            for _issue_data in _search_results["result"]["data_array"]
-        ]
+
+def build_embedder() -> tuple[Embedder, str]:
+    """The `EMBEDDING_PROVIDER`'s embedder (reading from the embedding store, if any) and the name of its model."""
+    from src.embeddings import EndpointEmbedder, LocalEmbedder, SQLiteEmbeddingStore, stored_embedder
+
+    embed: Embedder
+    if EMBEDDING_PROVIDER == "local":
+        embed = LocalEmbedder(LOCAL_EMBEDDING_MODEL, quantized=LOCAL_EMBEDDING_QUANTIZED)
+        model = f"{LOCAL_EMBEDDING_MODEL}@int8" if LOCAL_EMBEDDING_QUANTIZED else LOCAL_EMBEDDING_MODEL
+    else:
+        model = required_env("EMBEDDING_MODEL")
+        embed = EndpointEmbedder(get_open_ai_client(), model=model)
+    if EMBEDDING_STORE_PATH:
+        embed = stored_embedder(embed, SQLiteEmbeddingStore(EMBEDDING_STORE_PATH), model=model)
+    return embed, model
 
 
 @st.cache_resource
-def get_vector_searcher() -> VectorSearcher:
-    if os.getenv("DEBUG", "0") == "1":
+def get_query_embedder() -> Embedder:
+    """Embedder of the search queries, shared by all sessions so that their concurrent queries are batched."""
+    from src.embeddings import MicroBatchingEmbedder
+
+    return MicroBatchingEmbedder(build_embedder()[0])
+
+
+def _get_backend_searcher() -> SimilarIssueSearcher:
+    if VECTOR_SEARCH_BACKEND == "mock":
         logger.warning("Using mock vector searcher")
         from src.custom_mocks import MockVectorSearcher
 
-        return MockVectorSearcher()  # type: ignore
+        return MockVectorSearcher()
+
+    if VECTOR_SEARCH_BACKEND == "local":
+        from src.local_index import get_local_vector_searcher
+        from src.search_cache import TTLCache, cached_embedder
+
+        embed = get_query_embedder()
+        if SEARCH_CACHE_SIZE > 0:
+            embed = cached_embedder(embed, TTLCache(max_size=SEARCH_CACHE_SIZE, ttl_seconds=SEARCH_CACHE_TTL_SECONDS))
+        return get_local_vector_searcher(embed=embed)
+
+    # A managed embeddings index embeds the query text itself
+    query_embedder = get_query_embedder() if EMBEDDING_PROVIDER == "local" else None
+    searcher = VectorSearcher(vector_search_client=get_vector_search_client(), embed=query_embedder)
+    from src.resilience import ResilientSearcher, get_fallback_searcher
+
+    # Deadlines, hedged requests and a circuit breaker, failing over to a local snapshot or the last results
+    return ResilientSearcher(searcher, fallback=get_fallback_searcher())
+
+
+@st.cache_resource
+def get_vector_searcher() -> SimilarIssueSearcher:
+    searcher = _get_backend_searcher()
+    if HYBRID_SEARCH:
+        from src.hybrid_search import get_hybrid_searcher
+
+        searcher = get_hybrid_searcher(searcher)
+    if SEARCH_CACHE_SIZE <= 0:
+        return searcher
+
+    from src.search_cache import CachedSearcher, TTLCache
 
-    return VectorSearcher(vector_search_client=get_vector_search_client())
+    # Shared by every Streamlit session, as the cache_resource is process wide
+    return CachedSearcher(searcher, TTLCache(max_size=SEARCH_CACHE_SIZE, ttl_seconds=SEARCH_CACHE_TTL_SECONDS))
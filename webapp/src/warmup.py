@@ -0,0 +1,117 @@
+"""Background warm-up of the app at startup, so that the first user does not pay for it.
+
+The heavy modules are imported, the secrets fetched, the clients created and a query searched on a background thread.
+How long each stage took is kept in the startup report, which is logged, recorded as `startup.*` metrics and served by
+the API on `/startup`.
+"""
+
+import importlib
+import logging
+import os
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Any
+
+from src.telemetry import observe
+
+logger = logging.getLogger(__name__)
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") == "1"
+WARMUP_QUERY = os.getenv("WARMUP_QUERY", "Pitch motor overtemperature")
+
+
+class StartupReport:
+    """Durations of the startup stages, in the order they ran, and the errors of the ones that failed."""
+
+    def __init__(self) -> None:
+        self.stages: dict[str, float] = {}
+        self.errors: dict[str, str] = {}
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[stage] = seconds
+        observe(f"startup.{stage}", seconds)
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """Times a stage, logging (rather than raising) its failure so that the next stages still run."""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            logger.exception(f"Warm-up stage {stage} failed")
+            with self._lock:
+                self.errors[stage] = f"{type(e).__name__}: {e}"
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def to_dict(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "done": self.done.is_set(),
+                "total_seconds": sum(self.stages.values()),
+                "stages": dict(self.stages),
+                "errors": dict(self.errors),
+            }
+
+    def __str__(self) -> str:
+        with self._lock:
+            lines = [f"  {stage:<40} {seconds * 1000:>9.1f} ms" for stage, seconds in self.stages.items()]
+            lines += [f"  {stage} failed: {error}" for stage, error in self.errors.items()]
+        return "\n".join(lines)
+
+
+startup_report = StartupReport()
+
+
+def _heavy_modules() -> list[str]:
+    # The ones the app only imports when it first needs them
+    from src.vector_search import EMBEDDING_PROVIDER, VECTOR_SEARCH_BACKEND
+
+    modules = ["databricks.sdk", "openai", "plotly.figure_factory", "annotated_text"]
+    if VECTOR_SEARCH_BACKEND == "databricks":
+        modules.append("databricks.vector_search.client")
+    if EMBEDDING_PROVIDER == "local":
+        modules.append("sentence_transformers")
+    return modules
+
+
+def _warm_up() -> None:
+    from src.resources import get_completion_cache, get_open_ai_client
+    from src.vector_search import get_vector_searcher
+
+    start = time.perf_counter()
+    for module in _heavy_modules():
+        with startup_report.stage(f"import.{module}"):
+            importlib.import_module(module)
+    # Fetches the secret and creates the serving endpoints client
+    with startup_report.stage("client.open_ai"):
+        get_open_ai_client()
+    with startup_report.stage("client.completion_cache"):
+        get_completion_cache()
+    # The vector search client and `get_index` for Databricks, the index snapshot (and embedding model) if local
+    with startup_report.stage("searcher"):
+        get_vector_searcher()
+    # Embeds a query and opens the connections to the index
+    with startup_report.stage("warmup_query"):
+        get_vector_searcher().search(WARMUP_QUERY, num_results=1)
+    startup_report.done.set()
+    logger.info(f"Warmed up in {time.perf_counter() - start:.1f}s:\n{startup_report}")
+
+
+_warmup_started = False
+_warmup_lock = threading.Lock()
+
+
+def start_warmup() -> None:
+    """Starts the warm-up in the background, once per process."""
+    global _warmup_started
+    with _warmup_lock:
+        if _warmup_started or not WARMUP_ENABLED:
+            return
+        _warmup_started = True
+    threading.Thread(target=_warm_up, daemon=True, name="warmup").start()
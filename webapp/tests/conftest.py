@@ -0,0 +1,66 @@
+import threading
+from collections.abc import Sequence
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import FakeEmbedder, synthetic_embeddings, synthetic_issues
+from src.vector_search import N_SIMILAR_ISSUES, TABLE_COLS, Filters, SimilarIssue
+
+N_ISSUES = 2_000
+
+
+@pytest.fixture(scope="session")
+def embed() -> FakeEmbedder:
+    return FakeEmbedder(dim=64)
+
+
+@pytest.fixture(scope="session")
+def issues() -> pd.DataFrame:
+    return synthetic_issues(N_ISSUES)
+
+
+@pytest.fixture(scope="session")
+def embeddings(embed: FakeEmbedder) -> np.ndarray:
+    return synthetic_embeddings(embed, N_ISSUES)
+
+
+class FakeSearcher:
+    """Searcher returning the first `num_results` matching issues, counting its calls.
+
+    With a `gate`, searches block until it is set, to observe them while they are in flight.
+    """
+
+    def __init__(self, issues: pd.DataFrame, gate: threading.Event | None = None):
+        self.issues = issues
+        self.gate = gate
+        self.calls: list[tuple[str, Filters | None]] = []
+        self.version = "v1"
+
+    def index_version(self) -> str:
+        return self.version
+
+    def search(
+        self,
+        query: str,
+        cols: Sequence[str] = TABLE_COLS,
+        num_results: int = N_SIMILAR_ISSUES,
+        filters: Filters | None = None,
+    ) -> list[SimilarIssue]:
+        self.calls.append((query, filters))
+        if self.gate is not None:
+            self.gate.wait(timeout=10)
+        rows = self.issues
+        for col, values in (filters or {}).items():
+            rows = rows[rows[col].isin(values if isinstance(values, list) else [values])]
+        rows = rows.head(num_results)
+        return [
+            SimilarIssue(**{c.lower(): row[c] for c in cols}, score=1.0 / (1 + i))
+            for i, (_, row) in enumerate(rows.iterrows())
+        ]
+
+
+@pytest.fixture
+def searcher(issues: pd.DataFrame) -> FakeSearcher:
+    return FakeSearcher(issues)
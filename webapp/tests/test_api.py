@@ -0,0 +1,25 @@
+import asyncio
+import time
+
+import api
+
+
+def test_concurrent_first_requests_create_one_batcher(monkeypatch, searcher):
+    created = []
+
+    def get_vector_searcher():
+        # Slow enough for the other requests to arrive while the first one creates the searcher
+        time.sleep(0.1)
+        created.append(searcher)
+        return searcher
+
+    monkeypatch.setattr(api, "get_vector_searcher", get_vector_searcher)
+    monkeypatch.setattr(api, "_batcher", None)
+
+    async def first_requests():
+        return await asyncio.gather(*(api._get_batcher() for _ in range(4)))
+
+    batchers = asyncio.run(first_requests())
+    assert len(created) == 1
+    assert all(b is batchers[0] for b in batchers)
+    assert batchers[0].executor is api._search_executor
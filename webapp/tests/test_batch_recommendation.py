@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+
+import pytest
+from databricks.sdk.service.sql import StatementState
+
+from src.batch_recommendation import read_items
+from src.index_builder import read_table_chunks
+
+
+class FakeStatementExecution:
+    """Returns the rows of a query in chunks of `chunk_rows`, the first one inline like the SQL warehouse."""
+
+    def __init__(self, columns, rows, chunk_rows=2):
+        self.columns = columns
+        self.chunks = [
+            SimpleNamespace(
+                data_array=rows[i : i + chunk_rows],
+                next_chunk_index=n + 1 if i + chunk_rows < len(rows) else None,
+            )
+            for n, i in enumerate(range(0, max(len(rows), 1), chunk_rows))
+        ]
+        self.fetched = []
+
+    def execute_statement(self, statement, warehouse_id, wait_timeout):
+        return SimpleNamespace(
+            statement_id="statement",
+            status=SimpleNamespace(state=StatementState.SUCCEEDED),
+            manifest=SimpleNamespace(schema=SimpleNamespace(columns=[SimpleNamespace(name=c) for c in self.columns])),
+            result=self.chunks[0],
+        )
+
+    def get_statement_result_chunk_n(self, statement_id, chunk_index):
+        self.fetched.append(chunk_index)
+        return self.chunks[chunk_index]
+
+
+@pytest.fixture(autouse=True)
+def warehouse(monkeypatch):
+    monkeypatch.setenv("DATABRICKS_WAREHOUSE_ID", "warehouse")
+
+
+def test_read_items_reads_every_chunk_of_a_table():
+    rows = [[str(i), f"Issue {i}"] for i in range(5)]
+    statements = FakeStatementExecution(["Id", "Description"], rows)
+
+    items = read_items(input_table="alerts", workspace_client=SimpleNamespace(statement_execution=statements))
+
+    assert [(i.id, i.description) for i in items] == [(str(i), f"Issue {i}") for i in range(5)]
+    assert statements.fetched == [1, 2]
+
+
+def test_read_table_chunks_yields_every_chunk():
+    rows = [[str(i), "M", "S", "T", "Title", "Original", "Summary"] for i in range(3)]
+    statements = FakeStatementExecution(["Id", "Market", "Site", "Turbine", "Title", "Original", "Summary"], rows)
+
+    chunks = list(read_table_chunks(SimpleNamespace(statement_execution=statements), "issues"))
+
+    assert [len(c) for c in chunks] == [2, 1]
+    assert chunks[1]["Id"].tolist() == [2.0]
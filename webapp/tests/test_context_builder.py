@@ -0,0 +1,75 @@
+import pytest
+
+from src.context_builder import build_context, estimate_tokens, parse_summary
+from src.vector_search import SimilarIssue
+
+
+def similar_issue(id, summary, score, title=""):
+    return SimilarIssue(
+        id=id, market="M", site="S", turbine="T", title=title or f"Trip {id}", summary=summary, score=score
+    )
+
+
+def summary(symptoms, recommendation="Check the converter.", resolution="Replaced the IGBT module."):
+    return f"### Symptoms:\n{symptoms}\n\n### Recommendation:\n{recommendation}\n\n### Resolution:\n{resolution}"
+
+
+@pytest.fixture
+def issues():
+    return [
+        similar_issue(i, summary(f"Alarm {i}: " + " ".join(f"word{i}_{j}" for j in range(40))), score=1 - i / 100)
+        for i in range(20)
+    ]
+
+
+def test_parse_summary():
+    assert parse_summary(summary("Overheating.")) == {
+        "Symptoms": "Overheating.",
+        "Recommendation": "Check the converter.",
+        "Resolution": "Replaced the IGBT module.",
+    }
+
+
+@pytest.mark.parametrize("token_budget", [100, 250, 333, 1000, 1500])
+def test_packs_within_the_budget(issues, token_budget):
+    context = build_context(issues, token_budget=token_budget)
+    assert context.tokens == estimate_tokens(context.text) <= token_budget
+    assert len(context.issue_ids) == context.text.count("## Issue ")
+
+
+def test_separators_count_against_the_budget(issues):
+    block_tokens = estimate_tokens(build_context(issues[:1], token_budget=10_000).text)
+    # Fits the blocks of two issues, but not the separator between them: the second one is truncated instead
+    context = build_context(issues[:2], token_budget=2 * block_tokens)
+    assert context.tokens <= 2 * block_tokens
+    assert context.n_truncated == 1
+
+
+def test_takes_issues_by_decreasing_score(issues):
+    context = build_context(list(reversed(issues[:3])), token_budget=10_000)
+    assert context.issue_ids == [0, 1, 2]
+    assert context.text.index("Trip 0") < context.text.index("Trip 1") < context.text.index("Trip 2")
+
+
+def test_skips_near_duplicates(issues):
+    duplicate = similar_issue(100, issues[0].summary.replace("Replaced", "replaced"), score=0.5)
+    context = build_context([issues[0], duplicate, issues[1]], token_budget=10_000)
+    assert context.issue_ids == [0, 1]
+    assert context.n_duplicates == 1
+
+
+def test_truncates_the_last_issue_and_drops_the_rest(issues):
+    context = build_context(issues, token_budget=300)
+    assert context.n_truncated == 1
+    assert context.text.endswith(" ...")
+    assert len(context.issue_ids) + context.n_dropped == len(issues)
+
+
+def test_only_packs_the_title_and_summary_sections():
+    issue = similar_issue(1, summary("Overheating."), score=1.0, title="Converter trip")
+    issue.original = "# Converter trip\nFull markdown with the alarm log"
+    context = build_context([issue], token_budget=10_000)
+    assert context.text == (
+        "## Issue 1:\nTitle: Converter trip\nSymptoms: Overheating.\nRecommendation: Check the converter.\n"
+        "Resolution: Replaced the IGBT module."
+    )
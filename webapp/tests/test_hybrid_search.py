@@ -0,0 +1,127 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import FakeSearcher
+
+from src import hybrid_search, index_builder, resources
+from src.hybrid_search import BM25Index, HeuristicReranker, HybridSearcher, reciprocal_rank_fusion, tokenize
+
+DOCUMENTS = [
+    "Gearbox oil pressure drop at rated power",
+    "Alarm E-1023 on the pitch motor, TURBINE/S stopped",
+    "Pitch motor overtemperature, pitch motor replaced",
+    "Yaw drive abnormal noise",
+]
+
+
+def test_tokenize_keeps_codes_and_censored_tokens_whole():
+    assert tokenize("Alarm E-1023 on TURBINE/S T29.") == ["alarm", "e-1023", "on", "turbine/s", "t29"]
+
+
+def test_bm25_ranks_rarer_and_repeated_terms_higher():
+    index = BM25Index(DOCUMENTS)
+    scores, rows = index.search("pitch motor", k=4)
+    # The document repeating the terms first, and the ones without them not at all
+    assert rows.tolist() == [2, 1]
+    assert scores[0] > scores[1] > 0
+    _, rows = index.search("e-1023 gearbox", k=1)
+    assert rows.tolist() in ([0], [1])
+    assert index.search("unknown words", k=3)[1].size == 0
+
+
+def test_bm25_search_within_rows():
+    _, rows = BM25Index(DOCUMENTS).search("pitch motor", k=4, rows=np.array([0, 1]))
+    assert rows.tolist() == [1]
+
+
+def test_reciprocal_rank_fusion_favours_issues_in_both_rankings():
+    fused = reciprocal_rank_fusion([[1.0, 2.0, 3.0], [3.0, 4.0]], rrf_k=60)
+    assert fused[3.0] == pytest.approx(1 / 63 + 1 / 61)
+    assert fused[1.0] == pytest.approx(1 / 61)
+    assert max(fused, key=fused.__getitem__) == 3.0
+
+
+def test_heuristic_reranker_boosts_codes(issues):
+    candidates = FakeSearcher(issues).search("", num_results=2)
+    reranked = HeuristicReranker().rerank("e-1023 fault", candidates, ["no code", "alarm E-1023"], float("inf"))
+    assert [i.id for i in reranked] == [1.0, 0.0]
+
+
+@pytest.fixture
+def searcher(issues):
+    # Vector results matching nothing, to observe the lexical ones
+    return FakeSearcher(issues.head(0))
+
+
+def test_hybrid_search_finds_alarm_codes(issues, searcher):
+    code = issues["Original"].iloc[0].split("\n\n")[1].split(":")[0].removeprefix("Alarm ")
+    results = HybridSearcher(searcher, issues).search(f"{code} fault", num_results=5)
+    assert len(results) == 5
+    assert all(code in issues["Original"].iloc[int(issue.id)] for issue in results)
+
+
+def test_lexical_index_is_rebuilt_when_the_index_changes(issues, searcher):
+    corpus = {"issues": issues.head(100)}
+    hybrid = HybridSearcher(searcher, corpus["issues"], load_corpus=lambda: corpus["issues"])
+    version = hybrid.index_version()
+    new_issue = issues.head(1).assign(Id=10_000.0, Original="# Blade lightning strike\\n\\nAlarm X-9999")
+    corpus["issues"] = pd.concat([issues.head(100), new_issue])
+    hybrid.refresh()
+    assert hybrid.index_version() == version
+    assert [i.id for i in hybrid.search("x-9999", num_results=1)] == [10_000.0]
+
+    # In the background, when the vector index's version changes
+    searcher.version = "v2"
+    corpus["issues"] = issues.head(50)
+    hybrid.index_version()
+    for _ in range(100):
+        if hybrid.lexical.version == "v2":
+            break
+        time.sleep(0.01)
+    assert hybrid.index_version() != version
+    assert len(hybrid.lexical.texts) == 50
+
+
+def test_searches_follow_the_index_version_without_a_cache(issues, searcher):
+    corpus = {"issues": issues.head(100)}
+    hybrid = HybridSearcher(searcher, corpus["issues"], load_corpus=lambda: corpus["issues"], version_poll_seconds=0)
+    # e.g. a submission ingested into the table the index syncs from
+    new_issue = issues.head(1).assign(Id=-1.0, Original="# Blade lightning strike\n\nAlarm X-9999")
+    corpus["issues"] = pd.concat([issues.head(100), new_issue])
+    searcher.version = "v2"
+    hybrid.search("gearbox", num_results=1)
+    for _ in range(100):
+        if hybrid.lexical.version == "v2":
+            break
+        time.sleep(0.01)
+    assert [i.id for i in hybrid.search("x-9999", num_results=1)] == [-1.0]
+
+
+def test_corpus_is_loaded_from_the_index_source_table(issues, monkeypatch):
+    monkeypatch.setenv("HYBRID_CORPUS_TABLE", "issues")
+    monkeypatch.delenv("HYBRID_CORPUS_PATH", raising=False)
+    tables = []
+
+    def read_table_chunks(workspace_client, table):
+        tables.append(table)
+        return [issues.head(10), issues.iloc[10:15]]
+
+    monkeypatch.setattr(index_builder, "read_table_chunks", read_table_chunks)
+    monkeypatch.setattr(resources, "get_workspace_client", lambda: None)
+    corpus = hybrid_search.load_hybrid_corpus()
+    assert tables == ["issues"]
+    assert corpus["Id"].tolist() == issues["Id"].head(15).tolist()
+
+
+def test_fetch_originals_falls_through_to_the_wrapped_searcher(issues):
+    class OriginalsSearcher(FakeSearcher):
+        def fetch_originals(self, ids):
+            return {i: f"original {i}" for i in ids if i == 10_000.0}
+
+    hybrid = HybridSearcher(OriginalsSearcher(issues), issues.head(10))
+    assert hybrid.fetch_originals([1.0, 10_000.0, 20_000.0]) == {
+        1.0: issues["Original"].iloc[1],
+        10_000.0: "original 10000.0",
+    }
@@ -0,0 +1,81 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import synthetic_issues
+from src.index_builder import build_snapshot, publish
+from src.local_index import (
+    EMBEDDINGS_FILE,
+    IVF_CENTROIDS_FILE,
+    MANIFEST_FILE,
+    LocalVectorIndex,
+    ivf_assignments,
+    ivf_lists,
+    normalize,
+)
+
+
+def build(root, chunks, embed, **kwargs):
+    snapshot = build_snapshot(root, chunks, embed, model="fake", max_workers=1, **kwargs)
+    publish(root, snapshot)
+    return snapshot, json.loads((snapshot / MANIFEST_FILE).read_text())
+
+
+def test_snapshot_embeddings_are_the_normalized_vectors(tmp_path, issues, embed):
+    snapshot, manifest = build(tmp_path, [issues.head(300), issues.iloc[300:500]], embed, n_lists=0)
+    embeddings = np.load(snapshot / EMBEDDINGS_FILE)
+    assert embeddings.shape == (500, embed.dim) == (manifest["n_rows"], manifest["dim"])
+    np.testing.assert_allclose(embeddings, normalize(embed(issues["Summary"].head(500).tolist())), rtol=1e-5)
+
+
+def test_no_ivf_lists_by_default_for_exact_search(tmp_path, issues, embed):
+    snapshot, manifest = build(tmp_path, [issues.head(100)], embed)
+    assert manifest["ivf"] is None
+    assert not (snapshot / IVF_CENTROIDS_FILE).exists()
+    # IVF search falls back to exact search
+    index = LocalVectorIndex.load(tmp_path)
+    assert index.search(embed(["gearbox"]), k=3, mode="ivf")[1].shape == (1, 3)
+
+
+def test_upserted_issues_are_assigned_to_the_current_centroids(tmp_path, issues, embed):
+    first, first_manifest = build(tmp_path, [issues.head(1000)], embed, n_lists=16)
+    assert first_manifest["ivf"]["retrained"]
+    changed = issues.iloc[[3, 5]].assign(Summary=lambda df: df["Summary"] + " Update the controller firmware.")
+    second, manifest = build(tmp_path, [changed, issues.iloc[1000:1200]], embed, upsert=True, delete_ids=[7.0])
+    assert not manifest["ivf"]["retrained"]
+    np.testing.assert_array_equal(np.load(second / IVF_CENTROIDS_FILE), np.load(first / IVF_CENTROIDS_FILE))
+
+    index = LocalVectorIndex.load(tmp_path)
+    assert len(index.metadata) == 1000 + 200 - 1
+    # Every row is in the list of its closest centroid
+    centroids, list_offsets, list_rows = index.ivf
+    assignments = ivf_assignments(list_offsets, list_rows)
+    np.testing.assert_array_equal(assignments, np.argmax(index.embeddings @ centroids.T, axis=1))
+    queries = embed(["gearbox high vibration", "firmware update"])
+    np.testing.assert_array_equal(index.search(queries, k=10, mode="ivf", nprobe=16)[1], index.search(queries, k=10)[1])
+
+
+def test_centroids_are_retrained_once_the_index_doubled(tmp_path, issues, embed):
+    build(tmp_path, [issues.head(400)], embed, n_lists=8)
+    _, manifest = build(tmp_path, [issues.iloc[400:1000]], embed, upsert=True)
+    assert manifest["ivf"]["retrained"]
+    assert manifest["ivf"]["trained_rows"] == 1000
+
+
+def test_centroids_are_retrained_when_the_new_issues_drift(tmp_path, issues, embed):
+    build(tmp_path, [issues.head(500)], embed, n_lists=8)
+    unrelated = pd.DataFrame(
+        {**synthetic_issues(100, seed=7).drop(columns="Summary"), "Summary": [f"word{i} other{i}" for i in range(100)]}
+    ).assign(Id=lambda df: df["Id"] + 10_000)
+    _, manifest = build(tmp_path, [unrelated], embed, upsert=True)
+    assert manifest["ivf"]["retrained"]
+
+
+@pytest.mark.parametrize("n_lists", [1, 5])
+def test_ivf_lists_round_trip(n_lists):
+    assignments = np.random.default_rng(0).integers(n_lists, size=50)
+    list_offsets, list_rows = ivf_lists(assignments, n_lists)
+    assert list_offsets[-1] == 50
+    np.testing.assert_array_equal(ivf_assignments(list_offsets, list_rows), assignments)
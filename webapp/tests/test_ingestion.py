@@ -0,0 +1,100 @@
+import os
+import time
+
+import pandas as pd
+import pytest
+
+from src.context_builder import SUMMARY_SECTIONS, parse_summary
+from src.index_builder import build_snapshot, prune, publish
+from src.ingestion import IngestionQueue, IngestionWriter, Submission
+from src.local_index import CURRENT_FILE, SNAPSHOTS_DIR, LocalVectorIndex
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return IngestionQueue(tmp_path / "queue.sqlite")
+
+
+def submission(description="Gearbox high vibration at rated power"):
+    return Submission(description=description, recommendation="Re-torque the bolts", similar_issue_ids=[3.0, 7.0])
+
+
+def test_submission_summary_has_the_summarization_jobs_sections():
+    row = submission().to_row()
+    assert row["Id"] < 0
+    sections = parse_summary(str(row["Summary"]))
+    assert tuple(sections) == SUMMARY_SECTIONS
+    assert sections["Symptoms"] == "Gearbox high vibration at rated power"
+    assert sections["Recommendation"] == "Re-torque the bolts"
+
+
+def test_claimed_submissions_are_leased(queue):
+    queue.put(first := submission())
+    queue.put(submission("Yaw drive abnormal noise"))
+    claimed = queue.claim(limit=1, lease_seconds=60)
+    assert [(s.id, written) for s, written in claimed] == [(first.id, False)]
+    # Another writer only gets the unclaimed one
+    assert [s.description for s, _ in queue.claim(limit=10)] == ["Yaw drive abnormal noise"]
+    assert queue.claim(limit=10) == []
+
+
+def test_expired_leases_are_claimed_again(queue):
+    queue.put(first := submission())
+    queue.claim(limit=1, lease_seconds=0.05)
+    time.sleep(0.06)
+    assert [s.id for s, _ in queue.claim(limit=1)] == [first.id]
+
+
+def test_failed_submissions_are_retried_after_a_backoff(queue):
+    queue.put(first := submission())
+    queue.claim(limit=1)
+    queue.fail([first.id], "ConnectionError: down")
+    assert queue.claim(limit=1) == []
+    queue._connection().execute("UPDATE submissions SET next_attempt_at = 0")
+    assert [s.id for s, _ in queue.claim(limit=1)] == [first.id]
+
+
+def test_writer_does_not_repeat_the_completed_stage(queue):
+    written, upserted = [], []
+
+    def upsert(rows):
+        upserted.append(rows)
+        if len(upserted) == 1:
+            raise ConnectionError("index down")
+
+    queue.put(first := submission())
+    writer = IngestionWriter(queue, write_table=written.append, upsert_index=upsert)
+    assert writer.flush() == 0
+    queue._connection().execute("UPDATE submissions SET next_attempt_at = 0")
+    assert writer.flush() == 1
+    assert len(written) == 1 and len(upserted) == 2
+    assert upserted[1]["Id"].tolist() == [first.id]
+    assert queue.depth() == 0
+
+
+def test_upserted_snapshot_has_the_new_issues(tmp_path, issues, embed):
+    publish(tmp_path, build_snapshot(tmp_path, [issues.head(100)], embed, model="fake", n_lists=0))
+    new = pd.DataFrame([submission().to_row()])
+    publish(tmp_path, build_snapshot(tmp_path, [new], embed, model="fake", upsert=True, n_lists=0))
+    index = LocalVectorIndex.load(tmp_path)
+    assert len(index.metadata) == 101
+    assert index.manifest["n_embedded"] == 1
+
+
+def test_prune_keeps_unfinished_snapshots_of_builds_in_progress(tmp_path, issues, embed):
+    for _ in range(3):
+        publish(tmp_path, build_snapshot(tmp_path, [issues.head(10)], embed, model="fake", n_lists=0))
+    snapshots = tmp_path / SNAPSHOTS_DIR
+    finished = sorted(p.name for p in snapshots.iterdir())
+    in_progress = snapshots / ".20260101T000000000000Z.1.tmp"
+    abandoned = snapshots / ".20250101T000000000000Z.2.tmp"
+    own = snapshots / f".20260101T000000000000Z.{os.getpid()}.tmp"
+    for path in (in_progress, abandoned, own):
+        path.mkdir()
+        (path / "embeddings.f32").touch()
+    os.utime(abandoned / "embeddings.f32", (0, 0))
+    os.utime(abandoned, (0, 0))
+
+    prune(tmp_path, keep=2)
+    assert sorted(p.name for p in snapshots.iterdir()) == sorted([in_progress.name, *finished[-2:]])
+    assert (tmp_path / CURRENT_FILE).read_text() == finished[-1]
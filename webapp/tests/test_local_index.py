@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from src.local_index import (
+    CURRENT_FILE,
+    SNAPSHOTS_DIR,
+    LocalVectorIndex,
+    LocalVectorSearcher,
+    normalize,
+    recall_at_k,
+    resolve_snapshot,
+    write_snapshot,
+)
+
+
+@pytest.fixture(scope="module")
+def index(tmp_path_factory, issues, embeddings):
+    path = tmp_path_factory.mktemp("index")
+    write_snapshot(path, embeddings, issues, n_lists=16)
+    # A small chunk size, so that exact search merges the top-k of several chunks
+    index = LocalVectorIndex.load(path)
+    index.chunk_size = 256
+    return index
+
+
+def brute_force(embeddings, queries, k, rows=None):
+    rows = np.arange(len(embeddings)) if rows is None else rows
+    scores = normalize(queries) @ normalize(embeddings[rows]).T
+    return rows[np.argsort(-scores, axis=1, kind="stable")[:, :k]]
+
+
+def test_exact_search_matches_brute_force(index, embeddings, embed):
+    queries = embed(["gearbox high vibration", "pitch motor overtemperature alarms", "yaw drive abnormal noise"])
+    scores, indices = index.search(queries, k=10)
+    np.testing.assert_array_equal(indices, brute_force(embeddings, queries, k=10))
+    assert (np.diff(scores, axis=1) <= 0).all()
+
+
+def test_exact_search_only_scans_the_filtered_rows(index, issues, embeddings, embed):
+    queries = embed(["main bearing oil leakage"])
+    rows = index.filter_rows({"Market": ["US", "Spain"], "Site": issues["Site"].iloc[0]})
+    expected_rows = np.flatnonzero(
+        issues["Market"].isin(["US", "Spain"]).to_numpy() & (issues["Site"] == issues["Site"].iloc[0]).to_numpy()
+    )
+    np.testing.assert_array_equal(rows, expected_rows)
+    _, indices = index.search(queries, k=5, rows=rows)
+    np.testing.assert_array_equal(indices, brute_force(embeddings, queries, k=5, rows=expected_rows))
+
+
+def test_search_with_no_matching_rows_is_empty(index, embed):
+    rows = index.filter_rows({"Market": "Atlantis"})
+    scores, indices = index.search(embed(["gearbox"]), k=5, rows=rows)
+    assert scores.shape == indices.shape == (1, 0)
+
+
+def test_ivf_search_probing_every_list_is_exact(index, embed):
+    queries = embed(["generator insulation resistance faults", "converter unexpected shutdowns"])
+    exact_scores, exact_indices = index.search(queries, k=10)
+    scores, indices = index.search(queries, k=10, mode="ivf", nprobe=16)
+    np.testing.assert_array_equal(indices, exact_indices)
+    np.testing.assert_allclose(scores, exact_scores, rtol=1e-5)
+
+
+def test_ivf_search_recall_grows_with_nprobe(index, embed):
+    queries = embed([f"{c} high vibration" for c in ("gearbox", "blade", "generator", "slip ring", "transformer")])
+    _, exact_indices = index.search(queries, k=10)
+    recalls = [recall_at_k(index.search(queries, k=10, mode="ivf", nprobe=n)[1], exact_indices) for n in (1, 4, 16)]
+    assert recalls == sorted(recalls)
+    assert recalls[-1] == 1.0
+
+
+def test_rows_for_ids(index):
+    np.testing.assert_array_equal(index.rows_for_ids([3.0, 1_000_000.0, 0.0]), [3, -1, 0])
+
+
+def test_searcher_returns_the_issue_columns(index, issues, embed):
+    searcher = LocalVectorSearcher(index, embed)
+    results = searcher.search("gearbox high vibration", num_results=3, filters={"Market": "US"})
+    assert len(results) == 3
+    assert all(issue.market == "US" for issue in results)
+    assert [issue.score for issue in results] == sorted((issue.score for issue in results), reverse=True)
+    assert searcher.fetch_originals([results[0].id]) == {results[0].id: issues["Original"].iloc[int(results[0].id)]}
+
+
+def test_snapshot_root_resolves_to_the_current_snapshot(tmp_path):
+    (tmp_path / SNAPSHOTS_DIR / "v1").mkdir(parents=True)
+    (tmp_path / CURRENT_FILE).write_text("v1\n")
+    assert resolve_snapshot(tmp_path) == tmp_path / SNAPSHOTS_DIR / "v1"
+    assert resolve_snapshot(tmp_path / SNAPSHOTS_DIR / "v1") == tmp_path / SNAPSHOTS_DIR / "v1"
@@ -0,0 +1,87 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from conftest import FakeSearcher
+
+from src import orchestration
+from src.orchestration import SearchOrchestrator, description_fingerprint
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        yield executor
+
+
+def test_fingerprint_ignores_case_and_whitespace():
+    assert description_fingerprint("Gearbox  vibration ") == description_fingerprint("gearbox vibration")
+    assert description_fingerprint("gearbox vibration") != description_fingerprint("gearbox vibration", num_results=3)
+    assert description_fingerprint("gearbox", scopes=[{"Site": "A"}]) != description_fingerprint("gearbox")
+
+
+def test_searches_in_flight_are_shared(issues, executor):
+    gate = threading.Event()
+    searcher = FakeSearcher(issues, gate=gate)
+    orchestrator = SearchOrchestrator(searcher, executor)
+    first = orchestrator.submit("gearbox high vibration")
+    assert orchestrator.submit("Gearbox high vibration ") is first
+    gate.set()
+    assert len(first.result()) == 5
+    assert len(searcher.calls) == 1
+
+
+def test_finished_searches_are_shared_until_they_expire(searcher, executor, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(orchestration.time, "monotonic", lambda: now[0])
+    orchestrator = SearchOrchestrator(searcher, executor, result_ttl_seconds=30)
+    first = orchestrator.submit("gearbox high vibration")
+    # The search is kept by a callback of its future, which can run after `result()` returns
+    while not orchestrator._finished:
+        time.sleep(0.001)
+    now[0] += 29
+    assert orchestrator.submit("gearbox high vibration") is first
+    assert len(searcher.calls) == 1
+    now[0] += 1
+    second = orchestrator.submit("gearbox high vibration")
+    assert second is not first
+    assert second.result() == first.result()
+    assert len(searcher.calls) == 2
+
+
+def test_failed_searches_are_not_shared_once_finished(issues, executor):
+    class Searcher(FakeSearcher):
+        def search(self, *args, **kwargs):
+            super().search(*args, **kwargs)
+            raise ConnectionError("index unavailable")
+
+    searcher = Searcher(issues)
+    orchestrator = SearchOrchestrator(searcher, executor, result_ttl_seconds=30)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            orchestrator.search("gearbox high vibration")
+    assert len(searcher.calls) == 2
+    assert not orchestrator._searches
+
+
+def test_finished_searches_are_forgotten_without_a_ttl(searcher, executor):
+    orchestrator = SearchOrchestrator(searcher, executor, result_ttl_seconds=0)
+    first = orchestrator.search("gearbox high vibration")
+    # Caching the results, and invalidating them with the index, is left to the `CachedSearcher`
+    searcher.version = "v2"
+    second = orchestrator.search("gearbox high vibration")
+    assert second == first
+    assert len(searcher.calls) == 2
+    assert not orchestrator._searches
+
+
+def test_scopes_are_filled_from_the_narrowest(issues, searcher, executor):
+    site = issues["Site"].iloc[0]
+    n_site = int((issues["Site"] == site).sum())
+    orchestrator = SearchOrchestrator(searcher, executor)
+    results = orchestrator.search("gearbox", num_results=n_site + 10, scopes=[{"Site": site}])
+    assert len({issue.id for issue in results}) == len(results) == n_site + 10
+    assert all(issue.site == site for issue in results[:n_site])
+    # Both scopes are searched concurrently
+    assert sorted(searcher.calls, key=str) == [("gearbox", None), ("gearbox", {"Site": site})]
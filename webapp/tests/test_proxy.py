@@ -0,0 +1,69 @@
+import asyncio
+
+from tornado import web, websocket
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from src.proxy import make_proxy
+
+
+class EchoHandler(web.RequestHandler):
+    def initialize(self, name):
+        self.name = name
+
+    def get(self, path):
+        self.set_header("X-Upstream", self.name)
+        self.write(f"{self.name} GET {self.request.uri}")
+
+    def post(self, path):
+        self.set_status(201)
+        self.write(f"{self.name} POST {self.request.uri} {self.request.body.decode()}")
+
+
+class EchoWebSocket(websocket.WebSocketHandler):
+    def select_subprotocol(self, subprotocols):
+        return subprotocols[0]
+
+    def on_message(self, message):
+        self.write_message(f"echo {message}")
+
+
+def serve(app):
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    return server, f"http://127.0.0.1:{port}"
+
+
+def test_routes_the_api_and_the_ui_on_one_port():
+    async def run():
+        api, api_url = serve(web.Application([(r"(.*)", EchoHandler, {"name": "api"})]))
+        ui, ui_url = serve(
+            web.Application([(r"/_stcore/stream", EchoWebSocket), (r"(.*)", EchoHandler, {"name": "ui"})])
+        )
+        proxy, proxy_url = serve(make_proxy(api_url, ui_url))
+        client = AsyncHTTPClient()
+        try:
+            search = await client.fetch(f"{proxy_url}/api/search", method="POST", body="{}")
+            assert (search.code, search.body) == (201, b"api POST /search {}")
+            health = await client.fetch(f"{proxy_url}/api?x=1")
+            assert health.body == b"api GET /?x=1"
+            page = await client.fetch(f"{proxy_url}/static/app.js")
+            assert page.body == b"ui GET /static/app.js" and page.headers["X-Upstream"] == "ui"
+
+            connection = await websocket.websocket_connect(
+                f"{proxy_url.replace('http', 'ws')}/_stcore/stream", subprotocols=["streamlit", "token"]
+            )
+            assert connection.selected_subprotocol == "streamlit"
+            await connection.write_message("hello")
+            assert await connection.read_message() == "echo hello"
+            connection.close()
+            # Waits for the closing handshakes, of the proxy's upstream connection too
+            assert await connection.read_message() is None
+            await asyncio.sleep(0.1)
+        finally:
+            for server in (proxy, api, ui):
+                server.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,109 @@
+import threading
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from src import rec_suggestion
+from src.rec_suggestion import GenerationTiming, LLMUnavailableError, _stream_response
+from src.resilience import CircuitBreaker
+
+SMALL, LARGE = "small-model", "large-model"
+
+
+def chunk(content=None, finish_reason=None):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(delta=SimpleNamespace(content=content), finish_reason=finish_reason)], usage=None
+    )
+
+
+class FakeStream:
+    def __init__(self, chunks, on_chunk=None):
+        self.chunks = chunks
+        self.on_chunk = on_chunk
+        self.closed = False
+
+    def __iter__(self):
+        for n, _chunk in enumerate(self.chunks):
+            if self.on_chunk is not None:
+                self.on_chunk(n)
+            yield _chunk
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClient:
+    """Streams the chunks given per model, or raises the error given instead."""
+
+    def __init__(self, streams):
+        self.streams = streams
+        self.calls = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def with_options(self, **kwargs):
+        return self
+
+    def create(self, model, messages, temperature, stream):
+        self.calls.append(model)
+        if isinstance(self.streams[model], Exception):
+            raise self.streams[model]
+        return self.streams[model]
+
+
+@pytest.fixture
+def usages(monkeypatch):
+    monkeypatch.setenv("INSTRUCT_MODEL", LARGE)
+    monkeypatch.setattr(rec_suggestion, "llm_breaker", CircuitBreaker("llm"))
+    monkeypatch.setattr(rec_suggestion, "small_llm_breaker", CircuitBreaker("llm_small"))
+    monkeypatch.setattr(rec_suggestion, "SMALL_MODEL_HOLDBACK_CHUNKS", 4)
+    recorded = []
+    monkeypatch.setattr(rec_suggestion, "record_usage", recorded.append)
+    return recorded
+
+
+def test_cut_off_small_model_escalates_before_yielding(usages):
+    small = FakeStream([chunk("Check "), chunk("the", finish_reason="length")])
+    large = FakeStream([chunk("Replace "), chunk("the pitch bearing."), chunk(finish_reason="stop")])
+    client = FakeClient({SMALL: small, LARGE: large})
+
+    text = "".join(_stream_response(client, "prompt", models=[SMALL, LARGE]))
+
+    assert text == "Replace the pitch bearing."
+    assert client.calls == [SMALL, LARGE]
+    assert small.closed and large.closed
+    assert [(u.model, u.outcome) for u in usages] == [(SMALL, "escalated"), (LARGE, "ok")]
+
+
+def test_cut_off_after_yielding_is_truncated(usages):
+    chunks = [chunk(f"{n} ") for n in range(6)] + [chunk("end", finish_reason="length")]
+    client = FakeClient({SMALL: FakeStream(chunks), LARGE: FakeStream([])})
+
+    text = "".join(_stream_response(client, "prompt", models=[SMALL, LARGE]))
+
+    assert text == "0 1 2 3 4 5 end"
+    assert client.calls == [SMALL]
+    assert [(u.model, u.outcome) for u in usages] == [(SMALL, "truncated")]
+
+
+def test_unavailable_endpoint_is_recorded_as_failed(usages):
+    error = openai.APIConnectionError(request=httpx.Request("POST", "http://endpoint"))
+    client = FakeClient({SMALL: error, LARGE: error})
+
+    with pytest.raises(LLMUnavailableError):
+        "".join(_stream_response(client, "prompt", models=[SMALL, LARGE]))
+
+    assert [(u.model, u.outcome) for u in usages] == [(SMALL, "escalated"), (LARGE, "failed")]
+
+
+def test_cancelled_stream_is_recorded_as_cancelled(usages):
+    cancel_event = threading.Event()
+    stream = FakeStream([chunk(f"{n} ") for n in range(10)], on_chunk=lambda n: n == 3 and cancel_event.set())
+    timing = GenerationTiming()
+
+    text = "".join(_stream_response(FakeClient({LARGE: stream}), "prompt", cancel_event=cancel_event, timing=timing))
+
+    assert text == "0 1 2 "
+    assert timing.cancelled and stream.closed
+    assert [(u.model, u.outcome) for u in usages] == [(LARGE, "cancelled")]
@@ -0,0 +1,13 @@
+import re
+import tomllib
+from pathlib import Path
+
+WEBAPP_DIR = Path(__file__).parents[1]
+
+
+def test_requirements_pin_the_versions_of_the_lock_file():
+    # Regenerate with `poe make-requirements` after `uv lock`
+    locked = {p["name"]: p["version"] for p in tomllib.loads((WEBAPP_DIR / "uv.lock").read_text())["package"]}
+    pinned = re.findall(r"^([\w.-]+)==([^\s;]+)", (WEBAPP_DIR / "requirements.txt").read_text(), re.MULTILINE)
+    assert pinned
+    assert {name: version for name, version in pinned if locked.get(name) != version} == {}
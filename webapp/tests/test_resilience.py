@@ -0,0 +1,191 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from conftest import FakeSearcher
+
+from src import vector_search
+from src.hybrid_search import HybridSearcher
+from src.local_index import METADATA_FILE
+from src.orchestration import SearchOrchestrator
+from src.resilience import CircuitBreaker, CircuitOpenError, HedgedCaller, ResilientSearcher
+from src.search_cache import CachedSearcher, TTLCache
+from src.vector_search import DegradedResults, is_degraded
+
+
+class FailingSearcher:
+    def __init__(self):
+        self.calls = 0
+
+    def search(self, query, cols=(), num_results=5, filters=None):
+        self.calls += 1
+        raise ConnectionError("index unavailable")
+
+
+def fail():
+    raise ConnectionError("down")
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        yield executor
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_seconds=60)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            breaker.call(fail)
+    assert breaker.is_open
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: "ok")
+
+
+def test_breaker_success_resets_the_failure_count():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_seconds=60)
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    assert breaker.call(lambda: "ok") == "ok"
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    assert not breaker.is_open
+
+
+def test_breaker_half_open_lets_one_trial_through():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_seconds=0.05)
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    time.sleep(0.06)
+    assert breaker.allow()
+    # Only one trial at a time while half-open
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open and not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.call(lambda: "ok") == "ok"
+    assert not breaker.is_open
+
+
+def test_hedged_call_sends_a_duplicate_when_slow(executor):
+    hedged = HedgedCaller("test", executor, quantile=0.5)
+    for _ in range(20):
+        hedged.latencies.observe(0.01)
+    calls = []
+
+    def call():
+        calls.append(time.perf_counter())
+        # Only the first call is slow
+        time.sleep(1.0 if len(calls) == 1 else 0.0)
+        return len(calls)
+
+    start = time.perf_counter()
+    assert hedged(call, deadline_seconds=5) == 2
+    assert time.perf_counter() - start < 0.5
+
+
+def test_hedged_call_without_history_does_not_hedge(executor):
+    calls = []
+    hedged = HedgedCaller("test", executor)
+    assert hedged(lambda: calls.append(1) or "ok", deadline_seconds=1) == "ok"
+    assert calls == [1]
+
+
+def test_hedged_call_raises_past_the_deadline(executor):
+    hedged = HedgedCaller("test", executor)
+    with pytest.raises(TimeoutError):
+        hedged(lambda: time.sleep(0.5), deadline_seconds=0.05)
+
+
+def test_hedged_call_raises_the_error(executor):
+    with pytest.raises(ConnectionError):
+        HedgedCaller("test", executor)(fail, deadline_seconds=1)
+
+
+def test_failed_search_falls_back(searcher):
+    failing = FailingSearcher()
+    resilient = ResilientSearcher(failing, fallback=searcher, deadline_seconds=1)
+    results = resilient.search("gearbox", num_results=3)
+    assert isinstance(results, DegradedResults)
+    assert len(results) == 3
+
+
+def test_failed_search_without_fallback_returns_the_last_results(searcher):
+    resilient = ResilientSearcher(searcher, deadline_seconds=1)
+    fresh = resilient.search("gearbox", num_results=3)
+    assert not is_degraded(fresh)
+    resilient.searcher = FailingSearcher()
+    assert resilient.search("Gearbox ", num_results=3) == list(fresh)
+    assert is_degraded(resilient.search("gearbox", num_results=3))
+    assert resilient.search("unknown query", num_results=3) == []
+
+
+def test_fetching_originals_goes_through_the_deadline_and_the_breaker():
+    class Searcher:
+        def __init__(self, originals, delay=0.0):
+            self.originals = originals
+            self.delay = delay
+
+        def search(self, query, cols=(), num_results=5, filters=None):
+            return []
+
+        def fetch_originals(self, ids):
+            time.sleep(self.delay)
+            return {i: self.originals[i] for i in ids if i in self.originals}
+
+    resilient = ResilientSearcher(Searcher({1.0: "index"}, delay=0.5), fallback=Searcher({1.0: "fallback"}))
+    resilient.deadline_seconds = 0.05
+    start = time.perf_counter()
+    # Found from the outermost searcher of the stack
+    assert vector_search.fetch_originals(CachedSearcher(resilient, TTLCache()), [1.0, 2.0]) == {1.0: "fallback"}
+    assert time.perf_counter() - start < 0.4
+    assert resilient.breaker.failures == 1
+
+    resilient.fallback = None
+    assert resilient.fetch_originals([1.0]) == {}
+    resilient.searcher.delay = 0.0
+    assert resilient.fetch_originals([1.0]) == {1.0: "index"}
+
+
+def test_hybrid_results_are_degraded_past_the_vector_budget(issues):
+    gate = threading.Event()
+    hybrid = HybridSearcher(FakeSearcher(issues, gate=gate), issues, vector_budget_seconds=0.01)
+    try:
+        results = hybrid.search("gearbox high vibration", num_results=3)
+    finally:
+        gate.set()
+    assert is_degraded(results)
+    assert len(results) == 3
+    assert not is_degraded(HybridSearcher(FakeSearcher(issues), issues).search("gearbox", num_results=3))
+
+
+def test_degraded_results_are_not_cached(searcher):
+    resilient = ResilientSearcher(FailingSearcher(), fallback=searcher, deadline_seconds=1)
+    cached = CachedSearcher(resilient, TTLCache())
+    assert is_degraded(cached.search("gearbox", num_results=3))
+    assert is_degraded(cached.search("gearbox", num_results=3))
+    assert cached.cache.stats.hits == 0
+
+
+def test_degraded_flag_survives_the_searcher_stack(tmp_path, monkeypatch, issues, searcher):
+    issues.to_parquet(tmp_path / METADATA_FILE)
+    monkeypatch.setenv("LOCAL_INDEX_PATH", str(tmp_path))
+    monkeypatch.setattr(vector_search, "HYBRID_SEARCH", True)
+    monkeypatch.setattr(vector_search, "SEARCH_CACHE_SIZE", 16)
+    failing = FailingSearcher()
+    backend = ResilientSearcher(failing, fallback=searcher, deadline_seconds=1)
+    monkeypatch.setattr(vector_search, "_get_backend_searcher", lambda: backend)
+    vector_search.get_vector_searcher.clear()
+    try:
+        stack = vector_search.get_vector_searcher()
+        assert isinstance(stack, CachedSearcher) and isinstance(stack.searcher, HybridSearcher)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            orchestrator = SearchOrchestrator(stack, executor)
+            site = issues["Site"].iloc[0]
+            for _ in range(2):
+                assert is_degraded(orchestrator.search("gearbox high vibration", scopes=[{"Site": site}]))
+        # Not cached, so the index is retried by every search (by the fallback too, unless it is cancelled in time)
+        assert 2 <= failing.calls <= 4
+    finally:
+        vector_search.get_vector_searcher.clear()
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from src.scada import lttb_downsample, min_max_downsample
+
+
+@pytest.fixture
+def signal():
+    rng = np.random.default_rng(0)
+    x = np.arange(10_000, dtype=np.int64)
+    y = np.sin(x / 500) + rng.normal(0, 0.05, len(x))
+    y[1234], y[7777] = 10.0, -10.0
+    return x, y
+
+
+@pytest.mark.parametrize("downsample", [min_max_downsample, lttb_downsample])
+def test_keeps_the_budget_order_and_ends(signal, downsample):
+    x, y = signal
+    xs, ys = downsample(x, y, 200)
+    assert 3 <= len(xs) <= 200
+    assert (np.diff(xs) > 0).all()
+    np.testing.assert_array_equal(ys, y[xs])
+    # Min-max keeps the extremes of the first and last buckets, LTTB the first and last points
+    assert xs[0] < 50 and xs[-1] > len(x) - 50
+
+
+@pytest.mark.parametrize("downsample", [min_max_downsample, lttb_downsample])
+def test_keeps_the_spikes(signal, downsample):
+    x, y = signal
+    xs, _ = downsample(x, y, 200)
+    assert {1234, 7777} <= set(xs.tolist())
+
+
+@pytest.mark.parametrize("downsample", [min_max_downsample, lttb_downsample])
+def test_short_signals_are_returned_without_their_gaps(downsample):
+    x = np.arange(10)
+    y = np.arange(10, dtype=np.float64)
+    y[3] = np.nan
+    xs, ys = downsample(x, y, 100)
+    np.testing.assert_array_equal(xs, [0, 1, 2, 4, 5, 6, 7, 8, 9])
+    np.testing.assert_array_equal(ys, xs)
+
+
+def test_min_max_keeps_every_bucket_extremes(signal):
+    x, y = signal
+    _, ys = min_max_downsample(x, y, 200)
+    buckets = y.reshape(100, 100)
+    np.testing.assert_array_equal(np.sort(ys), np.sort(np.concatenate([buckets.min(axis=1), buckets.max(axis=1)])))
+
+
+def test_lttb_keeps_exactly_the_budget_of_datetimes(signal):
+    _, y = signal
+    x = np.datetime64("2026-01-01T00:00") + np.arange(len(y)) * np.timedelta64(10, "m")
+    xs, _ = lttb_downsample(x, y, 500)
+    assert len(xs) == 500 and xs.dtype == x.dtype
+    assert xs[0] == x[0] and xs[-1] == x[-1]
+    assert (np.diff(xs) > np.timedelta64(0)).all()
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from src import search_cache
+from src.search_cache import CachedSearcher, TTLCache, cached_embedder, normalize_query
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(search_cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_entries_expire_after_their_ttl(clock):
+    cache = TTLCache[str](ttl_seconds=10)
+    cache.put("key", "value")
+    clock[0] += 9.9
+    assert cache.get("key") == "value"
+    clock[0] += 0.1
+    assert cache.get("key") is None
+
+
+def test_evicts_the_least_recently_used():
+    cache = TTLCache[int](max_size=2, ttl_seconds=None)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+
+
+def test_stats_count_hits_misses_and_saved_latency():
+    cache = TTLCache[int]()
+    assert cache.get_or_compute("key", lambda: 1) == 1
+    cache.put("other", 2, compute_seconds=0.5)
+    assert cache.get("other") == 2
+    assert cache.get_or_compute("key", lambda: 2) == 1
+    assert (cache.stats.hits, cache.stats.misses) == (2, 1)
+    assert cache.stats.hit_rate == pytest.approx(2 / 3)
+    assert cache.stats.latency_saved_s >= 0.5
+
+
+def test_normalize_query():
+    assert normalize_query("  Gearbox  OIL\ttemperature ") == normalize_query("gearbox oil temperature")
+
+
+def test_cached_searcher_serves_repeated_queries_from_the_cache(searcher):
+    cached = CachedSearcher(searcher, TTLCache(), version_poll_seconds=0)
+    first = cached.search("Pitch bearing noise", num_results=3)
+    assert cached.search("pitch   bearing noise ", num_results=3) is first
+    cached.search("Pitch bearing noise", num_results=4)
+    assert len(searcher.calls) == 2
+
+
+def test_cached_searcher_drops_the_cache_when_the_index_version_changes(searcher):
+    cached = CachedSearcher(searcher, TTLCache(), version_poll_seconds=0)
+    cached.search("query")
+    searcher.version = "v2"
+    cached.search("query")
+    assert len(searcher.calls) == 2
+    assert cached.index_version() == "v2"
+
+
+def test_cached_searcher_polls_the_version_until_refreshed(searcher, clock):
+    cached = CachedSearcher(searcher, TTLCache(ttl_seconds=None), version_poll_seconds=60)
+    cached.search("query")
+    searcher.version = "v2"
+    cached.search("query")
+    assert len(searcher.calls) == 1
+    cached.refresh()
+    cached.search("query")
+    assert len(searcher.calls) == 2
+
+
+def test_cached_searcher_searches_the_misses_of_a_batch_together(searcher):
+    cached = CachedSearcher(searcher, TTLCache(), version_poll_seconds=0)
+    cached.search("a")
+    searcher.search_batch = lambda queries, **kwargs: [searcher.search(q, **kwargs) for q in queries]
+    results = cached.search_batch(["a", "b", "c"])
+    assert len(results) == 3
+    assert [call[0] for call in searcher.calls] == ["a", "b", "c"]
+    assert cached.search_batch(["A", "b "]) == results[:2]
+    assert len(searcher.calls) == 3
+
+
+def test_cached_embedder_embeds_each_normalized_query_once():
+    embedded = []
+
+    def embed(texts):
+        embedded.extend(texts)
+        return np.array([[len(t), 1.0] for t in texts])
+
+    cached = cached_embedder(embed, TTLCache())
+    cached(["Yaw error", "grid fault"])
+    vectors = cached(["yaw  error", "Grid fault", "converter trip"])
+    assert embedded == ["Yaw error", "grid fault", "converter trip"]
+    assert vectors.shape == (3, 2)
@@ -0,0 +1,110 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from src.vector_search import (
+    DegradedResults,
+    IssueRecords,
+    SimilarIssue,
+    VectorSearcher,
+    issue_fields,
+    issue_ids,
+    search_scoped,
+)
+
+COLS = ("Id", "Market", "Site", "Turbine", "Title", "Summary")
+
+
+@pytest.fixture
+def records():
+    columns = [
+        [1.0, 2.0, 3.0],
+        ["NA", "EU", "EU"],
+        ["S1", "S2", "S3"],
+        ["T1", "T2", "T3"],
+        ["Pitch", "Yaw", "Gearbox"],
+        ["a", "b", "c"],
+    ]
+    return IssueRecords(issue_fields(COLS), columns, np.array([0.9, 0.8, 0.7]))
+
+
+def test_issue_fields_checks_the_columns():
+    assert issue_fields(COLS) == ("id", "market", "site", "turbine", "title", "summary")
+    with pytest.raises(ValueError, match="Unexpected index columns"):
+        issue_fields((*COLS, "Alarm"))
+    with pytest.raises(ValueError, match="Missing index columns"):
+        issue_fields(("Id", "Title"))
+
+
+def test_records_are_decoded_lazily_and_once(records):
+    assert records._issues == [None] * 3
+    issue = records[1]
+    assert records._issues[0] is None and records._issues[2] is None
+    assert records[1] is issue
+    assert (issue.id, issue.market, issue.title, issue.score) == (2.0, "EU", "Yaw", pytest.approx(0.8))
+    assert isinstance(issue.score, float)
+
+
+def test_records_iterate_and_slice(records):
+    assert [i.title for i in records] == ["Pitch", "Yaw", "Gearbox"]
+    head = records[:2]
+    assert isinstance(head, IssueRecords)
+    assert len(head) == 2
+    assert [i.summary for i in head] == ["a", "b"]
+    assert records[-1].id == 3.0
+
+
+def test_ids_do_not_decode_the_records(records):
+    assert issue_ids(records) == [1.0, 2.0, 3.0]
+    assert records._issues == [None] * 3
+    assert IssueRecords(issue_fields(COLS), [], ()).ids == []
+    assert issue_ids(list(records)) == [1.0, 2.0, 3.0]
+
+
+def test_search_scoped_keeps_the_degraded_marker(records):
+    class Searcher:
+        def search(self, query, cols=COLS, num_results=5, filters=None):
+            return records[:1] if filters else DegradedResults(records)
+
+    results = search_scoped(Searcher(), "query", [{"Site": "S1"}], num_results=3)
+    assert [i.id for i in results] == [1.0, 2.0, 3.0]
+    assert isinstance(results, DegradedResults)
+
+
+def test_search_scoped_searches_the_scopes_concurrently(records):
+    started = threading.Barrier(3, timeout=5)
+
+    class Searcher:
+        def search(self, query, cols=COLS, num_results=5, filters=None):
+            # Each scope waits for the two others: sequential searches would time out
+            started.wait()
+            return records[:1] if filters else records
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        scopes = [{"Site": "S1", "Turbine": "T1"}, {"Site": "S1"}]
+        results = search_scoped(Searcher(), "query", scopes, num_results=3, executor=executor)
+    assert [i.id for i in results] == [1.0, 2.0, 3.0]
+    assert not isinstance(results, DegradedResults)
+
+
+def test_vector_searcher_decodes_the_columnar_results(monkeypatch):
+    for name in ("INDEX_PRIMARY_KEY", "INDEX_ENDPOINT_NAME", "INDEX_NAME"):
+        monkeypatch.setenv(name, name.lower())
+    data = [[1.0, "NA", "S1", "T1", "Pitch", "a", 0.9], [2.0, "EU", "S2", "T2", "Yaw", "b", 0.8]]
+    response = {
+        "manifest": {"columns": [{"name": c} for c in (*COLS, "score")]},
+        "result": {"data_array": data},
+    }
+    index = SimpleNamespace(similarity_search=lambda **kwargs: response)
+    searcher = VectorSearcher(SimpleNamespace(get_index=lambda **kwargs: index))
+
+    results = searcher.search("query", cols=COLS)
+    assert isinstance(results, IssueRecords)
+    assert results.ids == [1.0, 2.0]
+    assert results[1] == SimilarIssue(id=2.0, market="EU", site="S2", turbine="T2", title="Yaw", summary="b", score=0.8)
+
+    response["result"] = {}
+    assert len(searcher.search("query", cols=COLS)) == 0